@@ -0,0 +1,650 @@
+"""Micro-benchmarks for the Materializer plugin.
+
+Like the `test_*_frame.py` helpers, these require access to EDMC modules.
+
+Usage: python benchmarks.py [name ...]
+"""
+
+from __future__ import print_function
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import threading
+import timeit
+from Queue import Queue
+
+from material_api import LOGGER, LOG_DEBUG, LOG_ERROR, LOG_INFO, LOG_OUTPUT
+from body_predicates import compile_predicate
+from edsm_async import AsyncEDSMQueries
+from edsm_cache import EDSMCache
+from edsm_metrics import EDSMMetrics
+from edsm_projection import BODIES_PROJECTION
+from edsm_queries import EDSMQueries
+from edsm_standin import StandInEDSM, fixed_latency, lognormal_latency
+from log_writer import LogWriter
+from material_api import CompiledFilterSet, MaterialFilter, MaterialMatch, Materials, numpy
+from material_pipeline import BodiesMatcher, MatchSnapshot
+from material_rules import MaterialRuleSet, merge_matches, parse_rule
+from material_scoring import MaterialScorer
+from quantile_sketch import SketchSet
+from rate_limiter import TokenBucket
+from threshold_tables import generate, iter_chunks, process_chunk
+
+
+FIXTURE_SOL = os.path.sep.join(['fixtures', 'edsm-system-body-sol.json'])
+
+
+def load_fixture(filename=FIXTURE_SOL):
+    """Load an EDSM api-system-v1/bodies reply."""
+
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def benchmark_filters():
+    """Compare per-filter `MaterialFilter.check_match` with `CompiledFilterSet` on the Sol fixture."""
+
+    bodies = [body.get('materials') for body in load_fixture()['bodies']]
+    filters = [MaterialFilter(material, 2.0) for material in Materials.items()]
+    compiled = CompiledFilterSet(filters)
+
+    def per_filter():
+        """Evaluate every filter against every body."""
+        for materials in bodies:
+            if materials:
+                [f.check_match(materials) for f in filters]
+
+    def single_pass():
+        """Evaluate the compiled set once per body."""
+        for materials in bodies:
+            compiled.check_matches(materials)
+
+    _report('filters: per filter', per_filter, len(bodies))
+    _report('filters: compiled', single_pass, len(bodies))
+
+
+def benchmark_batch():
+    """Compare per-body evaluation with batch evaluation (NumPy and pure python) of many bodies."""
+
+    bodies = [body.get('materials') for body in load_fixture()['bodies']] * 250
+    compiled = CompiledFilterSet([MaterialFilter(material, 2.0) for material in Materials.items()])
+
+    def per_body():
+        """Evaluate one body at a time."""
+        for materials in bodies:
+            compiled.check_matches(materials)
+
+    _report('batch: per body', per_body, len(bodies), number=3)
+    _report('batch: pure python', lambda: compiled.check_batch(bodies, use_numpy=False), len(bodies), number=3)
+    if numpy is not None:
+        _report('batch: numpy', lambda: compiled.check_batch(bodies), len(bodies), number=3)
+
+
+def benchmark_logging():
+    """Show that the per-body cost at INFO does not depend on the size of the debug messages.
+
+    Every material item carries a padding field which only shows up in the debug output of
+    `MaterialFilter.check_match`.
+    """
+
+    filters = [MaterialFilter(material, 2.0) for material in Materials.items()]
+    fixture = [body.get('materials') for body in load_fixture()['bodies'] if body.get('materials')]
+
+    for padding in (0, 1000):
+        bodies = [
+            [{'Name': name, 'Percent': percent, 'Padding': 'x' * padding} for name, percent in materials.items()]
+            for materials in fixture
+        ]
+
+        def per_body(bodies=bodies):
+            """Evaluate every filter against every body."""
+            for materials in bodies:
+                [f.check_match(materials) for f in filters]
+
+        for level, number in ((LOG_INFO, 20), (LOG_DEBUG, 1)):
+            LOGGER.logLevel = level
+            stdout, writer = sys.stdout, LOGGER.writer
+            sys.stdout, LOGGER.writer = open(os.devnull, 'w'), None
+            try:
+                best = min(timeit.repeat(per_body, number=number, repeat=3))
+            finally:
+                sys.stdout.close()
+                sys.stdout, LOGGER.writer = stdout, writer
+            print("{label:<40} {usec:10.2f} usec/item".format(
+                label='logging: {level} padding={padding}'.format(level=LOG_OUTPUT[level], padding=padding),
+                usec=best / number / len(bodies) * 1e6,
+            ))
+    LOGGER.logLevel = LOG_ERROR
+
+
+def benchmark_log_writer():
+    """Compare the caller side cost of a synchronous print with the background `LogWriter`.
+
+    Output goes to a stream which takes 0.2ms per write, like a slow console.
+    """
+
+    class SlowStream(object):
+        """A stream with slow writes."""
+
+        def write(self, _data):  # pylint: disable=no-self-use
+            """Take some time to write."""
+            time.sleep(0.0002)
+
+        def flush(self):
+            """Nothing to flush."""
+
+    record = "Materializer > INFO: " + "x" * 80
+    stdout = sys.stdout
+    sys.stdout = SlowStream()
+    writer = LogWriter(max_queue=100000)
+    try:
+        start = time.time()
+        for _i in range(1000):
+            print(record)
+        synchronous = time.time() - start
+
+        start = time.time()
+        for _i in range(1000):
+            writer.write(record)
+        queued = time.time() - start
+        writer.flush()
+        flushed = time.time() - start
+        writer.stop()
+    finally:
+        sys.stdout = stdout
+
+    for label, seconds in (('synchronous print', synchronous), ('LogWriter caller side', queued),
+                           ('LogWriter until flushed', flushed)):
+        print("{label:<40} {usec:10.2f} usec/item".format(label='log writer: ' + label, usec=seconds / 1000 * 1e6))
+
+
+def benchmark_memory():
+    """Count the bytes used by 100k `MaterialMatch`es with a `__dict__` layout and with the slotted, interned one.
+
+    Percentages are drawn with 2 decimals, like EDSM reports them. The interned figure includes the interning
+    table: it's dict, key tuples and weak references.
+    """
+
+    class DictMatch(object):  # pylint: disable=too-few-public-methods
+        """`MaterialMatch` layout before `__slots__` and interning."""
+
+        def __init__(self, material, percent):
+            """Create a new `DictMatch`."""
+            self.material = material
+            self.percent = percent
+
+    generator = random.Random(1)
+    materials = Materials.items()
+    values = [(generator.choice(materials), round(generator.uniform(0.0, 30.0), 2)) for _i in range(100000)]
+
+    for label, factory in (('__dict__', DictMatch), ('__slots__ + interned', MaterialMatch)):
+        matches = [factory(material, percent) for material, percent in values]
+        unique = dict((id(match), match) for match in matches).values()
+        size = sum(sys.getsizeof(match) for match in unique)
+        size += sum(sys.getsizeof(match.__dict__) for match in unique if hasattr(match, '__dict__'))
+        if factory is MaterialMatch:
+            table = MaterialMatch._interned.data  # pylint: disable=protected-access
+            size += sys.getsizeof(table) + sum(sys.getsizeof(key) + sys.getsizeof(ref) for key, ref in table.items())
+        print("{label:<40} {size:10d} bytes per 100k matches ({count} instances)".format(
+            label='memory: ' + label,
+            size=size,
+            count=len(unique),
+        ))
+
+
+def benchmark_cache():
+    """Time storing and serving the Sol fixture from an on-disk `EDSMCache`."""
+
+    reply = load_fixture()
+    directory = tempfile.mkdtemp()
+    try:
+        cache = EDSMCache(os.path.join(directory, 'cache.sqlite'))
+        _report('cache: put Sol', lambda: cache.put('api-system-v1', 'bodies', {'systemName': 'Sol'}, reply), 1,
+                number=50)
+        _report('cache: hit Sol', lambda: cache.get('api-system-v1', 'bodies', {'systemName': 'Sol'}), 1)
+        cache.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_metrics():
+    """Time recording a latency and a counter, the overhead the metrics add to a request."""
+
+    metrics = EDSMMetrics()
+    _report('metrics: observe', lambda: metrics.observe('http', 0.123, 'api-system-v1', 'bodies'), 1, number=100000)
+    _report('metrics: count', lambda: metrics.count('retries', 1, 'api-system-v1', 'bodies'), 1, number=100000)
+
+
+def benchmark_thresholds():
+    """Split the time of generating threshold tables from a 50k bodies dump over reading, parsing and merging.
+
+    Reading and merging happen in the parent process, parsing and summarizing in the workers. Each worker sends its
+    sketches once, so the parent merges one `SketchSet` per process. With enough cpus generating takes about as long
+    as the parent's share, the cpu time of the parent and of the workers is reported to show how far it scales.
+    """
+
+    generator = random.Random(1)
+    bodies = [body for body in load_fixture()['bodies'] if body.get('materials')]
+    directory = tempfile.mkdtemp()
+    try:
+        dump = os.path.join(directory, 'bodies.json')
+        with open(dump, 'w') as dump_file:
+            dump_file.write('[\n')
+            for index in range(50000):
+                body = dict(generator.choice(bodies), id=index)
+                body['materials'] = dict((name, round(percent * generator.uniform(0.5, 1.5), 2))
+                                         for name, percent in body['materials'].items())
+                dump_file.write(json.dumps(body) + (',\n' if index < 49999 else '\n'))
+            dump_file.write(']\n')
+
+        started = time.time()
+        chunks = list(iter_chunks(dump))
+        reading = time.time() - started
+        started = time.time()
+        (_count, dump_sketches, dump_sub_types) = process_chunk([line for chunk in chunks for line in chunk])
+        parsing = time.time() - started
+        started = time.time()
+        everything = SketchSet()
+        sub_types = dict()
+        everything.merge(SketchSet.from_dict(dump_sketches))
+        for sub_type, sketches in dump_sub_types.items():
+            sub_types.setdefault(sub_type, SketchSet()).merge(SketchSet.from_dict(sketches))
+        merging = time.time() - started
+        for label, seconds in (('read (parent)', reading), ('parse and summarize (workers)', parsing)):
+            print("{label:<40} {usec:10.2f} usec/body".format(label='thresholds: ' + label, usec=seconds / 50000 * 1e6))
+        print("{label:<40} {msec:10.2f} msec/process".format(label='thresholds: merge (parent)', msec=merging * 1e3))
+
+        for processes in sorted(set((1, 2, multiprocessing.cpu_count()))):
+            started = time.time()
+            parent = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            generate(dump, processes)
+            wall = time.time() - started
+            parent = _cpu_seconds(resource.getrusage(resource.RUSAGE_SELF)) - _cpu_seconds(parent)
+            children = _cpu_seconds(resource.getrusage(resource.RUSAGE_CHILDREN)) - _cpu_seconds(children)
+            print("{label:<40} {usec:10.2f} usec/body (cpu: parent {parent:.2f}, workers {workers:.2f}, "
+                  "at most {bound:.1f}x faster with more cpus)".format(
+                      label='thresholds: generate, {processes} processes'.format(processes=processes),
+                      usec=wall / 50000 * 1e6,
+                      parent=parent / 50000 * 1e6,
+                      workers=children / 50000 * 1e6,
+                      bound=(parent + children) / max(parent, 1e-6),
+                  ))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_workers():
+    """Time 20 bodies requests against a local server with 50ms latency, for several pool sizes."""
+
+    class Root(object):  # pylint: disable=too-few-public-methods
+        """Stands in for the Tk root."""
+
+        def event_generate(self, event, **kwargs):
+            """Ignore the event."""
+
+    stand_in = StandInEDSM(template='Sol', latency=fixed_latency(0.05)).start()
+    base_url = stand_in.base_url
+    requests = 20
+    try:
+        for label, workers, limits in (('1 worker', 1, None), ('4 workers', 4, None), ('4 workers, no limits', 4, {})):
+            queries = EDSMQueries(workers=workers, base_url=base_url)
+            queries.set_rate_limiter(TokenBucket(capacity=1000, rate=1000))
+            if limits is not None:
+                queries.CONCURRENCY = limits
+            start = time.time()
+            for index in range(requests):
+                system = 'System {index}'.format(index=index)
+                queries.request_get(EDSMQueries.API_SYSTEM_V1, 'bodies', systemName=system)
+            queries.start(Root())
+            queries.queue.join()
+            elapsed = time.time() - start
+            queries.stop()
+            queries.session.close()
+            print("{label:<40} {rate:10.1f} requests/s ({replies} replies)".format(
+                label='workers: ' + label,
+                rate=requests / elapsed,
+                replies=len(queries.resultQueue),
+            ))
+    finally:
+        stand_in.stop()
+
+
+def _rss():
+    """Return the resident set size in bytes, `None` when it is not available (only on Linux)."""
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError, AttributeError):
+        return None
+
+
+def benchmark_engines():
+    """Compare the worker pool with the event loop engine with 50 prefetch requests in flight.
+
+    Both get 8 connections and no per endpoint limits. Latency is from queueing a request until a stand-in Tk thread
+    takes it's reply.
+    """
+
+    stand_in = StandInEDSM(template='Sol', latency=fixed_latency(0.05)).start()
+    base_url = stand_in.base_url
+    requests = 50
+    try:
+        engines = (
+            ('8 worker threads', lambda: EDSMQueries(workers=8, base_url=base_url)),
+            ('event loop, 8 connections', lambda: AsyncEDSMQueries(max_connections=8, base_url=base_url)),
+        )
+        # The first round warms up, only the second one is reported.
+        rounds = [(False, engine) for engine in engines] + [(True, engine) for engine in engines]
+        for report, (label, factory) in rounds:
+            queries = factory()
+            queries.set_rate_limiter(TokenBucket(capacity=1000, rate=1000))
+            queries.CONCURRENCY = {}
+            queued = dict()
+            latencies = []
+            events = Queue()
+            handled = []
+
+            class Root(object):  # pylint: disable=too-few-public-methods
+                """Stands in for the Tk root: events are handled by another thread."""
+
+                def event_generate(self, event, **kwargs):  # pylint: disable=no-self-use
+                    """Queue the event."""
+                    events.put(event)
+
+            def tk_loop():
+                """Take the replies for each event, like `_edsm_callback_received`, with 5ms of Tk work per event."""
+                while events.get() is not None:
+                    time.sleep(0.005)
+                    handled.append(True)
+                    for (request, _reply) in queries.get_responses():
+                        latencies.append(time.time() - queued[request[3]['systemName']])
+
+            tk_thread = threading.Thread(target=tk_loop)
+            tk_thread.start()
+            rss = _rss()
+            start = time.time()
+            queries.start(Root())
+            for index in range(requests):
+                system = 'System {index}'.format(index=index)
+                queued[system] = time.time()
+                queries.request_get(EDSMQueries.API_SYSTEM_V1, 'bodies', EDSMQueries.PRIORITY_PREFETCH,
+                                    systemName=system)
+            queries.queue.join()
+            elapsed = time.time() - start
+            threads = len([item for item in threading.enumerate() if item.name.startswith('EDSM Queries')])
+            rss = _rss() - rss if rss is not None else None
+            queries.stop()
+            queries.session.close()
+            events.put(None)
+            tk_thread.join()
+
+            if not report:
+                continue
+            latencies.sort()
+            print("{label:<40} {total:6.2f}s total, latency p50 {p50:.0f}ms p95 {p95:.0f}ms, "
+                  "{threads} threads, {rss} kB rss ({replies} replies in {events} events)".format(
+                      label='engines: ' + label,
+                      total=elapsed,
+                      p50=latencies[len(latencies) // 2] * 1000,
+                      p95=latencies[int(len(latencies) * 0.95)] * 1000,
+                      threads=threads,
+                      rss=rss // 1024 if rss is not None else '?',
+                      replies=len(latencies),
+                      events=len(handled),
+                  ))
+    finally:
+        stand_in.stop()
+
+
+def benchmark_load():
+    """Run both engines against a stand-in EDSM with long tailed latency, faults and a rate limit budget.
+
+    120 bodies requests arrive at 20 per second. 5% of them get a server error and 3% a 429, and the server grants 60
+    requests per 5 seconds. The engines use their default settings, with a token bucket matching the budget like one
+    restored at startup. Latency is from queueing a request until a stand-in Tk thread takes it's reply.
+    """
+
+    requests = 120
+    arrival = 1 / 20.0
+    engines = (
+        ('{workers} worker threads'.format(workers=EDSMQueries.WORKERS), EDSMQueries),
+        ('event loop', AsyncEDSMQueries),
+    )
+    for label, factory in engines:
+        stand_in = StandInEDSM(template='Sol', latency=lognormal_latency(0.05), errors=0.05, throttled=0.03,
+                               rate_limit=(60, 5), seed=3).start()
+        queries = factory(base_url=stand_in.base_url)
+        queries.logLevel = LOG_ERROR - 1  # The faults are expected.
+        queries.set_rate_limiter(TokenBucket(capacity=60, rate=12))
+        queued = dict()
+        latencies = []
+        events = Queue()
+
+        class Root(object):  # pylint: disable=too-few-public-methods
+            """Stands in for the Tk root: events are handled by another thread."""
+
+            def event_generate(self, event, **kwargs):  # pylint: disable=no-self-use
+                """Queue the event."""
+                events.put(event)
+
+        def tk_loop():
+            """Take the replies for each event, like `_edsm_callback_received`."""
+            while events.get() is not None:
+                for (request, _reply) in queries.get_responses():
+                    latencies.append(time.time() - queued[request[3]['systemName']])
+
+        tk_thread = threading.Thread(target=tk_loop)
+        tk_thread.start()
+        try:
+            start = time.time()
+            queries.start(Root())
+            for index in range(requests):
+                system = 'System {index}'.format(index=index)
+                queued[system] = time.time()
+                queries.request_get(EDSMQueries.API_SYSTEM_V1, 'bodies', EDSMQueries.PRIORITY_PREFETCH,
+                                    systemName=system)
+                time.sleep(max(0.0, start + (index + 1) * arrival - time.time()))
+            queries.queue.join()
+            elapsed = time.time() - start
+        finally:
+            queries.stop()
+            queries.session.close()
+            stand_in.stop()
+            events.put(None)
+            tk_thread.join()
+
+        latencies.sort()
+        print("{label:<40} {rate:6.1f} replies/s, latency p50 {p50:.0f}ms p99 {p99:.0f}ms, {replies} replies, "
+              "{retries} retries, {dropped} dropped, {expired} expired; server: {statuses}".format(
+                  label='load: ' + label,
+                  rate=len(latencies) / elapsed,
+                  p50=latencies[len(latencies) // 2] * 1000 if latencies else 0,
+                  p99=latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+                  replies=len(latencies),
+                  retries=queries.counters['retries'],
+                  dropped=queries.counters['dropped'],
+                  expired=queries.counters['expired'],
+                  statuses=', '.join('{count}x {status}'.format(status=status, count=count)
+                                     for status, count in sorted(stand_in.stats.items())),
+              ))
+
+
+def _deep_size(value):
+    """Return the bytes used by a parsed json value, including everything it contains."""
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_size(key) + _deep_size(item) for key, item in value.items())
+    elif isinstance(value, list):
+        size += sum(_deep_size(item) for item in value)
+    return size
+
+
+def _peak_memory(func, *args):
+    """Run `func` in a forked process and return the growth of it's peak resident set size in kB."""
+
+    results = multiprocessing.Queue()
+
+    def measure():
+        """Report the peak memory used by `func`."""
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(*args)
+        results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+    process = multiprocessing.Process(target=measure)
+    process.start()
+    peak = results.get()
+    process.join()
+    return peak
+
+
+def _synthetic_system(reply, count):
+    """Return a bodies reply for a system with `count` bodies, copied from the bodies in `reply`."""
+
+    bodies = []
+    for index in range(count):
+        body = dict(reply['bodies'][index % len(reply['bodies'])])
+        body['name'] = 'Synthetic {index}'.format(index=index)
+        body['id'] = index
+        bodies.append(body)
+    return dict(reply, name='Synthetic', bodyCount=len(bodies), bodies=bodies)
+
+
+def benchmark_pipeline():
+    """Compare the Tk thread work per bodies reply of 500 bodies, without and with the `BodiesMatcher`.
+
+    Drawing is left out, it is the same for both. Without the matcher the Tk thread observes the sketches, applies the
+    body filter and matches all bodies, with it it only scores the matched bodies.
+    """
+
+    reply = _synthetic_system(load_fixture(), 500)
+    filters = [
+        MaterialFilter(Materials.POLONIUM, 1.0, True),
+        MaterialFilter(Materials.YTTRIUM, 1.1, True),
+        MaterialFilter(Materials.ANTIMONY, 1.0, True),
+    ]
+    rules = [parse_rule('ALL(Ge>=4.00;Nb>=1.00)')]
+    predicate = compile_predicate('isLandable == true and gravity < 2')
+    compiled = CompiledFilterSet(filters)
+    rule_set = MaterialRuleSet(rules)
+    scorer = MaterialScorer(compiled)
+
+    def tk_thread():
+        """Do what `edsm_querier_response_api_system_v1_bodies` and the frame did with every reply."""
+        sketches = SketchSet()
+        for body in reply['bodies']:
+            sketches.observe(body.get('materials'), body['name'])
+        bodies = [body for body in reply['bodies'] if predicate.matches(body)]
+        materials = [body.get('materials') or list() for body in bodies]
+        batch = compiled.check_batch(materials)
+        matched = dict((index, batch.matches(index)) for index in batch.matched())
+        for index, body_materials in enumerate(materials):
+            rule_matches = rule_set.check_matches(body_materials)
+            if rule_matches:
+                matched[index] = merge_matches(matched.get(index, []), rule_matches)
+        return [scorer.score(matches) for matches in matched.values()]
+
+    matcher = BodiesMatcher(MatchSnapshot(filters, rules, predicate), SketchSet())
+    system_matches = matcher(None, reply)
+
+    def tk_thread_matched():
+        """Do what is left for the Tk thread with the matcher."""
+        return [scorer.score(matches) for _planet, matches in system_matches.matches]
+
+    def worker():
+        """Run the matcher like the worker does, with new sketches each time."""
+        matcher.sketches = SketchSet()
+        return matcher(None, reply)
+
+    for label, func in (('Tk thread without matcher', tk_thread), ('Tk thread with matcher', tk_thread_matched),
+                        ('worker thread matcher', worker)):
+        number = 20
+        best = min(timeit.repeat(func, number=number, repeat=3))
+        print("{label:<40} {msec:8.3f} msec/reply ({matched} of {bodies} bodies matched)".format(
+            label='pipeline: ' + label,
+            msec=best / number * 1000,
+            matched=len(system_matches.matches),
+            bodies=len(reply['bodies']),
+        ))
+
+
+def benchmark_projection():
+    """Compare `json.loads` with the streaming `BODIES_PROJECTION` on the Sol fixture and on a 500 bodies system.
+
+    The reply is fed in 16kB chunks, like `EDSMQueries` reads it. Peak memory is measured in a forked process and
+    includes holding the reply text, retained is the size of the parsed result.
+    """
+
+    sol = load_fixture()
+    synthetic = _synthetic_system(sol, 500)
+
+    chunk_size = EDSMQueries.CHUNK_SIZE
+    runs = []
+    for system, reply in (('Sol', sol), ('500 bodies', synthetic)):
+        text = json.dumps(reply)
+        chunks = [text[start:start + chunk_size] for start in range(0, len(text), chunk_size)]
+        runs.append((system, len(text), 'json.loads', lambda chunks=chunks: json.loads(''.join(chunks))))
+        runs.append((system, len(text), 'projection', lambda chunks=chunks: BODIES_PROJECTION.parse(chunks)))
+
+    # Peaks first, so the forked processes do not reuse memory freed by the timing runs.
+    peaks = [_peak_memory(parse) for _system, _length, _label, parse in runs]
+    for (system, length, label, parse), peak in zip(runs, peaks):
+        number = 20
+        best = min(timeit.repeat(parse, number=number, repeat=3))
+        print("{label:<40} {msec:8.2f} msec/reply, peak +{peak} kB, retained {size} kB ({kb} kB reply)".format(
+            label='projection: {system} {label}'.format(system=system, label=label),
+            msec=best / number * 1000,
+            peak=peak,
+            size=_deep_size(parse()) // 1024,
+            kb=length // 1024,
+        ))
+
+
+def _cpu_seconds(usage):
+    """Return the user and system cpu time of a `resource.getrusage()` result."""
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def _report(label, func, per, number=200):
+    """Time `func` and print the cost per item."""
+
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    print("{label:<40} {usec:10.2f} usec/item".format(label=label, usec=best / number / per * 1e6))
+
+
+BENCHMARKS = {
+    'batch': benchmark_batch,
+    'cache': benchmark_cache,
+    'engines': benchmark_engines,
+    'filters': benchmark_filters,
+    'load': benchmark_load,
+    'log_writer': benchmark_log_writer,
+    'logging': benchmark_logging,
+    'memory': benchmark_memory,
+    'metrics': benchmark_metrics,
+    'pipeline': benchmark_pipeline,
+    'projection': benchmark_projection,
+    'thresholds': benchmark_thresholds,
+    'workers': benchmark_workers,
+}
+
+
+def main(names):
+    """Run the named benchmarks, or all when none are given."""
+
+    LOGGER.logLevel = LOG_ERROR
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,310 @@
+"""
+Predicates on body attributes, like `gravity < 0.5 and distanceToArrival < 5000`.
+
+An expression is parsed once and compiled into a closure which takes a dict with the
+body's attributes. Attribute names follow the EDSM bodies api, journal scans are
+translated with `body_attributes_from_scan()`.
+
+Grammar:
+
+    expression := term ('or' term)*
+    term       := factor ('and' factor)*
+    factor     := 'not' factor | '(' expression ')' | comparison
+    comparison := attribute ('<' | '<=' | '>' | '>=' | '==' | '!=') value
+    value      := number | 'string' | "string" | true | false
+
+A comparison against an attribute the body does not have is false.
+"""
+
+import operator
+import re
+
+from material_api import FIELD_LANDABLE
+
+
+# Attributes which can be used in expressions.
+ATTRIBUTES = (
+    'atmosphereType',
+    'distanceToArrival',
+    'earthMasses',
+    'gravity',
+    'isLandable',
+    'radius',
+    'subType',
+    'surfaceTemperature',
+    'terraformingState',
+)
+
+# Journal PlanetClass => EDSM subType, where they differ.
+PLANET_CLASSES = {
+    'Metal rich body': 'Metal-rich body',
+    'High metal content body': 'High metal content world',
+    'Rocky ice body': 'Rocky Ice world',
+    'Earthlike body': 'Earth-like world',
+    'Gas giant with water based life': 'Gas giant with water-based life',
+    'Gas giant with ammonia based life': 'Gas giant with ammonia-based life',
+    'Sudarsky class I gas giant': 'Class I gas giant',
+    'Sudarsky class II gas giant': 'Class II gas giant',
+    'Sudarsky class III gas giant': 'Class III gas giant',
+    'Sudarsky class IV gas giant': 'Class IV gas giant',
+    'Sudarsky class V gas giant': 'Class V gas giant',
+    'Helium rich gas giant': 'Helium-rich gas giant',
+}
+
+# Journal TerraformState => EDSM terraformingState, where they differ.
+TERRAFORM_STATES = {
+    '': 'Not terraformable',
+    'Terraformable': 'Candidate for terraforming',
+}
+
+ATMOSPHERE_PREFIXES = ('hot', 'thin', 'thick')
+
+
+def _edsm_atmosphere(value):
+    """Convert a journal Atmosphere, like 'thick methane rich atmosphere', to EDSM's 'Thick Methane-rich'."""
+
+    if not value:
+        return 'No atmosphere'
+    if value.endswith(' atmosphere'):
+        value = value[:-len(' atmosphere')]
+    words = value.replace(' rich', '-rich').replace(' based', '-based').split(' ')
+    # EDSM capitalizes the first word and the gas after hot/thin/thick.
+    index = 0
+    while index < len(words) - 1 and words[index].lower() in ATMOSPHERE_PREFIXES:
+        index += 1
+    words[index] = words[index].capitalize()
+    words[0] = words[0].capitalize()
+    return ' '.join(words)
+
+
+# Journal Scan field: (EDSM attribute, conversion)
+SCAN_ATTRIBUTES = {
+    'Atmosphere': ('atmosphereType', _edsm_atmosphere),
+    'DistanceFromArrivalLS': ('distanceToArrival', None),
+    'MassEM': ('earthMasses', None),
+    'SurfaceGravity': ('gravity', lambda value: value / 9.80665),  # m/s^2 => g
+    FIELD_LANDABLE: ('isLandable', None),
+    'Radius': ('radius', lambda value: value / 1000.0),  # m => km
+    'PlanetClass': ('subType', lambda value: PLANET_CLASSES.get(value, value)),
+    'SurfaceTemperature': ('surfaceTemperature', None),
+    'TerraformState': ('terraformingState', lambda value: TERRAFORM_STATES.get(value, value)),
+}
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+KEYWORDS = {
+    'true': True,
+    'false': False,
+}
+
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|-?\.\d+)
+        |(?P<string>'[^']*'|"[^"]*")
+        |(?P<operator><=|>=|==|!=|<|>)
+        |(?P<paren>[()])
+        |(?P<name>[A-Za-z_]\w*)
+    )""", re.VERBOSE)
+
+
+class BodyPredicateSyntaxError(ValueError):
+    """Raised when an expression can not be parsed."""
+
+
+class BodyPredicate(object):
+    """A compiled predicate on body attributes."""
+
+    def __init__(self, expression):
+        """
+        Parse and compile an expression.
+
+        :param expression: See the module documentation.
+        :raises BodyPredicateSyntaxError: when the expression is invalid.
+        """
+
+        self.expression = expression
+        self.matches = _Parser(expression).build()
+
+    def __str__(self):
+        """Return the expression."""
+
+        return self.expression
+
+
+def compile_predicate(expression):
+    """Compile an expression. Returns `None` for an empty expression."""
+
+    if expression is None or not expression.strip():
+        return None
+    return BodyPredicate(expression.strip())
+
+
+def body_attributes_from_scan(entry):
+    """Translate the fields of a journal Scan event into EDSM body attributes."""
+
+    attributes = dict()
+    for field, (attribute, conversion) in SCAN_ATTRIBUTES.items():
+        value = entry.get(field)
+        if value is None:
+            continue
+        attributes[attribute] = conversion(value) if conversion is not None else value
+    return attributes
+
+
+def _tokenize(expression):
+    """Split an expression into (kind, value) tokens."""
+
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if match is None:
+            raise BodyPredicateSyntaxError("Unexpected '{rest}' in '{expression}'".format(
+                rest=expression[position:].strip(),
+                expression=expression,
+            ))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value)
+        elif kind == 'string':
+            value = value[1:-1]
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent parser producing closures."""
+
+    def __init__(self, expression):
+        """Tokenize the expression."""
+
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def build(self):
+        """Return a function taking a dict with attributes and returning a bool."""
+
+        predicate = self._expression()
+        if self.position != len(self.tokens):
+            self._error("Unexpected '{token}'".format(token=self.tokens[self.position][1]))
+        return predicate
+
+    def _peek(self):
+        """Return the current token or (None, None) at the end."""
+
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def _next(self):
+        """Return the current token and advance."""
+
+        token = self._peek()
+        if token[0] is None:
+            self._error("Unexpected end")
+        self.position += 1
+        return token
+
+    def _keyword(self, keyword):
+        """Consume the keyword if it is the current token."""
+
+        kind, value = self._peek()
+        if kind == 'name' and value.lower() == keyword:
+            self.position += 1
+            return True
+        return False
+
+    def _error(self, message):
+        """Raise a syntax error."""
+
+        raise BodyPredicateSyntaxError("{message} in '{expression}'".format(
+            message=message,
+            expression=self.expression,
+        ))
+
+    def _expression(self):
+        """Parse: expression := term ('or' term)*."""
+
+        predicates = [self._term()]
+        while self._keyword('or'):
+            predicates.append(self._term())
+        if len(predicates) == 1:
+            return predicates[0]
+
+        def any_of(attributes):
+            """Or."""
+            for predicate in predicates:
+                if predicate(attributes):
+                    return True
+            return False
+        return any_of
+
+    def _term(self):
+        """Parse: term := factor ('and' factor)*."""
+
+        predicates = [self._factor()]
+        while self._keyword('and'):
+            predicates.append(self._factor())
+        if len(predicates) == 1:
+            return predicates[0]
+
+        def all_of(attributes):
+            """And."""
+            for predicate in predicates:
+                if not predicate(attributes):
+                    return False
+            return True
+        return all_of
+
+    def _factor(self):
+        """Parse: factor := 'not' factor | '(' expression ')' | comparison."""
+
+        if self._keyword('not'):
+            predicate = self._factor()
+            return lambda attributes: not predicate(attributes)
+
+        if self._peek() == ('paren', '('):
+            self.position += 1
+            predicate = self._expression()
+            if self._next() != ('paren', ')'):
+                self._error("Missing ')'")
+            return predicate
+
+        return self._comparison()
+
+    def _comparison(self):
+        """Parse: comparison := attribute operator value."""
+
+        kind, attribute = self._next()
+        if kind != 'name' or attribute not in ATTRIBUTES:
+            self._error("Unknown attribute '{attribute}'".format(attribute=attribute))
+
+        kind, symbol = self._next()
+        if kind != 'operator':
+            self._error("Expected a comparison after '{attribute}'".format(attribute=attribute))
+        compare = OPERATORS[symbol]
+
+        kind, value = self._next()
+        if kind == 'name':
+            if value.lower() not in KEYWORDS:
+                self._error("Unexpected '{value}'".format(value=value))
+            value = KEYWORDS[value.lower()]
+        elif kind not in ('number', 'string'):
+            self._error("Expected a value after '{operator}'".format(operator=symbol))
+
+        def comparison(attributes):
+            """Compare an attribute with the value."""
+            current = attributes.get(attribute)
+            return current is not None and compare(current, value)
+        return comparison
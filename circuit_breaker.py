@@ -0,0 +1,90 @@
+"""
+Circuit breaker for calls to a remote service.
+
+After `failure_threshold` consecutive failures the breaker opens and calls are
+refused without trying. Once `reset_timeout` seconds have passed, a single probe
+is let through (half-open): when it succeeds the breaker closes again, when it
+fails the breaker opens for another `reset_timeout`. A probe which ends without
+an outcome, because it expired or was interrupted, has to be released with
+`release_probe()`.
+"""
+
+import time
+from threading import Lock
+
+
+class CircuitBreaker(object):
+    """A closed/open/half-open circuit breaker."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=60.0, clock=time.time):
+        """Create a closed breaker.
+
+        :param failure_threshold: Number of consecutive failures that open the breaker.
+        :param reset_timeout: Seconds the breaker stays open before a probe is allowed.
+        :param clock: Function returning the current time in seconds.
+        """
+
+        self.failureThreshold = failure_threshold
+        self.resetTimeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.trips = 0
+        self.lock = Lock()
+        self.logPrefix = 'CircuitBreaker > '
+
+    def is_open(self):
+        """Check if calls are refused right now, without claiming the half-open probe."""
+
+        with self.lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN:
+                return self.clock() - self.openedAt < self.resetTimeout
+            return True  # Half-open: the probe is on it's way.
+
+    def allow(self):
+        """Check if a call may be made. When the reset timeout has passed, the caller becomes the probe."""
+
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.openedAt >= self.resetTimeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        """Close the breaker."""
+
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.openedAt = None
+
+    def record_failure(self):
+        """Count a failure, opening the breaker when there are too many or the probe failed."""
+
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failureThreshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.openedAt = self.clock()
+
+    def release_probe(self):
+        """Open the breaker for another `reset_timeout` when it is half-open: the probe ended without an outcome.
+
+        Call it after every call that was allowed. It does nothing when the outcome was recorded.
+        """
+
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.openedAt = self.clock()
@@ -0,0 +1,768 @@
+"""
+Event loop engine for EDSM queries.
+
+`AsyncEDSMQueries` offers the `EDSMQueries` interface, but instead of a pool of
+worker threads blocking on one request each, a single thread runs a select()
+loop over non-blocking HTTP/1.1 keep-alive connections. Many outstanding
+requests then cost a few sockets instead of a thread each.
+
+EDMC runs on Python 2.7, which has no asyncio, so the loop is written against
+select, ssl and socket directly. Queueing, caching, coalescing, rate limiting,
+the circuit breaker and the ordered delivery are shared with `EDSMQueries`.
+"""
+
+import errno
+import heapq
+import itertools
+import json
+import select
+import socket
+import ssl
+import time
+import zlib
+from collections import deque
+from Queue import Empty
+from threading import Thread
+from urllib import urlencode
+from urlparse import urlsplit
+
+from requests.structures import CaseInsensitiveDict
+
+from edsm_queries import EDSMQueries, NOT_MODIFIED
+from material_api import LOGGER, LOG_INFO
+
+# connect_ex() results meaning "in progress", WSAEWOULDBLOCK is Windows' one.
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035)
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, 10035)
+
+
+class ProtocolError(IOError):
+    """Raised when the server sends something we do not understand or closes the connection early."""
+
+
+class Response(object):  # pylint: disable=too-few-public-methods
+    """A complete HTTP response."""
+
+    def __init__(self, status_code, headers, content, keep_alive, received=None):
+        """Create a new `Response`.
+
+        :param received: Number of body bytes received, before decompression.
+        """
+
+        self.status_code = status_code  # pylint: disable=invalid-name
+        self.headers = headers
+        self.content = content
+        self.keepAlive = keep_alive
+        self.received = len(content) if received is None else received
+
+
+class ResponseParser(object):
+    """Incremental HTTP/1.1 response parser: Content-Length, chunked and close delimited bodies."""
+
+    def __init__(self):
+        """Create a parser waiting for the status line."""
+
+        self.buffer = b''
+        self.state = 'head'
+        self.status = None
+        self.headers = None
+        self.version = None
+        self.remaining = None
+        self.chunks = []
+
+    def feed(self, data):
+        """Add received data.
+
+        :return: The `Response` once it is complete, otherwise `None`.
+        :raises ProtocolError: on a malformed response.
+        """
+
+        self.buffer += data
+        while True:
+            if self.state == 'head':
+                end = self.buffer.find(b'\r\n\r\n')
+                if end < 0:
+                    return None
+                self._parse_head(self.buffer[:end])
+                self.buffer = self.buffer[end + 4:]
+            elif self.state == 'length':
+                take = min(self.remaining, len(self.buffer))
+                self.chunks.append(self.buffer[:take])
+                self.buffer = self.buffer[take:]
+                self.remaining -= take
+                if self.remaining:
+                    return None
+                return self._response()
+            elif self.state == 'chunk-size':
+                end = self.buffer.find(b'\r\n')
+                if end < 0:
+                    return None
+                try:
+                    self.remaining = int(self.buffer[:end].split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise ProtocolError("Invalid chunk size")
+                self.buffer = self.buffer[end + 2:]
+                self.state = 'chunk' if self.remaining else 'trailer'
+            elif self.state == 'chunk':
+                if len(self.buffer) < self.remaining + 2:
+                    return None
+                self.chunks.append(self.buffer[:self.remaining])
+                self.buffer = self.buffer[self.remaining + 2:]
+                self.state = 'chunk-size'
+            elif self.state == 'trailer':
+                end = self.buffer.find(b'\r\n')
+                if end < 0:
+                    return None
+                line = self.buffer[:end]
+                self.buffer = self.buffer[end + 2:]
+                if not line:
+                    return self._response()
+            else:  # close delimited
+                self.chunks.append(self.buffer)
+                self.buffer = b''
+                return None
+
+    def eof(self):
+        """Handle the server closing the connection.
+
+        :return: The `Response` for close delimited bodies.
+        :raises ProtocolError: when the response is incomplete.
+        """
+
+        if self.state == 'close':
+            return self._response(keep_alive=False)
+        raise ProtocolError("Connection closed before the response was complete")
+
+    def _parse_head(self, head):
+        """Parse the status line and headers, and decide how the body is delimited."""
+
+        lines = head.split(b'\r\n')
+        parts = lines[0].split(b' ', 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+            raise ProtocolError("Invalid status line: {line!r}".format(line=lines[0]))
+        self.version = parts[0]
+        try:
+            self.status = int(parts[1])
+        except ValueError:
+            raise ProtocolError("Invalid status: {status!r}".format(status=parts[1]))
+
+        self.headers = CaseInsensitiveDict()
+        for line in lines[1:]:
+            if b':' in line:
+                (name, value) = line.split(b':', 1)
+                self.headers[name.strip()] = value.strip()
+
+        if self.status in (204, 304) or 100 <= self.status < 200:
+            self.state = 'length'
+            self.remaining = 0
+        elif self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            self.state = 'chunk-size'
+        elif 'Content-Length' in self.headers:
+            self.state = 'length'
+            try:
+                self.remaining = int(self.headers['Content-Length'])
+            except ValueError:
+                raise ProtocolError("Invalid Content-Length")
+        else:
+            self.state = 'close'
+
+    def _response(self, keep_alive=True):
+        """Build the response and get ready for the next one."""
+
+        content = b''.join(self.chunks)
+        received = len(content)
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            try:
+                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            except zlib.error as err:
+                raise ProtocolError("Invalid gzip body: {err}".format(err=err))
+
+        connection = self.headers.get('Connection', '').lower()
+        if connection == 'close' or (self.version == b'HTTP/1.0' and connection != 'keep-alive'):
+            keep_alive = False
+        response = Response(self.status, self.headers, content, keep_alive, received)
+        self.state = 'head'
+        self.chunks = []
+        return response
+
+
+class Connection(object):
+    """A non-blocking (TLS) connection carrying one request at a time."""
+
+    def __init__(self, address, host, use_ssl):
+        """Start connecting.
+
+        :param address: getaddrinfo() result to connect to.
+        :param host: Host name, for SNI and certificate checks.
+        :param use_ssl: Use TLS.
+        """
+
+        (family, socktype, proto, _name, sockaddr) = address
+        self.host = host
+        self.useSsl = use_ssl
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.connected = False
+        self.handshaking = False
+        self.wantWrite = True
+        self.out = b''
+        self.parser = ResponseParser()
+        self.job = None
+        self.deadline = None
+        self.served = 0
+        self.received = False
+
+        result = self.sock.connect_ex(sockaddr)
+        if result not in (0,) + CONNECT_IN_PROGRESS:
+            self.sock.close()
+            raise socket.error(result, "Unable to connect")
+
+    def fileno(self):
+        """Return the socket's file descriptor, for select()."""
+
+        return self.sock.fileno()
+
+    def wants_write(self):
+        """Check if we are waiting for the socket to become writable."""
+
+        return not self.connected or (self.handshaking and self.wantWrite) or bool(self.out)
+
+    def start(self, job, data, deadline):
+        """Send a request."""
+
+        self.job = job
+        self.out = data
+        self.deadline = deadline
+        self.received = False
+        if self.connected and not self.handshaking:
+            self._flush()
+
+    def on_writable(self):
+        """Finish connecting or send more of the request."""
+
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, "Unable to connect")
+            self.connected = True
+            if self.useSsl:
+                context = ssl.create_default_context()
+                self.sock = context.wrap_socket(self.sock, server_hostname=self.host, do_handshake_on_connect=False)
+                self.handshaking = True
+
+        if self.handshaking:
+            self._handshake()
+        if not self.handshaking:
+            self._flush()
+
+    def on_readable(self):
+        """Read what is available.
+
+        :return: The `Response` when it is complete, otherwise `None`.
+        :raises socket.error, ssl.SSLError, ProtocolError: when the connection failed.
+        """
+
+        if not self.connected:
+            return None  # A failed connect is reported when the socket becomes writable.
+        if self.handshaking:
+            self._handshake()
+            if self.handshaking:
+                return None
+            self._flush()
+
+        response = None
+        while response is None:
+            try:
+                data = self.sock.recv(65536)
+            except ssl.SSLWantReadError:
+                break
+            except ssl.SSLWantWriteError:
+                break
+            except socket.error as err:
+                if err.args[0] in WOULD_BLOCK:
+                    break
+                raise
+            if not data:
+                if self.job is None:
+                    raise ProtocolError("Connection closed")
+                return self.parser.eof()
+            self.received = True
+            if self.job is None:
+                raise ProtocolError("Unexpected data on an idle connection")
+            response = self.parser.feed(data)
+        return response
+
+    def close(self):
+        """Close the socket."""
+
+        try:
+            self.sock.close()
+        except (socket.error, ssl.SSLError):
+            pass
+
+    def _handshake(self):
+        """Continue the TLS handshake."""
+
+        try:
+            self.sock.do_handshake()
+            self.handshaking = False
+        except ssl.SSLWantReadError:
+            self.wantWrite = False
+        except ssl.SSLWantWriteError:
+            self.wantWrite = True
+
+    def _flush(self):
+        """Send as much of the request as the socket takes."""
+
+        while self.out:
+            try:
+                sent = self.sock.send(self.out)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except socket.error as err:
+                if err.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            self.out = self.out[sent:]
+
+
+class Job(object):  # pylint: disable=too-few-public-methods
+    """A request taken from the queue, the number of attempts made and the validators of it's cached reply."""
+
+    __slots__ = ('request', 'attempt', 'limits', 'validators', 'deadline', 'sent', 'generation')
+
+    def __init__(self, request, validators=None, deadline=None, generation=None):
+        """Create a new `Job`.
+
+        :param deadline: Time by which the request has to be done.
+        :param generation: The `generation` of the queries when the job was taken from the queue.
+        """
+
+        self.request = request
+        self.generation = generation
+        self.attempt = 0
+        self.limits = ()
+        self.validators = validators or {}
+        self.deadline = deadline
+        self.sent = None
+
+
+class AsyncEDSMQueries(EDSMQueries):
+    """`EDSMQueries` running all requests from a single event loop thread."""
+
+    MAX_CONNECTIONS = 8
+    # Longest select() wait, keeps the loop responsive to `stop()` even if waking it fails.
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, max_connections=None, base_url=None):
+        """Initialize `AsyncEDSMQueries`.
+
+        :param max_connections: Maximum number of connections (and requests in flight).
+        :param base_url: Override `API_BASE_URL`, for example to use a stand-in server.
+        """
+
+        EDSMQueries.__init__(self, workers=1, base_url=base_url)
+        self.logPrefix = 'AsyncEDSMQueries > '
+        self.maxConnections = max_connections or self.MAX_CONNECTIONS
+        self.thread = None
+        self.running = False
+        self.connections = []
+        self.idle = deque()
+        self.ready = deque()
+        self.timers = []
+        self.timerSequence = itertools.count()
+        self.active = 0
+        self.inFlight = dict()
+        self.address = None
+        self.wakeReader = None
+        self.wakeWriter = None
+
+    def start(self, callback_root):
+        """Start the event loop thread."""
+
+        self.callbackRoot = callback_root
+        if self.thread is not None and self.thread.isAlive():
+            LOGGER.debug(self, "Thread already started.")
+            return
+
+        self.interruptEvent.clear()
+        (self.wakeReader, self.wakeWriter) = _socket_pair()
+        self.running = True
+        self.thread = Thread(target=self.loop, args=(self.generation,), name='EDSM Queries event loop')
+        self.thread.daemon = True
+        self.thread.start()
+        LOGGER.log(self, LOG_INFO, "Started event loop.")
+
+    def stop(self, timeout=None):
+        """Drop the queued requests and stop the event loop, which closes the connections of requests in flight.
+
+        When the loop does not stop within `timeout` seconds (default `STOP_TIMEOUT`) it is abandoned.
+        """
+
+        started = time.time()
+        timeout = self.STOP_TIMEOUT if timeout is None else timeout
+        self.generation += 1
+        self.queue.clear()
+        self._stop_processor()
+        with self.pendingLock:
+            self.pending.clear()
+            self.queuedAt.clear()
+            self.revalidating.clear()
+            self.sequences.clear()
+        self.running = False
+        self.interruptEvent.set()
+        self._wake()
+        self.abandonedWorkers = 0
+        if self.thread is not None:
+            self.thread.join(max(started + timeout - time.time(), 0.0))
+            if self.thread.isAlive():
+                self.abandonedWorkers = 1
+            else:
+                for sock in (self.wakeReader, self.wakeWriter):
+                    if sock is not None:
+                        sock.close()
+            self.thread = None
+        self.wakeReader = self.wakeWriter = None
+        self.delivery.clear()
+        self.shutdownSeconds = time.time() - started
+        LOGGER.log(self, LOG_INFO, "Stopped event loop in {seconds:.2f}s ({abandoned} abandoned).",
+                   seconds=self.shutdownSeconds, abandoned=self.abandonedWorkers)
+
+    def _request(self, api, endpoint, method, priority=EDSMQueries.PRIORITY_CURRENT, **request_params):
+        """Queue the request and wake up the loop."""
+
+        EDSMQueries._request(self, api, endpoint, method, priority, **request_params)
+        self._wake()
+
+    def _wake(self):
+        """Interrupt the select() call of the loop."""
+
+        if self.wakeWriter is not None:
+            try:
+                self.wakeWriter.send(b'.')
+            except socket.error:
+                pass
+
+    def loop(self, generation=None):
+        """Run the event loop until `stop()`.
+
+        :param generation: The `generation` the loop was started in. When `stop()` gave up on the loop, it exits
+            as soon as it gets the chance, even when a new loop has been started since.
+        """
+
+        while self.running and (generation is None or generation == self.generation):
+            self._start_requests()
+            readers = [self.wakeReader] + self.connections
+            writers = [connection for connection in self.connections if connection.wants_write()]
+            try:
+                (readable, writable, _errors) = select.select(readers, writers, [], self._timeout())
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.wakeReader in readable:
+                readable.remove(self.wakeReader)
+                try:
+                    self.wakeReader.recv(4096)
+                except socket.error:
+                    pass
+            for connection in writable:
+                self._handle(connection, connection.on_writable)
+            for connection in readable:
+                if connection in self.connections:
+                    self._handle(connection, connection.on_readable)
+            self._run_timers()
+            self._check_deadlines()
+
+        for connection in list(self.connections):
+            self._close(connection)
+        # Requests in flight, a probe among them, are dropped without an outcome.
+        self.circuitBreaker.release_probe()
+
+    def _timeout(self):
+        """Return how long select() may wait."""
+
+        now = time.time()
+        timeout = self.POLL_INTERVAL
+        if self.timers:
+            timeout = min(timeout, self.timers[0][0] - now)
+        for connection in self.connections:
+            if connection.deadline is not None:
+                timeout = min(timeout, connection.deadline - now)
+        return max(timeout, 0.0)
+
+    def _schedule(self, delay, callback, *args):
+        """Call callback(*args) from the loop after delay seconds."""
+
+        heapq.heappush(self.timers, (time.time() + delay, next(self.timerSequence), callback, args))
+
+    def _run_timers(self):
+        """Run the timers that are due."""
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            (_when, _sequence, callback, args) = heapq.heappop(self.timers)
+            callback(*args)
+
+    def _check_deadlines(self):
+        """Fail the requests that take longer than `API_TIMEOUT`."""
+
+        now = time.time()
+        for connection in list(self.connections):
+            if connection.deadline is not None and connection.deadline <= now:
+                self._on_error(connection, socket.timeout("Timed out after {timeout}s".format(
+                    timeout=self.API_TIMEOUT,
+                )))
+
+    def _start_requests(self):
+        """Take requests from the queue while there is room and send the ones that may go."""
+
+        while self.active < self.maxConnections:
+            try:
+                request = self.queue.get_nowait()
+            except Empty:
+                break
+            if request is None:
+                self.queue.task_done()
+                continue
+
+            self._dequeued(request)
+            self.active += 1
+            if self.circuitBreaker.allow():
+                self._attempt(Job(request, self._validators(request), time.time() + self.DEADLINE, self.generation))
+            else:
+                self._done(Job(request, generation=self.generation), self._fail_fast(request), cached=True)
+
+        for _index in range(len(self.ready)):
+            job = self.ready.popleft()
+            if not self._acquire(job):
+                self.ready.append(job)
+                continue
+            try:
+                connection = self._connection()
+            except socket.error as err:
+                LOGGER.error(self, "HTTP Connection error: {err}", err=err)
+                self._release(job)
+                self._retry(job, None)
+                continue
+            if connection is None:
+                self._release(job)
+                self.ready.appendleft(job)
+                break
+            deadline = time.time() + self.API_TIMEOUT
+            if job.deadline is not None:
+                deadline = min(deadline, job.deadline)
+            job.sent = time.time()
+            connection.start(job, self._request_data(job.request, job.validators), deadline)
+
+    def _attempt(self, job):
+        """Get a rate limit token and queue the job to be sent."""
+
+        wait = self.rateLimiter.reserve()
+        if job.deadline is not None and wait >= job.deadline - time.time():
+            self._done(job, self._expired(job.request))
+        elif wait > 0:
+            LOGGER.debug(self, "Rate limited, waiting {wait:.1f}s", wait=wait)
+            self._schedule(wait, self.ready.append, job)
+        else:
+            self.ready.append(job)
+
+    def _acquire(self, job):
+        """Take a slot in the per api and endpoint concurrency limits, `False` when they are full."""
+
+        (api, endpoint) = job.request[:2]
+        limits = [key for key in (api, (api, endpoint)) if key in self.CONCURRENCY]
+        for key in limits:
+            if self.inFlight.get(key, 0) >= self.CONCURRENCY[key]:
+                return False
+        for key in limits:
+            self.inFlight[key] = self.inFlight.get(key, 0) + 1
+        job.limits = limits
+        return True
+
+    def _release(self, job):
+        """Give back the concurrency slots of a job."""
+
+        for key in job.limits:
+            self.inFlight[key] -= 1
+        job.limits = ()
+
+    def _connection(self):
+        """Return an idle connection, a new one or `None` when all connections are busy."""
+
+        while self.idle:
+            connection = self.idle.popleft()
+            if connection in self.connections:
+                return connection
+        if len(self.connections) >= self.maxConnections:
+            return None
+
+        url = urlsplit(self.API_BASE_URL)
+        use_ssl = url.scheme == 'https'
+        if self.address is None:
+            # Resolving blocks, but only once.
+            self.address = socket.getaddrinfo(url.hostname, url.port or (443 if use_ssl else 80), 0,
+                                              socket.SOCK_STREAM)[0]
+        connection = Connection(self.address, url.hostname, use_ssl)
+        self.connections.append(connection)
+        return connection
+
+    def _request_data(self, request, validators=None):
+        """Return the bytes to send for a request, conditional when there are validators of a cached reply."""
+
+        (api, endpoint, method, request_params) = request
+        url = urlsplit(self._url(api, endpoint))
+        query = urlencode(sorted(
+            (name, value.encode('utf-8') if isinstance(value, unicode) else value)
+            for name, value in request_params.items()
+        ))
+        headers = [
+            ('Host', url.netloc),
+            ('User-Agent', self.session.headers['User-Agent']),
+            ('Accept', 'application/json'),
+            ('Accept-Encoding', 'gzip'),
+            ('Connection', 'keep-alive'),
+        ]
+        if method == 'GET':
+            target = url.path + ('?' + query if query else '')
+            body = b''
+            headers.extend(sorted(self.conditional_headers(validators or {}).items()))
+        else:
+            target = url.path
+            body = query
+            headers.append(('Content-Type', 'application/x-www-form-urlencoded'))
+            headers.append(('Content-Length', str(len(body))))
+
+        lines = ["{method} {target} HTTP/1.1".format(method=method, target=target)]
+        lines.extend("{name}: {value}".format(name=name, value=value) for name, value in headers)
+        return "\r\n".join(lines) + "\r\n\r\n" + body
+
+    def _handle(self, connection, handler):
+        """Call a connection's handler and process the response or error."""
+
+        try:
+            response = handler()
+        except (socket.error, ssl.SSLError, ProtocolError) as err:
+            self._on_error(connection, err)
+            return
+        if response is not None:
+            self._on_response(connection, response)
+
+    def _on_response(self, connection, response):
+        """Handle a complete response."""
+
+        job = connection.job
+        connection.job = None
+        connection.deadline = None
+        connection.served += 1
+        if response.keepAlive:
+            self.idle.append(connection)
+        else:
+            self._close(connection)
+        self._release(job)
+
+        self.rateLimiter.update(response.headers)
+        (api, endpoint) = job.request[:2]
+        self.metrics.observe('http', time.time() - job.sent, api, endpoint)
+        status = response.status_code
+        if status == 304:
+            job.validators.update(self.response_validators(response.headers))
+            self.circuitBreaker.record_success()
+            self._done(job, NOT_MODIFIED)
+        elif 200 <= status < 300:
+            self._count_bytes(api, endpoint, response.received, len(response.content))
+            job.validators = self.response_validators(response.headers)
+            parsing = time.time()
+            try:
+                projection = self.projections.get((api, endpoint))
+                if projection is not None:
+                    # The body is already complete here, but only the projected records are kept.
+                    reply = projection.parse([response.content])
+                else:
+                    reply = json.loads(response.content)
+            except ValueError as err:
+                LOGGER.error(self, "Invalid reply for {api}/{endpoint}: {err}", api=api, endpoint=endpoint, err=err)
+                self._retry(job, None)
+                return
+            self.metrics.observe('parse', time.time() - parsing, api, endpoint)
+            self.circuitBreaker.record_success()
+            self._done(job, reply)
+        elif 400 <= status < 500 and status != 429:
+            LOGGER.error(self, "HTTP error occured: {status} for {api}/{endpoint}", status=status, api=api,
+                         endpoint=endpoint)
+            self.circuitBreaker.record_success()
+            self._done(job, None)
+        else:
+            LOGGER.error(self, "HTTP error occured: {status} for {api}/{endpoint}", status=status, api=api,
+                         endpoint=endpoint)
+            self._retry(job, self._retry_after(response))
+
+    def _on_error(self, connection, err):
+        """Handle a failed connection."""
+
+        job = connection.job
+        reused = connection.served > 0 and not connection.received
+        self._close(connection)
+        if job is None:
+            return
+        self._release(job)
+        if reused:
+            # The server closed the idle connection before it saw our request: just send it again.
+            self.ready.appendleft(job)
+            return
+        LOGGER.error(self, "HTTP Connection error: {err}", err=err)
+        self._retry(job, None)
+
+    def _retry(self, job, retry_after):
+        """Schedule another attempt, or give up after `MAX_ATTEMPTS`."""
+
+        job.attempt += 1
+        if job.attempt >= self.MAX_ATTEMPTS:
+            self.circuitBreaker.record_failure()
+            self._done(job, None)
+            return
+        wait = retry_after if retry_after is not None else self._backoff(job.attempt)
+        if job.deadline is not None and wait >= job.deadline - time.time():
+            self._done(job, self._expired(job.request))
+            return
+        with self.pendingLock:
+            self.counters['retries'] += 1
+        self.metrics.count('retries', api=job.request[0], endpoint=job.request[1])
+        self._schedule(wait, self._attempt, job)
+
+    def _done(self, job, reply, cached=False):
+        """Finish a job. The reply of a job from before `stop()` is dropped: the cache may be closed by now."""
+
+        self.active -= 1
+        if not cached:
+            # A probe that expired or was interrupted has no outcome, it must not keep the breaker half-open.
+            self.circuitBreaker.release_probe()
+        if job.generation is not None and job.generation != self.generation:
+            LOGGER.debug(self, "Dropped the reply for {api}/{endpoint} after stop", api=job.request[0],
+                         endpoint=job.request[1])
+            return
+        self._complete(job.request, reply, cached, job.validators)
+        self.queue.task_done()
+
+    def _close(self, connection):
+        """Close and forget a connection."""
+
+        connection.close()
+        if connection in self.connections:
+            self.connections.remove(connection)
+
+
+def _socket_pair():
+    """Return a pair of connected sockets. socket.socketpair() is not available on Windows with Python 2."""
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        (reader, _address) = listener.accept()
+    finally:
+        listener.close()
+    reader.setblocking(0)
+    return reader, writer
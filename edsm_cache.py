@@ -0,0 +1,216 @@
+"""
+Persistent cache for EDSM replies.
+
+Replies are stored in a SQLite database keyed on (api, endpoint, normalized params).
+Each endpoint has it's own time to live. Entries older than that are still served,
+but flagged as stale so the caller can revalidate them in the background. The
+ETag and Last-Modified validators of a reply are kept with it, so revalidating an
+unchanged reply only costs a 304 Not Modified. The number of entries is bounded:
+the least recently used entries are evicted first. A hit does not write to the
+database, it's access time is kept in memory until the next `put()` or `close()`.
+
+The cache is used from both the Tk thread and the EDSM worker, access is serialized
+with a lock.
+"""
+
+import json
+import sqlite3
+import time
+from threading import Lock
+
+from material_api import LOGGER
+
+
+class EDSMCache(object):
+    """SQLite backed cache for EDSM replies."""
+
+    DEFAULT_TTL = 60 * 60
+    # (api, endpoint): seconds a reply is fresh.
+    TTLS = {
+        ('api-system-v1', 'bodies'): 24 * 60 * 60,
+        ('api-status-v1', 'elite-server'): 60,
+    }
+    MAX_ENTRIES = 2000
+
+    def __init__(self, filename=':memory:', max_entries=None, ttls=None):
+        """Open (and create) the cache.
+
+        :param filename: SQLite database file.
+        :param max_entries: Maximum number of replies kept.
+        :param ttls: dict with (api, endpoint): seconds, overriding `TTLS`.
+        """
+
+        self.filename = filename
+        self.maxEntries = max_entries or self.MAX_ENTRIES
+        self.ttls = dict(self.TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.logLevel = None
+        self.logPrefix = 'EDSMCache > '
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        # key => time of the last hit, not written to the database yet.
+        self.accessed = dict()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS replies ("
+                " key TEXT PRIMARY KEY,"
+                " stored REAL NOT NULL,"
+                " accessed REAL NOT NULL,"
+                " reply TEXT NOT NULL)",
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS replies_accessed ON replies (accessed)")
+            # Caches created before validators were stored lack these columns.
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(replies)")]
+            for column in ('etag', 'modified'):
+                if column not in columns:
+                    self.connection.execute("ALTER TABLE replies ADD COLUMN {column} TEXT".format(column=column))
+
+    @staticmethod
+    def key(api, endpoint, params):
+        """Return the cache key for a request.
+
+        Parameter order, surrounding whitespace and the case of values do not matter:
+        EDSM treats system names case insensitive.
+        """
+
+        normalized = dict()
+        for name, value in (params or {}).items():
+            if isinstance(value, basestring):
+                value = value.strip().lower()
+            normalized[name] = value
+        return json.dumps([api, endpoint, normalized], sort_keys=True, separators=(',', ':'))
+
+    def ttl(self, api, endpoint):
+        """Return the number of seconds a reply for an endpoint is fresh."""
+
+        return self.ttls.get((api, endpoint), self.DEFAULT_TTL)
+
+    def get(self, api, endpoint, params):
+        """Look up a reply.
+
+        :return: tuple (reply, fresh) or `None` when the request is not cached.
+        """
+
+        key = self.key(api, endpoint, params)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT stored, reply FROM replies WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Writing here would commit, and wait for the disk, on the Tk thread.
+            self.accessed[key] = now
+
+        (stored, reply) = row
+        fresh = now - stored < self.ttl(api, endpoint)
+        LOGGER.debug(self, "Hit for {key} (fresh: {fresh})", key=key, fresh=fresh)
+        return json.loads(reply), fresh
+
+    def validators(self, api, endpoint, params):
+        """Return the validators of a cached reply.
+
+        :return: dict with the 'etag' and/or 'modified' the reply was sent with, empty when there are none.
+        """
+
+        key = self.key(api, endpoint, params)
+        with self.lock:
+            row = self.connection.execute("SELECT etag, modified FROM replies WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return dict()
+        return dict((name, value) for name, value in zip(('etag', 'modified'), row) if value)
+
+    def put(self, api, endpoint, params, reply, validators=None):
+        """Store a reply and evict the least recently used replies beyond `maxEntries`.
+
+        :param validators: dict with the 'etag' and 'modified' the reply was sent with.
+        :return: `True` when the reply is new or differs from the cached one.
+        """
+
+        key = self.key(api, endpoint, params)
+        data = json.dumps(reply, sort_keys=True, separators=(',', ':'))
+        validators = validators or {}
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT reply FROM replies WHERE key = ?", (key,)).fetchone()
+            with self.connection:
+                # The access times decide what is evicted.
+                self._write_accessed()
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO replies (key, stored, accessed, reply, etag, modified)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, now, now, data, validators.get('etag'), validators.get('modified')),
+                )
+                self.connection.execute(
+                    "DELETE FROM replies WHERE key IN"
+                    " (SELECT key FROM replies ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.maxEntries,),
+                )
+        LOGGER.debug(self, "Stored {key}", key=key)
+        return row is None or row[0] != data
+
+    def _write_accessed(self):
+        """Write the access times of the hits since the last write. Called with the lock held, in a transaction."""
+
+        if self.accessed:
+            self.connection.executemany("UPDATE replies SET accessed = ? WHERE key = ?",
+                                        [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed.clear()
+
+    def revalidate(self, api, endpoint, params, validators=None):
+        """Mark a cached reply fresh again, after EDSM confirmed it did not change.
+
+        :param validators: Validators sent with the confirmation, replacing the stored ones.
+        :return: `False` when the reply is no longer cached.
+        """
+
+        key = self.key(api, endpoint, params)
+        validators = validators or {}
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                cursor = self.connection.execute(
+                    "UPDATE replies SET stored = ?, accessed = ?, etag = COALESCE(?, etag),"
+                    " modified = COALESCE(?, modified) WHERE key = ?",
+                    (now, now, validators.get('etag'), validators.get('modified'), key),
+                )
+        LOGGER.debug(self, "Revalidated {key}", key=key)
+        return cursor.rowcount > 0
+
+    def __len__(self):
+        """Return the number of cached replies."""
+
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM replies").fetchone()[0]
+
+    def clear(self):
+        """Remove all cached replies."""
+
+        with self.lock:
+            self.accessed.clear()
+            with self.connection:
+                self.connection.execute("DELETE FROM replies")
+
+    def close(self):
+        """Write the access times of the last hits and close the database."""
+
+        with self.lock:
+            try:
+                with self.connection:
+                    self._write_accessed()
+            except sqlite3.Error as err:
+                LOGGER.error(self, "Unable to write the access times: {err}", err=err)
+            self.connection.close()
+
+
+def open_cache(filename, **kwargs):
+    """Open a cache, falling back to an in-memory cache when the file can not be used."""
+
+    try:
+        return EDSMCache(filename, **kwargs)
+    except sqlite3.Error as err:
+        LOGGER.error(None, "Unable to open the EDSM cache {filename}: {err}", filename=filename, err=err)
+        return EDSMCache(':memory:', **kwargs)
@@ -0,0 +1,209 @@
+"""
+Request metrics for the EDSM client.
+
+`EDSMMetrics` keeps counters and latency histograms per api and endpoint, and
+a few for the client as a whole. Histograms have fixed buckets, so recording a
+value is a bisect and an increment, and the memory used does not grow.
+
+`snapshot()` returns everything as a json serializable dict. A `MetricsDump`
+writes a snapshot to a file every so often.
+
+This module does not depend on EDMC.
+"""
+
+import bisect
+import json
+import os
+import time
+from threading import Event, Lock, Thread
+
+# Upper bounds of the histogram buckets, in seconds. Slower values go into an overflow bucket.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+
+
+class Histogram(object):
+    """Counts values in fixed buckets."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=BUCKETS):
+        """Create an empty `Histogram`.
+
+        :param bounds: Sorted upper bounds of the buckets.
+        """
+
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Count a value."""
+
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """Estimate a quantile: the upper bound of the bucket it falls in, `max` for the overflow bucket."""
+
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        """Return a json serializable representation."""
+
+        buckets = [[bound, count] for bound, count in zip(self.bounds, self.counts)]
+        buckets.append(['+Inf', self.counts[-1]])
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+
+class EDSMMetrics(object):
+    """Counters, gauges and histograms for the EDSM client, per api and endpoint."""
+
+    def __init__(self, clock=time.time):
+        """Create empty `EDSMMetrics`.
+
+        :param clock: Function returning the current time in seconds.
+        """
+
+        self.clock = clock
+        self.started = clock()
+        self.lock = Lock()
+        # (api, endpoint) => name => value. (None, None) holds the ones for the client as a whole.
+        self.counters = dict()
+        self.histograms = dict()
+        # name => [value, maximum]
+        self.gauges = dict()
+
+    def count(self, name, amount=1, api=None, endpoint=None):
+        """Add to a counter."""
+
+        with self.lock:
+            counters = self.counters.setdefault((api, endpoint), dict())
+            counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, seconds, api=None, endpoint=None):
+        """Add a duration to a histogram."""
+
+        with self.lock:
+            histograms = self.histograms.setdefault((api, endpoint), dict())
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, value):
+        """Set a gauge. It's maximum is kept as well."""
+
+        with self.lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                self.gauges[name] = [value, value]
+            else:
+                gauge[0] = value
+                gauge[1] = max(gauge[1], value)
+
+    def snapshot(self):
+        """Return all metrics as a json serializable dict.
+
+        The ones for the client as a whole are at the top level, the others under 'endpoints', by 'api/endpoint'.
+        """
+
+        now = self.clock()
+        with self.lock:
+            snapshot = {
+                'time': now,
+                'uptime': now - self.started,
+                'gauges': dict((name, {'value': value, 'max': maximum})
+                               for name, (value, maximum) in self.gauges.items()),
+                'counters': dict(self.counters.get((None, None), {})),
+                'histograms': dict((name, histogram.to_dict())
+                                   for name, histogram in self.histograms.get((None, None), {}).items()),
+                'endpoints': dict(),
+            }
+            for key in set(self.counters) | set(self.histograms):
+                if key == (None, None):
+                    continue
+                snapshot['endpoints']['{api}/{endpoint}'.format(api=key[0], endpoint=key[1])] = {
+                    'counters': dict(self.counters.get(key, {})),
+                    'histograms': dict((name, histogram.to_dict())
+                                       for name, histogram in self.histograms.get(key, {}).items()),
+                }
+        return snapshot
+
+
+class MetricsDump(object):
+    """Writes a metrics snapshot to a json file every `interval` seconds, and once more when stopped."""
+
+    def __init__(self, snapshot, filename, interval=60.0):
+        """Create a new `MetricsDump`. It is started with `start()`.
+
+        :param snapshot: Function returning the snapshot, like `EDSMQueries.metrics_snapshot`.
+        :param filename: File to write.
+        :param interval: Seconds between writes.
+        """
+
+        self.snapshot = snapshot
+        self.filename = filename
+        self.interval = interval
+        self.stopEvent = Event()
+        self.thread = None
+        # The last error writing the file, `None` after a successful write.
+        self.lastError = None
+
+    def start(self):
+        """Start writing in a background thread."""
+
+        self.stopEvent.clear()
+        self.thread = Thread(target=self.worker, name='Materializer metrics dump')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Write a last snapshot and stop the thread."""
+
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def worker(self):
+        """Write a snapshot every interval until stopped."""
+
+        while not self.stopEvent.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self):
+        """Write a snapshot. The file is replaced at once, readers never see a partial one."""
+
+        temporary = self.filename + '.tmp'
+        try:
+            with open(temporary, 'w') as dump:
+                json.dump(self.snapshot(), dump, indent=2, sort_keys=True)
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)  # No atomic replace on Windows with python 2.
+            os.rename(temporary, self.filename)
+            self.lastError = None
+        except (IOError, OSError) as err:
+            self.lastError = err
@@ -0,0 +1,196 @@
+"""
+Streaming projection of EDSM replies.
+
+A bodies reply for a big system is mostly rings, belts, parents and discovery
+information the plugin never looks at. A `Projection` parses a reply while it
+is being received, one list item at a time, and keeps only the fields asked
+for. The full reply is never held in memory and the kept records are small.
+
+This module does not depend on EDMC.
+"""
+
+import codecs
+import json
+import re
+
+from body_predicates import ATTRIBUTES
+
+WHITESPACE = re.compile(r'\s*')
+NUMBER_END = re.compile(r'[-+0-9.eE]$')
+
+
+class ProjectionError(ValueError):
+    """Raised when a reply is not the json object we expect."""
+
+
+class _NeedMore(Exception):
+    """Internal: the buffer ends in the middle of a value."""
+
+
+class Projection(object):
+    """Keeps selected fields of a json object and of the objects in one of it's lists."""
+
+    def __init__(self, fields, list_field, item_fields):
+        """Create a new `Projection`.
+
+        :param fields: Top level fields to keep.
+        :param list_field: Name of the list with items to project, like 'bodies'.
+        :param item_fields: Fields to keep of each item.
+        """
+
+        self.fields = frozenset(fields)
+        self.listField = list_field
+        self.itemFields = frozenset(item_fields)
+
+    def project_item(self, item):
+        """Return an item with only the wanted fields."""
+
+        if not isinstance(item, dict):
+            return item
+        return dict((key, item[key]) for key in self.itemFields.intersection(item))
+
+    def project(self, reply):
+        """Project an already parsed reply."""
+
+        if not isinstance(reply, dict):
+            return reply
+        projected = dict((key, reply[key]) for key in self.fields.intersection(reply))
+        if isinstance(reply.get(self.listField), list):
+            projected[self.listField] = [self.project_item(item) for item in reply[self.listField]]
+        return projected
+
+    def parse(self, chunks):
+        """Parse a reply from an iterable of byte (or unicode) chunks.
+
+        :return: The projected reply.
+        :raises ProjectionError: when the reply is not a json object.
+        """
+
+        return _StreamParser(self, chunks).parse()
+
+
+class _StreamParser(object):
+    """Incremental parser for one reply: walks the top level object and decodes it's values one by one."""
+
+    def __init__(self, projection, chunks):
+        """Initialize the parser."""
+
+        self.projection = projection
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.position = 0
+        self.finished = False
+
+    def parse(self):
+        """Parse the reply."""
+
+        result = dict()
+        self._expect(u'{')
+        if self._peek() == u'}':
+            return result
+
+        while True:
+            key = self._value()
+            if not isinstance(key, basestring):
+                raise ProjectionError("Expected a field name")
+            self._expect(u':')
+            if key == self.projection.listField and self._peek() == u'[':
+                result[key] = self._items()
+            else:
+                value = self._value()
+                if key in self.projection.fields:
+                    result[key] = value
+            if self._next_separator(u'}'):
+                return result
+
+    def _items(self):
+        """Parse the projected list, one item at a time."""
+
+        self._expect(u'[')
+        items = []
+        if self._peek() == u']':
+            self.position += 1
+            return items
+        while True:
+            items.append(self.projection.project_item(self._value()))
+            if self._next_separator(u']'):
+                return items
+
+    def _next_separator(self, closing):
+        """Consume a ',' or the closing character. Returns `True` for the closing one."""
+
+        character = self._peek()
+        self.position += 1
+        if character == closing:
+            return True
+        if character != u',':
+            raise ProjectionError("Expected ',' or '{closing}', got '{character}'".format(
+                closing=closing,
+                character=character,
+            ))
+        return False
+
+    def _expect(self, character):
+        """Consume an expected character."""
+
+        if self._peek() != character:
+            raise ProjectionError("Expected '{character}'".format(character=character))
+        self.position += 1
+
+    def _peek(self):
+        """Skip whitespace and return the next character."""
+
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read():
+                raise ProjectionError("Unexpected end of reply")
+
+    def _value(self):
+        """Decode the next json value."""
+
+        self._peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buffer, self.position)
+                if end == len(self.buffer) and not self.finished and NUMBER_END.search(self.buffer):
+                    raise _NeedMore()  # The number might continue in the next chunk.
+            except (ValueError, _NeedMore):
+                if not self._read():
+                    raise ProjectionError("Invalid or truncated reply")
+                continue
+            self.position = end
+            return value
+
+    def _read(self):
+        """Append the next chunk to the buffer. Returns `False` at the end of the reply."""
+
+        if self.finished:
+            return False
+
+        # Drop what has been parsed, so the buffer only holds the value being decoded.
+        if self.position:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.utf8.decode(chunk)
+            if chunk:
+                self.buffer += chunk
+                return True
+
+        self.finished = True
+        self.buffer += self.utf8.decode(b'', True)
+        return True
+
+
+# The fields the plugin uses from api-system-v1/bodies.
+BODIES_PROJECTION = Projection(
+    ('id', 'id64', 'name', 'url', 'bodyCount'),
+    'bodies',
+    ('id', 'bodyId', 'name', 'type', 'isLandable', 'materials') + ATTRIBUTES,
+)
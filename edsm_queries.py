@@ -5,111 +5,519 @@ The EDSMQueries helper will run in it's own thread and perform
 a callback when an item on the queue is processed.
 """
 
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from email.utils import mktime_tz, parsedate_tz
 from Queue import Queue, Empty
-from threading import Thread, Event
+from threading import BoundedSemaphore, Event, Lock, Thread
 
 from pprint import pformat
-from requests import Session, HTTPError, ConnectionError
+from requests import Session, HTTPError, ConnectionError, Timeout
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError
+
+from circuit_breaker import CircuitBreaker
+from edsm_metrics import EDSMMetrics
+from edsm_projection import ProjectionError
 
 from material_api import LOGGER, LOG_INFO, LOG_DEBUG
+from rate_limiter import TokenBucket
 from version import VERSION
 
+# Returned instead of a reply when EDSM confirms the cached reply did not change.
+NOT_MODIFIED = object()
+
 
 class EDSMQueries(object):
     """Handles queries to EDSM in a queued way."""
 
-    THROTTLE = 5
     API_TIMEOUT = 10
+    # Seconds a request may take in total, including rate limit waits and retries.
+    DEADLINE = 30.0
+    # Seconds `stop()` waits for the workers by default.
+    STOP_TIMEOUT = 2.0
+    # Bytes read at a time from projected (streamed) replies.
+    CHUNK_SIZE = 16 * 1024
     API_BASE_URL = 'https://www.edsm.net'
     API_SYSTEM_V1 = 'api-system-v1'
     API_SYSTEMS_V1 = 'api-systems-v1'
     API_STATUS_V1 = 'api-status-v1'
 
-    def __init__(self):
-        """Initialize `EDSMQueries`."""
+    # Request priorities, lower goes first.
+    PRIORITY_CURRENT = 0
+    PRIORITY_PREFETCH = 1
+    PRIORITY_BACKGROUND = 2
+    MAX_QUEUED = 50
+
+    # Retries: up to MAX_ATTEMPTS tries with a random wait of up to BACKOFF_BASE * 2 ** attempt seconds in between.
+    MAX_ATTEMPTS = 3
+    BACKOFF_BASE = 1.0
+    BACKOFF_MAX = 30.0
+    # Longest Retry-After we are willing to honour.
+    RETRY_AFTER_MAX = 120.0
+
+    WORKERS = 3
+    # Maximum number of concurrent requests per api or (api, endpoint). Others are only limited by WORKERS.
+    CONCURRENCY = {
+        API_SYSTEM_V1: 2,
+        API_STATUS_V1: 1,
+    }
+
+    def __init__(self, workers=None, base_url=None):
+        """Initialize `EDSMQueries`.
 
-        self.queue = ClearableQueue()
-        self.resultQueue = []
+        :param workers: Number of worker threads, defaults to `WORKERS`.
+        :param base_url: Override `API_BASE_URL`, for example to use a stand-in server.
+        """
+
+        self.queue = RequestQueue(self.MAX_QUEUED)
+        self.currentSystem = None
+        # Replies for the Tk thread. One event is generated for all replies that arrive until it drains them.
+        self.resultQueue = deque()
         self.callbackRoot = None
-        self.thread = None
+        self.notifyLock = Lock()
+        self.notifyPending = False
+        self.notifiedAt = None
+        self.workers = workers or self.WORKERS
+        if base_url is not None:
+            self.API_BASE_URL = base_url  # pylint: disable=invalid-name
+        self.threads = []
+        # Incremented by `stop()`: workers from before it which are still busy exit after their request.
+        self.generation = 0
+        # Seconds the last `stop()` took and the number of workers it could not wait for.
+        self.shutdownSeconds = None
+        self.abandonedWorkers = 0
+        # The workers share the session and it's connection pool.
         self.session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.session.headers['User-Agent'] = "{product}/{version}".format(
             product="EDMC-Materializer-Plugin",
             version=VERSION,
         )
+        # EDSM's replies compress very well.
+        self.session.headers['Accept-Encoding'] = 'gzip'
         self.logLevel = None
         self.logPrefix = 'EDSMQueries > '
         self.interruptEvent = Event()
+        self.cache = None
+        self.rateLimiter = TokenBucket()
+        self.circuitBreaker = CircuitBreaker()
+        self.random = random.Random()
+        # Requests queued or being performed: key => number of calls waiting for the reply.
+        self.pending = dict()
+        # key => time the request was queued, for the queue wait metric.
+        self.queuedAt = dict()
+        # Keys of the pending requests refreshing a stale reply, which has been delivered from the cache already.
+        self.revalidating = set()
+        self.pendingLock = Lock()
+        self.sequences = dict()
+        self.delivery = OrderedDelivery(self._deliver)
+        self.semaphores = dict()
+        # (api, endpoint): Projection applied while the reply is received.
+        self.projections = dict()
+        # (api, endpoint): callable(request, reply) turning a reply into what is delivered to the Tk thread.
+        self.processors = dict()
+        # Thread and queue processing cache hits, started when needed. See `_process_later()`.
+        self.processThread = None
+        self.processQueue = None
+        self.counters = {
+            'requests': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'cancelled': 0,
+            'retries': 0,
+            'failedFast': 0,
+            'expired': 0,
+            'notModified': 0,
+            # Bytes of reply bodies as received (compressed) and after decompression.
+            'bytesReceived': 0,
+            'bytesDecoded': 0,
+        }
+        # Latencies, retries, failures and bytes per api and endpoint. See `metrics_snapshot()`.
+        self.metrics = EDSMMetrics()
+
+    def set_cache(self, cache):
+        """Use an `EDSMCache` for GET requests. `None` disables caching."""
+
+        self.cache = cache
+
+    def set_rate_limiter(self, rate_limiter):
+        """Use a (restored) `TokenBucket` to pace the requests."""
+
+        self.rateLimiter = rate_limiter
+
+    def set_projection(self, api, endpoint, projection):
+        """Only keep the fields selected by an `edsm_projection.Projection` of replies for an endpoint.
+
+        The reply is streamed and projected while it is received. `None` restores full replies.
+        """
+
+        if projection is None:
+            self.projections.pop((api, endpoint), None)
+        else:
+            self.projections[(api, endpoint)] = projection
+
+    def set_processor(self, api, endpoint, processor):
+        """Process the replies for an endpoint before they are delivered, like `material_pipeline.BodiesMatcher`.
+
+        The processor is called with the request and the reply by the thread that completes the request, the worker
+        (or event loop), or by the processor thread for cache hits. It is never called on the Tk thread. What it
+        returns is delivered instead of the reply, while the reply itself is cached. `None` removes the processor.
+        """
+
+        if processor is None:
+            self.processors.pop((api, endpoint), None)
+        else:
+            self.processors[(api, endpoint)] = processor
+
+    def _init_threads(self):
+        """Create the worker threads."""
 
-    def _init_thread(self):
-        if self.thread is None:
-            self.thread = Thread(target=self.worker, name='EDSM Queries worker')
-            self.thread.daemon = True
-        return self.thread
+        while len(self.threads) < self.workers:
+            thread = Thread(target=self.worker, args=(self.generation,),
+                            name='EDSM Queries worker {index}'.format(index=len(self.threads)))
+            thread.daemon = True
+            self.threads.append(thread)
+        return self.threads
 
     def get_response(self):
         """Return the first queued response."""
 
-        if not self.resultQueue:
+        self._notified()
+        try:
+            return self.resultQueue.popleft()
+        except IndexError:
             return None
 
-        return self.resultQueue.pop(0)
+    def get_responses(self):
+        """Return all queued responses, in the order they arrived.
+
+        Replies that arrive while or after they are taken generate a new event.
+        """
+
+        self._notified()
+        responses = []
+        while True:
+            try:
+                responses.append(self.resultQueue.popleft())
+            except IndexError:
+                return responses
+
+    def _notified(self):
+        """Note that the Tk thread handles the event, recording how long it took to get to it."""
+
+        with self.notifyLock:
+            if self.notifyPending:
+                self.metrics.observe('dispatch', time.time() - self.notifiedAt)
+            self.notifyPending = False
+
+    def metrics_snapshot(self):
+        """Return the metrics, the counters and how the last `stop()` went as a json serializable dict.
+
+        See `EDSMMetrics.snapshot()`. The counters are added to the ones for the client as a whole.
+        """
+
+        snapshot = self.metrics.snapshot()
+        with self.pendingLock:
+            snapshot['counters'].update(self.counters)
+        snapshot['gauges'].setdefault('queueDepth', {'value': 0, 'max': 0})['value'] = self.queue.qsize()
+        snapshot['shutdownSeconds'] = self.shutdownSeconds
+        snapshot['abandonedWorkers'] = self.abandonedWorkers
+        return snapshot
 
     def start(self, callback_root):
-        """Start the thread."""
+        """Start the threads."""
 
         self.callbackRoot = callback_root
-        if self.thread is None:
-            self._init_thread()
+        self._init_threads()
 
         self.interruptEvent.clear()
-        if self.thread.isAlive():
-            LOGGER.log(self, LOG_DEBUG, "Thread already started.")
-        else:
-            self.thread.start()
-            LOGGER.log(self, LOG_INFO, "Started thread.")
+        for thread in self.threads:
+            if thread.isAlive():
+                LOGGER.log(self, LOG_DEBUG, "Thread already started.")
+            else:
+                thread.start()
+                LOGGER.log(self, LOG_INFO, "Started thread.")
+
+    def stop(self, timeout=None):
+        """Clear queue and stop the threads.
 
-    def stop(self):
-        """Clear queue and stop the thread."""
+        Requests in flight are aborted as soon as possible. Workers which are still busy after `timeout` seconds
+        (default `STOP_TIMEOUT`) are abandoned: they are daemon threads and exit without delivering their reply.
+        """
 
+        started = time.time()
+        timeout = self.STOP_TIMEOUT if timeout is None else timeout
         LOGGER.log(self, LOG_DEBUG, "Stopping the EDSM Querier Queue.")
+        self.generation += 1
         self.queue.clear()
-        self.queue.put(None)
-        LOGGER.log(self, LOG_DEBUG, "Waiting for worker to exit.")
-        # Send an interrupt if we have any THROTTLE waits in place.
+        self._stop_processor()
+        with self.pendingLock:
+            self.pending.clear()
+            self.queuedAt.clear()
+            self.revalidating.clear()
+            self.sequences.clear()
+        for _thread in self.threads:
+            self.queue.put((RequestQueue.PRIORITY_STOP, None))
+        LOGGER.log(self, LOG_DEBUG, "Waiting for workers to exit.")
+        # Interrupt rate limit and retry waits, and make requests in flight give up.
         self.interruptEvent.set()
-        self.thread.join()
-        self.thread = None
-        LOGGER.log(self, LOG_INFO, "Stopped EDSMQuerier.")
+        for thread in self.threads:
+            thread.join(max(started + timeout - time.time(), 0.0))
+        self.abandonedWorkers = len([thread for thread in self.threads if thread.isAlive()])
+        # Stop requests the abandoned workers did not take.
+        self.queue.clear()
+        self.threads = []
+        self.delivery.clear()
+        self.shutdownSeconds = time.time() - started
+        LOGGER.log(self, LOG_INFO, "Stopped EDSMQuerier in {seconds:.2f}s ({abandoned} workers abandoned).",
+                   seconds=self.shutdownSeconds, abandoned=self.abandonedWorkers)
+
+    def set_current_system(self, system):
+        """Change the current system: queued requests for other systems with the current priority are cancelled.
+
+        Prefetch and background requests are left alone.
+        """
 
-    def request_get(self, api, endpoint, **request_params):
+        self.currentSystem = system
+        current = (system or '').lower()
+
+        def left_system(priority, request):
+            """Check if a request is a current system request for a system we have left."""
+            request_system = request[3].get('systemName')
+            if priority != self.PRIORITY_CURRENT or request_system is None:
+                return False
+            return request_system.lower() != current
+
+        cancelled = self.queue.cancel(left_system)
+        for request in cancelled:
+            LOGGER.debug(self, "Cancelled {api}/{endpoint} for {system}", api=request[0], endpoint=request[1],
+                         system=request[3]['systemName'])
+            self._finish(request)
+        with self.pendingLock:
+            self.counters['cancelled'] += len(cancelled)
+
+    def request_get(self, api, endpoint, priority=PRIORITY_CURRENT, **request_params):
         """Queues a GET request.
 
         See #_request() for information on parameters.
         """
 
-        self._request(api, endpoint, 'GET', **request_params)
+        self._request(api, endpoint, 'GET', priority, **request_params)
 
-    def request_post(self, api, endpoint, **data):
+    def request_post(self, api, endpoint, priority=PRIORITY_CURRENT, **data):
         """Send out a post request.
 
         See #_request() for information on parameters.
         """
 
-        self._request(api, endpoint, 'POST', **data)
+        self._request(api, endpoint, 'POST', priority, **data)
 
-    def _request(self, api, endpoint, method, **request_params):
+    def _request(self, api, endpoint, method, priority=PRIORITY_CURRENT, **request_params):
         """Add a new request to the queue.
 
         :param api: api you want to get
         :param endpoint: EDSM's api endpoint you want to hit
         :param method: HTTP method to use.
+        :param priority: One of the PRIORITY_* constants.
         :param request_params: additional request parameters.
         """
 
-        self.queue.put((api, endpoint, method, request_params), False)
+        request = (api, endpoint, method, request_params)
+        revalidate = False
+        if method == 'GET' and self.cache is not None:
+            cached = self.cache.get(api, endpoint, request_params)
+            if cached is not None:
+                (reply, fresh) = cached
+                sequence = self.delivery.issue(self._stream(request))
+                if request[:2] in self.processors:
+                    self._process_later(request, reply, sequence)
+                else:
+                    self.delivery.complete(self._stream(request), sequence, (request, reply))
+                if fresh:
+                    return
+                if self.circuitBreaker.is_open():
+                    LOGGER.debug(self, "EDSM unavailable, serving stale {api}/{endpoint}", api=api, endpoint=endpoint)
+                    return
+                # Stale: the cached reply has been served, refresh it in the background.
+                LOGGER.debug(self, "Revalidating {api}/{endpoint}", api=api, endpoint=endpoint)
+                revalidate = True
+
+        # Identical requests which are queued or in flight get the same reply: don't send them twice.
+        key = self.request_key(api, endpoint, method, request_params)
+        self.metrics.count('requests', api=api, endpoint=endpoint)
+        with self.pendingLock:
+            self.counters['requests'] += 1
+            if key in self.pending:
+                self.pending[key] += 1
+                self.counters['coalesced'] += 1
+                LOGGER.debug(self, "Coalesced {api}/{endpoint} with a pending request", api=api, endpoint=endpoint)
+                self.queue.promote(request, priority)
+                return
+            self.pending[key] = 1
+            self.queuedAt[key] = time.time()
+            if revalidate:
+                self.revalidating.add(key)
+            self.sequences[key] = self.delivery.issue(self._stream(request))
+
+        dropped = self.queue.put_bounded(request, priority)
+        self.metrics.gauge('queueDepth', self.queue.qsize())
+        if dropped is not None:
+            LOGGER.warn(self, "Queue full, dropped {api}/{endpoint}", api=dropped[0], endpoint=dropped[1])
+            self._finish(dropped)
+            with self.pendingLock:
+                self.counters['dropped'] += 1
+
+    @staticmethod
+    def request_key(api, endpoint, method, request_params):
+        """Return a hashable key identifying a request."""
+
+        return (api, endpoint, method, tuple(sorted(request_params.items())))
+
+    @staticmethod
+    def _stream(request):
+        """Return the stream replies are delivered in order for: the (lower cased) system of the request."""
+
+        system = request[3].get('systemName')
+        return system.lower() if system is not None else None
+
+    def _finish(self, request, reply=None):
+        """Forget a pending request and hand it's reply over for delivery. Later identical requests will be sent again.
+
+        :param request: The finished request.
+        :param reply: The reply to deliver, `None` when there is nothing to deliver.
+        :return: The number of calls that were waiting for the reply.
+        """
+
+        key = self.request_key(*request)
+        with self.pendingLock:
+            waiters = self.pending.pop(key, 1)
+            self.queuedAt.pop(key, None)
+            self.revalidating.discard(key)
+            sequence = self.sequences.pop(key, None)
+        if reply:
+            reply = self._process(request, reply)
+        if sequence is not None:
+            self.delivery.complete(self._stream(request), sequence, (request, reply) if reply else None)
+        elif reply:
+            self._deliver(request, reply)
+        return waiters
+
+    def _process(self, request, reply):
+        """Run the processor for the endpoint of a request on a reply, outside the delivery lock."""
+
+        processor = self.processors.get(request[:2])
+        if processor is None:
+            return reply
+        return processor(request, reply)
+
+    def _process_later(self, request, reply, sequence):
+        """Process a cached reply in the processor thread, processing a big system takes too long for the Tk thread.
+
+        :param sequence: The delivery sequence issued for the request.
+        """
+
+        if self.processThread is None:
+            self.processQueue = ClearableQueue()
+            self.processThread = Thread(target=self.process_worker, args=(self.processQueue,),
+                                        name='EDSM Queries processor')
+            self.processThread.daemon = True
+            self.processThread.start()
+        self.processQueue.put((self.generation, request, reply, sequence))
+
+    def process_worker(self, process_queue):
+        """Process the cached replies from a queue until a `None` is taken from it."""
+
+        while True:
+            item = process_queue.get()
+            if item is None:
+                break
+            (generation, request, reply, sequence) = item
+            processed = self._process(request, reply)
+            if generation == self.generation:
+                self.delivery.complete(self._stream(request), sequence, (request, processed))
+
+    def _stop_processor(self):
+        """Drop the cached replies waiting to be processed and let the processor thread exit."""
+
+        if self.processThread is not None:
+            self.processQueue.clear()
+            self.processQueue.put(None)
+            self.processThread = None
+            self.processQueue = None
+
+    def _deliver(self, request, reply):
+        """Queue a reply and notify the Tk thread, unless it has been notified and did not take the replies yet."""
+
+        self.resultQueue.append((request, reply))
+        if self.callbackRoot is None:
+            return
+        with self.notifyLock:
+            if self.notifyPending:
+                return
+            self.notifyPending = True
+            self.notifiedAt = time.time()
+        self.callbackRoot.event_generate('<<EDSMCallback>>', when='tail')
+
+    def _url(self, api, endpoint):
+        """Return the url for an api endpoint."""
+
+        return "{base}/{api}/{endpoint}".format(base=self.API_BASE_URL, api=api, endpoint=endpoint)
+
+    @staticmethod
+    def conditional_headers(validators):
+        """Return the headers asking EDSM to only send a reply when it changed since the cached one."""
+
+        headers = dict()
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('modified'):
+            headers['If-Modified-Since'] = validators['modified']
+        return headers
+
+    @staticmethod
+    def response_validators(headers):
+        """Return the validators of a reply: it's ETag and Last-Modified headers."""
 
-    def _http_request(self, api, endpoint, method, request_params):
+        validators = dict()
+        if headers.get('ETag'):
+            validators['etag'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            validators['modified'] = headers['Last-Modified']
+        return validators
+
+    def _validators(self, request):
+        """Return the validators of the cached reply for a request."""
+
+        (api, endpoint, method, request_params) = request
+        if method != 'GET' or self.cache is None:
+            return dict()
+        return self.cache.validators(api, endpoint, request_params)
+
+    def _count_bytes(self, api, endpoint, received, decoded):
+        """Add to the bytes on the wire counters."""
+
+        with self.pendingLock:
+            self.counters['bytesReceived'] += received
+            self.counters['bytesDecoded'] += decoded
+        self.metrics.count('bytesReceived', received, api, endpoint)
+        self.metrics.count('bytesDecoded', decoded, api, endpoint)
+
+    def _dequeued(self, request):
+        """Record how long a request taken from the queue waited there."""
+
+        with self.pendingLock:
+            queued = self.queuedAt.pop(self.request_key(*request), None)
+        if queued is not None:
+            self.metrics.observe('queueWait', time.time() - queued, request[0], request[1])
+        self.metrics.gauge('queueDepth', self.queue.qsize())
+
+    def _http_request(self, api, endpoint, method, request_params, validators=None, deadline=None):
         """Perform the http request to edsm.
 
         If performing a get request, the request_params are send as such.
@@ -118,51 +526,382 @@ class EDSMQueries(object):
         :param endpoint: EDSM's api endpoint you want to hit
         :param method: HTTP method to use.
         :param request_params: additional request parameters.
+        :param validators: Validators of the cached reply, updated with the ones of the new reply.
+        :param deadline: Time by which the request has to be done.
+        :return: The reply, or `NOT_MODIFIED`.
+        :raises Timeout: when the deadline passes or we are stopping while the reply is received.
         """
 
-        url = "{base}/{api}/{endpoint}".format(base=self.API_BASE_URL, api=api, endpoint=endpoint)
-        LOGGER.log(self, LOG_DEBUG, "request {method} '{url}'".format(method=method, url=url))
+        url = self._url(api, endpoint)
+        projection = self.projections.get((api, endpoint))
+        stream = projection is not None
+        headers = self.conditional_headers(validators or {})
+        timeout = self.API_TIMEOUT
+        if deadline is not None:
+            timeout = max(min(timeout, deadline - time.time()), 0.1)
+        LOGGER.log(self, LOG_DEBUG, "request {method} '{url}'", method=method, url=url)
+        started = time.time()
         if method == 'GET':
-            session_request = self.session.get(url, params=request_params, timeout=self.API_TIMEOUT)
+            session_request = self.session.get(url, params=request_params, headers=headers, timeout=timeout,
+                                               stream=stream)
         elif method == 'POST':
-            session_request = self.session.post(url, data=request_params, timeout=self.API_TIMEOUT)
+            session_request = self.session.post(url, data=request_params, timeout=timeout, stream=stream)
+        # Seconds spent waiting for EDSM: for the headers, and for the chunks of a streamed reply.
+        waited = time.time() - started
+        reading = [0.0]
 
-        session_request.raise_for_status()
-        return session_request.json()
+        try:
+            self.rateLimiter.update(session_request.headers)
+            session_request.raise_for_status()
+            if session_request.status_code == 304:
+                if validators is not None:
+                    validators.update(self.response_validators(session_request.headers))
+                return NOT_MODIFIED
+            if validators is not None:
+                validators.clear()
+                validators.update(self.response_validators(session_request.headers))
 
-    def worker(self):
+            parsing = time.time()
+            if projection is not None:
+                decoded = [0]
+
+                def chunks():
+                    """Count the decompressed bytes passed to the projection, give up when time is up."""
+                    content = session_request.iter_content(self.CHUNK_SIZE)
+                    while True:
+                        before = time.time()
+                        chunk = next(content, None)
+                        reading[0] += time.time() - before
+                        if chunk is None:
+                            return
+                        if self.interruptEvent.is_set() or (deadline is not None and time.time() > deadline):
+                            raise Timeout("Deadline passed while receiving the reply")
+                        decoded[0] += len(chunk)
+                        yield chunk
+                reply = projection.parse(chunks())
+                decoded = decoded[0]
+                self.metrics.observe('parse', time.time() - parsing - reading[0], api, endpoint)
+            else:
+                reply = session_request.json()
+                decoded = len(session_request.content)
+                self.metrics.observe('parse', time.time() - parsing, api, endpoint)
+            # urllib3 counts the bytes read from the connection, before decompression.
+            received = session_request.raw.tell()
+            self._count_bytes(api, endpoint, received, decoded)
+            if received >= decoded and decoded > self.CHUNK_SIZE:
+                LOGGER.debug(self, "{api}/{endpoint} reply was not compressed", api=api, endpoint=endpoint)
+            return reply
+        finally:
+            session_request.close()
+            self.metrics.observe('http', waited + reading[0], api, endpoint)
+
+    def worker(self, generation=None):
         """Wait for a request to come in.
 
         Executes the http request and makes the callback with the reply.
+        :param generation: The `generation` the worker was started in. When `stop()` gave up on the worker, it exits
+            after it's current request.
         """
         while True:
             request = self.queue.get()
             if request is None:
                 break
 
-            (api, endpoint, method, request_params) = request
-            reply = None
-            retrying = 0
-            LOGGER.debug(self, "Performing callback for {api}/{endpoint}".format(api=api, endpoint=endpoint))
-            while retrying < 3:
-                try:
-                    reply = self._http_request(api, endpoint, method, request_params)
-                    break
-                except ConnectionError, err:
-                    LOGGER.error(self, "HTTP Connection error: {err}".format(err=err))
-                except HTTPError, err:
-                    LOGGER.error(self, "HTTP error occured: {err}".format(err=err))
-                retrying += 1
-
-            if reply:
-                self.resultQueue.append((request, reply))
-                self.callbackRoot.event_generate('<<EDSMCallback>>', when='tail')
+            abandoned = False
+            try:
+                self._dequeued(request)
+                LOGGER.debug(self, "Performing callback for {api}/{endpoint}", api=request[0], endpoint=request[1])
+                if self.circuitBreaker.allow():
+                    validators = self._validators(request)
+                    try:
+                        reply = self._perform(request, validators)
+                    finally:
+                        # A probe that expired, was interrupted or crashed has no outcome, it must not keep the
+                        # breaker half-open.
+                        self.circuitBreaker.release_probe()
+                    if generation is not None and generation != self.generation:
+                        LOGGER.debug(self, "Abandoned worker exits")
+                        abandoned = True
+                        break
+                    self._complete(request, reply, validators=validators)
+                else:
+                    self._complete(request, self._fail_fast(request), cached=True)
+            except Exception as err:  # pylint: disable=broad-except
+                # Keep the worker alive, and don't leave identical requests coalesced onto this one forever.
+                LOGGER.error(self, "Failed {api}/{endpoint}: {err}", api=request[0], endpoint=request[1], err=err)
+                self._finish(request)
+            finally:
+                if not abandoned:
+                    self.queue.task_done()
+
+    def _complete(self, request, reply, cached=False, validators=None):
+        """Store a reply in the cache and hand it over for delivery.
+
+        :param request: The finished request.
+        :param reply: The reply, `NOT_MODIFIED` or `None` when the request failed.
+        :param cached: The reply came from the cache.
+        :param validators: Validators of the reply.
+        """
+
+        (api, endpoint, method, request_params) = request
+        if reply is NOT_MODIFIED:
+            # The cached reply, which has been delivered when the request was made, is still good.
+            with self.pendingLock:
+                self.counters['notModified'] += 1
+            if self.cache is not None:
+                self.cache.revalidate(api, endpoint, request_params, validators)
+            self._finish(request)
+            LOGGER.debug(self, "{api}/{endpoint} not modified", api=api, endpoint=endpoint)
+            return
+
+        changed = bool(reply)
+        if reply and not cached and method == 'GET' and self.cache is not None:
+            # An unchanged reply has already been delivered from the cache.
+            changed = self.cache.put(api, endpoint, request_params, reply, validators)
+
+        waiters = self._finish(request, reply if changed else None)
+        if waiters > 1:
+            LOGGER.debug(self, "Reply for {api}/{endpoint} serves {waiters} calls", api=api, endpoint=endpoint,
+                         waiters=waiters)
+        if not reply:
+            self.metrics.count('failures', api=api, endpoint=endpoint)
+            LOGGER.error(self, "Unable to perform request {api}/{endpoint}".format(api=api, endpoint=endpoint))
+
+    def _perform(self, request, validators=None):
+        """Perform a request, retrying with backoff. Updates the circuit breaker.
+
+        :param validators: Validators of the cached reply, updated with the ones of the new reply.
+        :return: The reply, `NOT_MODIFIED` or `None`.
+        """
+
+        (api, endpoint, method, request_params) = request
+        deadline = time.time() + self.DEADLINE
+        attempt = 0
+        while True:
+            # The token is taken right away, so concurrent workers each wait for their own.
+            wait = self.rateLimiter.reserve()
+            if wait > 0:
+                LOGGER.debug(self, "Rate limited, waiting {wait:.1f}s", wait=wait)
+                if wait >= deadline - time.time():
+                    return self._expired(request)
+                if self._interruptible_wait(wait):
+                    return None
+
+            retry_after = None
+            semaphores = self._semaphores(api, endpoint)
+            if not self._acquire_all(semaphores):
+                return None
+            try:
+                if self.interruptEvent.is_set():
+                    return None
+                reply = self._http_request(api, endpoint, method, request_params, validators, deadline)
+                self.circuitBreaker.record_success()
+                return reply
+            except Timeout, err:
+                if self.interruptEvent.is_set():
+                    return None
+
+                LOGGER.error(self, "HTTP timeout: {err}", err=err)
+            except ConnectionError, err:
+                LOGGER.error(self, "HTTP Connection error: {err}", err=err)
+            except (ChunkedEncodingError, ProjectionError, ValueError), err:
+                # ValueError: not json, like a maintenance page.
+                LOGGER.error(self, "Invalid or truncated reply: {err}", err=err)
+            except HTTPError, err:
+                LOGGER.error(self, "HTTP error occured: {err}", err=err)
+                status = err.response.status_code if err.response is not None else None
+                if status is not None and 400 <= status < 500 and status != 429:
+                    # EDSM is up, retrying will not change it's mind.
+                    self.circuitBreaker.record_success()
+                    return None
+                retry_after = self._retry_after(err.response)
+            finally:
+                for semaphore in reversed(semaphores):
+                    semaphore.release()
+
+            if self.interruptEvent.is_set():
+                return None
+            attempt += 1
+            if attempt >= self.MAX_ATTEMPTS:
+                self.circuitBreaker.record_failure()
+                return None
+            if retry_after is None:
+                retry_after = self._backoff(attempt)
+            if retry_after >= deadline - time.time():
+                return self._expired(request)
+            with self.pendingLock:
+                self.counters['retries'] += 1
+            self.metrics.count('retries', api=api, endpoint=endpoint)
+            LOGGER.debug(self, "Retrying {api}/{endpoint} in {wait:.1f}s", api=api, endpoint=endpoint, wait=retry_after)
+            if self._interruptible_wait(retry_after):
+                return None
+
+    def _expired(self, request):
+        """Give up on a request which would not be done before it's deadline."""
+
+        with self.pendingLock:
+            self.counters['expired'] += 1
+        LOGGER.debug(self, "{api}/{endpoint} would take longer than {deadline}s", api=request[0], endpoint=request[1],
+                     deadline=self.DEADLINE)
+        return None
+
+    def _acquire_all(self, semaphores):
+        """Acquire the semaphores, unless we are stopping. Returns `False`, holding none of them, when interrupted."""
+
+        for index, semaphore in enumerate(semaphores):
+            while not semaphore.acquire(False):
+                if self._interruptible_wait(0.05):
+                    for acquired in reversed(semaphores[:index]):
+                        acquired.release()
+                    return False
+        return True
+
+    def _fail_fast(self, request):
+        """Handle a request while the circuit breaker is open: use a cached reply when there is one.
+
+        :return: A cached reply or `None`. `None` as well when the request refreshes a cached reply: it has been
+            delivered when the request was made.
+        """
+
+        (api, endpoint, method, request_params) = request
+        with self.pendingLock:
+            self.counters['failedFast'] += 1
+            revalidating = self.request_key(*request) in self.revalidating
+        LOGGER.debug(self, "EDSM unavailable, not sending {api}/{endpoint}", api=api, endpoint=endpoint)
+        if method != 'GET' or self.cache is None or revalidating:
+            return None
+        cached = self.cache.get(api, endpoint, request_params)
+        return cached[0] if cached is not None else None
+
+    def _semaphores(self, api, endpoint):
+        """Return the semaphores limiting the concurrency for an api and endpoint."""
+
+        semaphores = []
+        with self.pendingLock:
+            for key in (api, (api, endpoint)):
+                if key not in self.CONCURRENCY:
+                    continue
+                if key not in self.semaphores:
+                    self.semaphores[key] = BoundedSemaphore(self.CONCURRENCY[key])
+                semaphores.append(self.semaphores[key])
+        return semaphores
+
+    def _backoff(self, attempt):
+        """Return the seconds to wait before a retry: exponential with full jitter."""
+
+        return self.random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+
+    def _retry_after(self, response):
+        """Return the seconds from the Retry-After header of a response, `None` when there is none."""
+
+        if response is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+
+        try:
+            seconds = float(value)
+        except ValueError:
+            parsed = parsedate_tz(value)
+            if parsed is None:
+                return None
+            seconds = mktime_tz(parsed) - time.time()
+        return min(max(seconds, 0.0), self.RETRY_AFTER_MAX)
+
+    def _interruptible_wait(self, seconds):
+        """Wait, unless we are stopping. Returns `True` when interrupted."""
+
+        self.interruptEvent.wait(seconds)
+        return self.interruptEvent.is_set()
+
+
+class OrderedDelivery(object):
+    """Delivers replies in the order the requests were made, per stream.
+
+    Each request gets a sequence number in it's stream when it is made. Replies which are
+    completed out of order are held back until all earlier requests in their stream are done.
+
+    `deliver` is never called with the lock held: it generates a Tk event, which waits for the Tk
+    thread, and the Tk thread takes the lock to issue sequence numbers.
+    """
+
+    def __init__(self, deliver):
+        """Create a new `OrderedDelivery`.
+
+        :param deliver: Function called with (request, reply), in order.
+        """
+
+        self.deliver = deliver
+        self.lock = Lock()
+        self.issued = dict()
+        self.next = dict()
+        self.ready = dict()
+        # Items in delivery order, delivered by one thread at a time.
+        self.outgoing = deque()
+        self.delivering = False
+
+    def issue(self, stream):
+        """Return the next sequence number for a stream."""
+
+        with self.lock:
+            sequence = self.issued.get(stream, 0)
+            self.issued[stream] = sequence + 1
+            return sequence
+
+    def complete(self, stream, sequence, item):
+        """Mark a sequence number as done and deliver what can be delivered.
+
+        :param item: (request, reply) tuple, `None` when there is nothing to deliver.
+        """
+
+        with self.lock:
+            if sequence < self.next.get(stream, 0):
+                return  # From before a `clear()`.
+            ready = self.ready.setdefault(stream, dict())
+            ready[sequence] = item
+            position = self.next.get(stream, 0)
+            while position in ready:
+                item = ready.pop(position)
+                if item is not None:
+                    self.outgoing.append(item)
+                position += 1
+            if position == self.issued.get(stream) and not ready:
+                # All caught up: forget the stream.
+                del self.issued[stream]
+                self.next.pop(stream, None)
+                del self.ready[stream]
             else:
-                LOGGER.error(self, "Unable to perform request {api}/{endpoint}".format(api=api, endpoint=endpoint))
+                self.next[stream] = position
+            if self.delivering:
+                return  # Another thread is delivering, it takes our items as well.
+            self.delivering = True
+        self._deliver_outgoing()
 
-            if self.THROTTLE > 0:
-                self.interruptEvent.wait(self.THROTTLE)
-            self.queue.task_done()
+    def _deliver_outgoing(self):
+        """Deliver the outgoing items, without holding the lock."""
+
+        try:
+            while True:
+                with self.lock:
+                    if not self.outgoing:
+                        self.delivering = False
+                        return
+                    item = self.outgoing.popleft()
+                self.deliver(*item)
+        except Exception:
+            with self.lock:
+                self.delivering = False
+            raise
+
+    def clear(self):
+        """Forget everything in progress."""
+
+        with self.lock:
+            self.issued.clear()
+            self.next.clear()
+            self.ready.clear()
+            self.outgoing.clear()
 
 
 class ClearableQueue(Queue):
@@ -178,13 +917,109 @@ class ClearableQueue(Queue):
         """Clear all elements from the queue until we are empty."""
 
         LOGGER.log(self, LOG_DEBUG, "Clearing queue")
+        debug = LOGGER.is_enabled_for(self, LOG_DEBUG)
         try:
             while True:
-                LOGGER.log(self, LOG_DEBUG, "Queue Item Dropped: {item}".format(item=pformat(self.get_nowait())))
+                item = self.get_nowait()
+                if debug:
+                    LOGGER.log(self, LOG_DEBUG, "Queue Item Dropped: {item}", item=pformat(item))
         except Empty:
             LOGGER.log(self, LOG_DEBUG, "Yep, we're empty")
 
         LOGGER.log(self, LOG_DEBUG, "Queue cleared")
 
 
+class RequestQueue(ClearableQueue):
+    """A bounded priority queue for requests.
+
+    Items are put as (priority, request) and get returns the request with the lowest priority
+    value. Requests with the same priority are served first come, first served.
+    """
+
+    PRIORITY_STOP = -1
+
+    def __init__(self, max_requests=None):
+        """Initialize the queue.
+
+        :param max_requests: Maximum number of queued requests for `put_bounded()`.
+        """
+
+        ClearableQueue.__init__(self)
+        self.maxRequests = max_requests
+        self.logPrefix = 'RequestQueue > '
+
+    def _init(self, maxsize):
+        """Use a heap with [priority, sequence, request] entries."""
+
+        self.queue = []
+        self.sequence = itertools.count()
+
+    def _put(self, item):
+        """Push a (priority, request) item."""
+
+        (priority, request) = item
+        heapq.heappush(self.queue, [priority, next(self.sequence), request])
+
+    def _get(self):
+        """Pop the request with the lowest priority value."""
+
+        return heapq.heappop(self.queue)[2]
+
+    def put_bounded(self, request, priority):
+        """Queue a request without blocking.
+
+        When the queue is full, the lowest priority request is dropped: either a queued one or
+        this one if nothing queued has a lower priority.
+        :return: The dropped request or `None`.
+        """
+
+        with self.mutex:
+            dropped = None
+            if self.maxRequests and len(self.queue) >= self.maxRequests:
+                worst = max(self.queue)
+                if worst[0] <= priority:
+                    return request
+                self.queue.remove(worst)
+                heapq.heapify(self.queue)
+                self.unfinished_tasks -= 1
+                dropped = worst[2]
+
+            self._put((priority, request))
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return dropped
+
+    def promote(self, request, priority):
+        """Raise the priority of a queued request."""
+
+        with self.mutex:
+            for entry in self.queue:
+                if entry[2] == request and entry[0] > priority:
+                    entry[0] = priority
+                    heapq.heapify(self.queue)
+                    break
+
+    def cancel(self, predicate):
+        """Remove the queued requests for which predicate(priority, request) is true.
+
+        :return: list with the removed requests.
+        """
+
+        with self.mutex:
+            keep = []
+            cancelled = []
+            for entry in self.queue:
+                if entry[2] is not None and predicate(entry[0], entry[2]):
+                    cancelled.append(entry[2])
+                else:
+                    keep.append(entry)
+            if cancelled:
+                heapq.heapify(keep)
+                self.queue = keep
+                self.unfinished_tasks -= len(cancelled)
+                if not self.unfinished_tasks:
+                    self.all_tasks_done.notify_all()
+            return cancelled
+
+
 EDSM_QUERIES = EDSMQueries()
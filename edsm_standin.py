@@ -0,0 +1,292 @@
+"""
+Local stand-in for the EDSM api.
+
+Serves api-system-v1/bodies and api-status-v1/elite-server from fixtures, so
+`EDSMQueries` can be exercised without www.edsm.net or a Tk window. Point
+the queries at it with the `base_url` argument.
+
+The nasty parts of a real server can be injected:
+
+* latency: a function returning the delay of each reply, see `fixed_latency()`,
+  `uniform_latency()` and `lognormal_latency()`.
+* errors: a fraction of the requests is answered with a 500, 502 or 503.
+* throttled: a fraction of the requests is answered with a 429 and a Retry-After.
+* rate_limit: a budget of requests per window, reported in the X-Rate-Limit headers
+  like EDSM does. Requests over budget get a 429.
+* drip: replies are sent a few bytes at a time.
+
+Usage: python edsm_standin.py [port]
+
+This module does not depend on EDMC.
+"""
+
+from __future__ import print_function
+import BaseHTTPServer
+import glob
+import json
+import math
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlsplit
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+ERROR_STATUSES = (500, 502, 503)
+
+
+def fixed_latency(seconds):
+    """Return a latency function always waiting `seconds`."""
+
+    return lambda _random: seconds
+
+
+def uniform_latency(low, high):
+    """Return a latency function waiting between `low` and `high` seconds."""
+
+    return lambda rnd: rnd.uniform(low, high)
+
+
+def lognormal_latency(median, sigma=0.5):
+    """Return a latency function with a long tail, like a real server: half of the replies take less than `median`."""
+
+    return lambda rnd: rnd.lognormvariate(math.log(median), sigma)
+
+
+def load_fixtures(directory=FIXTURES_DIR):
+    """Load the edsm-system-body-*.json fixtures.
+
+    :return: dict of lower cased system name to bodies reply.
+    """
+
+    fixtures = dict()
+    for filename in glob.glob(os.path.join(directory, 'edsm-system-body-*.json')):
+        with open(filename, 'r') as fixture:
+            reply = json.load(fixture)
+        fixtures[reply['name'].lower()] = reply
+    return fixtures
+
+
+class StandInEDSM(object):  # pylint: disable=too-many-instance-attributes
+    """A local EDSM api server."""
+
+    def __init__(self, fixtures=None, template=None, latency=None, errors=0.0, throttled=0.0, retry_after=1,
+                 rate_limit=None, drip=None, seed=None, address=('127.0.0.1', 0)):
+        """Create a new `StandInEDSM`. It is started with `start()`.
+
+        :param fixtures: dict of lower cased system name to bodies reply. Defaults to `load_fixtures()`.
+        :param template: Name of a fixture system served, renamed, for systems without a fixture. Without one
+            they get an empty reply, like EDSM does for unknown systems.
+        :param latency: Latency function, taking a `random.Random`. No latency by default.
+        :param errors: Fraction of requests answered with a server error.
+        :param throttled: Fraction of requests answered with a 429.
+        :param retry_after: Retry-After seconds sent with a 429.
+        :param rate_limit: (requests, window seconds) budget, `None` for no budget.
+        :param drip: (bytes, seconds): send replies this many bytes at a time, with a pause in between.
+        :param seed: Seed for the random latencies and faults.
+        :param address: (host, port) to listen on. Port 0 picks a free port.
+        """
+
+        self.fixtures = fixtures if fixtures is not None else load_fixtures()
+        self.template = self.fixtures[template.lower()] if template is not None else None
+        self.latency = latency
+        self.errors = errors
+        self.throttled = throttled
+        self.retryAfter = retry_after
+        self.rateLimit = rate_limit
+        self.drip = drip
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.budget = float(rate_limit[0]) if rate_limit is not None else None
+        self.budgetUpdated = time.time()
+        self.server = _Server(address, _Handler)
+        self.server.standIn = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        """Return the url to pass as `base_url` to `EDSMQueries`."""
+
+        return 'http://{host}:{port}'.format(host=self.server.server_address[0], port=self.server.server_address[1])
+
+    def start(self):
+        """Serve requests in a background thread."""
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name='EDSM stand-in')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+
+    def __enter__(self):
+        """Start the server."""
+
+        return self.start()
+
+    def __exit__(self, *_args):
+        """Stop the server."""
+
+        self.stop()
+
+    def reply(self, path, params):
+        """Decide how to answer a request.
+
+        :param path: Path of the request, like '/api-system-v1/bodies'.
+        :param params: dict of request parameters.
+        :return: (delay, status, headers, body)
+        """
+
+        with self.lock:
+            delay = self.latency(self.random) if self.latency is not None else 0.0
+            fault = self.random.random()
+            error = self.random.choice(ERROR_STATUSES)
+            headers = self._take_budget()
+
+        if headers.get('Retry-After') is not None:
+            return self._count(delay, 429, headers, {})
+        if fault < self.errors:
+            return self._count(delay, error, headers, {})
+        if fault < self.errors + self.throttled:
+            headers['Retry-After'] = str(self.retryAfter)
+            return self._count(delay, 429, headers, {})
+
+        if path == '/api-system-v1/bodies':
+            return self._count(delay, 200, headers, self._bodies(params.get('systemName')))
+        if path == '/api-status-v1/elite-server':
+            return self._count(delay, 200, headers, {
+                'lastUpdate': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+                'type': 'success',
+                'message': 'OK',
+                'status': 2,
+            })
+        return self._count(delay, 404, headers, {})
+
+    def _bodies(self, system):
+        """Return the bodies reply for a system."""
+
+        if not system:
+            return {}
+        reply = self.fixtures.get(system.lower())
+        if reply is None and self.template is not None:
+            reply = dict(self.template, name=system)
+        return reply if reply is not None else {}
+
+    def _take_budget(self):
+        """Take a request from the rate limit budget. Called with the lock held.
+
+        :return: dict with the rate limit headers, with a Retry-After when there is no budget left.
+        """
+
+        if self.rateLimit is None:
+            return dict()
+
+        (limit, window) = self.rateLimit
+        rate = float(limit) / window
+        now = time.time()
+        self.budget = min(float(limit), self.budget + (now - self.budgetUpdated) * rate)
+        self.budgetUpdated = now
+
+        headers = dict()
+        if self.budget < 1.0:
+            headers['Retry-After'] = str(int(math.ceil((1.0 - self.budget) / rate)))
+        else:
+            self.budget -= 1.0
+        headers['X-Rate-Limit-Limit'] = str(limit)
+        headers['X-Rate-Limit-Remaining'] = str(int(self.budget))
+        headers['X-Rate-Limit-Reset'] = str(int(math.ceil((limit - self.budget) / rate)))
+        return headers
+
+    def _count(self, delay, status, headers, body):
+        """Count the reply by status and return it."""
+
+        with self.lock:
+            self.stats[status] += 1
+        return (delay, status, headers, json.dumps(body))
+
+
+class _Server(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server, `standIn` decides on the replies."""
+
+    daemon_threads = True
+    standIn = None
+
+    def handle_error(self, request, client_address):
+        """Print the error, unless the client just hung up."""
+
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the requests of one connection."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer a GET request."""
+
+        url = urlsplit(self.path)
+        self._answer(url.path, parse_qs(url.query))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Answer a POST request, the parameters are in the form encoded body."""
+
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self._answer(urlsplit(self.path).path, parse_qs(self.rfile.read(length)))
+
+    def _answer(self, path, query):
+        """Send the reply the stand-in decides on."""
+
+        params = dict((key, values[-1]) for key, values in query.items())
+        (delay, status, headers, body) = self.server.standIn.reply(path, params)
+        time.sleep(delay)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        drip = self.server.standIn.drip
+        if drip is None:
+            self.wfile.write(body)
+            return
+        (size, pause) = drip
+        for offset in range(0, len(body), size):
+            self.wfile.write(body[offset:offset + size])
+            self.wfile.flush()
+            time.sleep(pause)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Be quiet."""
+
+
+def main(args):
+    """Serve the fixtures until interrupted."""
+
+    stand_in = StandInEDSM(template='Sol', address=('127.0.0.1', int(args[0]) if args else 0))
+    print("Serving EDSM fixtures on {url}".format(url=stand_in.base_url))
+    try:
+        stand_in.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stand_in.server.server_close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
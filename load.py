@@ -1,5 +1,6 @@
 """Plugin to help with finding planets with the materials you need while exploring."""
 
+import os
 import sys
 import Tkinter as tk
 from pprint import pformat
@@ -11,12 +12,22 @@ from monitor import monitor
 import plug
 
 # Own materializer stuff
+from body_predicates import BodyPredicateSyntaxError, body_attributes_from_scan, compile_predicate
+from edsm_async import AsyncEDSMQueries
+from edsm_cache import open_cache
+from edsm_metrics import MetricsDump
+from edsm_projection import BODIES_PROJECTION
 from edsm_queries import EDSM_QUERIES
-from material_api import LOGGER, LOG_INFO, LOG_DEBUG
+from material_api import LOGGER, LOG_INFO, LOG_DEBUG, LOG_WRITER
 from material_api import FIELD_BODY_NAME, FIELD_EVENT, FIELD_LANDABLE, FIELD_MATERIALS, FIELD_SCAN_TYPE
 from material_api import VALUE_EVENT_FSDJUMP, VALUE_EVENT_SCAN, VALUE_SCAN_TYPE_DETAILED
 from material_api import Materials
+from material_pipeline import BodiesMatcher, MatchSnapshot, SystemMatches
 from material_ui import MaterialFilterConfigFrame, MaterialFilterListConfigTranslator, MaterialFilterMatchesFrame
+from material_ui import MaterialWeightConfigTranslator
+from quantile_sketch import SketchSet
+from rate_limiter import TokenBucket
+from threshold_tables import load_thresholds
 from version import VERSION
 
 
@@ -26,8 +37,16 @@ this = sys.modules[__name__]  # For holding module globals
 # LOGGER.logLevel = LOG_DEBUG
 this.logPrefix = "Materializer Plugin > "
 
+SKETCHES_FILE = 'materializer-sketches.json'
+EDSM_CACHE_FILE = 'materializer-edsm-cache.sqlite'
+RATE_LIMIT_FILE = 'materializer-rate-limit.json'
+EDSM_METRICS_FILE = 'materializer-edsm-metrics.json'
+SUGGEST_QUANTILE = 0.95
+SUGGEST_MINIMUM_BODIES = 20
+
 # Based on https://tinyurl.com/mexgpnb
-DEFAULT_THRESHOLDS = {
+# Used when no thresholds.json has been generated with `invoke thresholds`.
+BUILTIN_THRESHOLDS = {
     Materials.ANTIMONY: 1.4,
     Materials.ARSENIC: 2.6,
     Materials.CADMIUM: 3.0,
@@ -57,6 +76,25 @@ DEFAULT_THRESHOLDS = {
 }
 
 
+def load_default_thresholds(filename):
+    """Load the default thresholds from a generated data file, falling back to `BUILTIN_THRESHOLDS`."""
+
+    loaded = load_thresholds(filename)
+    if loaded is None:
+        return BUILTIN_THRESHOLDS
+
+    thresholds = dict(BUILTIN_THRESHOLDS)
+    for name, threshold in loaded.items():
+        material = Materials.by_name(name)
+        if material is not None:
+            thresholds[material] = threshold
+    return thresholds
+
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+DEFAULT_THRESHOLDS = load_default_thresholds(THRESHOLDS_FILE)
+
+
 def plugin_prefs(parent, _cmdr, _is_beta):
     """Return a Tk Frame for adding to the EDMC settings dialog."""
 
@@ -66,6 +104,7 @@ def plugin_prefs(parent, _cmdr, _is_beta):
         this.prefsFrame,
         DEFAULT_THRESHOLDS,
         this.materialFilters,
+        this.materialWeights,
     )
     this.materialFiltersPreferences.grid(column=0, row=0, sticky=tk.N + tk.S + tk.W)
 
@@ -83,8 +122,34 @@ def prefs_changed(_cmdr, _is_beta):
     """
 
     this.materialFilters = this.materialFiltersPreferences.get_material_filters()
-    this.materialMatchesFrame.update_filters(this.materialFilters)
-    config.set('material_filters', MaterialFilterListConfigTranslator.translate_to_settings(this.materialFilters))
+    this.materialWeights = this.materialFiltersPreferences.get_material_weights()
+    this.sortByScore = this.sortByScoreVar.get()
+    # Rules with a syntax error are kept in the settings as they are, a typo should not delete them.
+    this.invalidRules = []
+    this.materialRules = MaterialFilterListConfigTranslator.translate_rules_from_settings(
+        [line.strip() for line in this.rulesText.get('1.0', tk.END).splitlines() if line.strip()],
+        this.invalidRules,
+    )
+    this.materialMatchesFrame.update_filters(
+        this.materialFilters,
+        this.materialWeights,
+        bool(this.sortByScore),
+        this.materialRules,
+    )
+    filters_settings = MaterialFilterListConfigTranslator.translate_to_settings(this.materialFilters)
+    rules_settings = MaterialFilterListConfigTranslator.translate_rules_to_settings(this.materialRules)
+    config.set('material_filters', filters_settings + rules_settings + this.invalidRules)
+    config.set('material_weights', MaterialWeightConfigTranslator.translate_to_settings(this.materialWeights))
+    config.set('material_sort_by_score', this.sortByScore)
+    this.bodyFilter = this.bodyFilterVar.get().strip()
+    this.bodyPredicate = load_body_predicate(this.bodyFilter)
+    config.set('body_filter', this.bodyFilter)
+    if this.bodiesMatcher is not None:
+        this.bodiesMatcher.set_snapshot(create_match_snapshot())
+        # The frame does not keep the bodies matched on the worker: match them again, they come from the cache.
+        system = this.materialMatchesFrame.currentSystem
+        if system is not None and system == this.lastEDSMScan:
+            this.edsmQueries.request_get(EDSM_QUERIES.API_SYSTEM_V1, 'bodies', systemName=system)
 
 
 def plugin_start(_plugin_dir):
@@ -106,17 +171,54 @@ def plugin_start(_plugin_dir):
     raw_material_filters = [x for x in material_filters_config if x]
     # Load known filters
     this.materialFilters = MaterialFilterListConfigTranslator.translate_from_settings(raw_material_filters)
+    this.invalidRules = []
+    this.materialRules = MaterialFilterListConfigTranslator.translate_rules_from_settings(
+        raw_material_filters,
+        this.invalidRules,
+    )
+    this.materialWeights = MaterialWeightConfigTranslator.translate_from_settings(
+        [x for x in config.get('material_weights') or [] if x],
+    )
+    this.sortByScore = config.getint('material_sort_by_score')
+    this.bodyFilter = config.get('body_filter') or ''
+    this.bodyPredicate = load_body_predicate(this.bodyFilter)
 
     #                |
     # . . .,---.,---.|__/ ,---.,---.
     # | | ||   ||    |  \ |---'|
     # `-'-'`---'`    `   ``---'`
     this.lastEDSMScan = None
-    this.edsmQueries = EDSM_QUERIES
+    # The event loop engine is an alternative to the worker threads, enable it with the materializer_event_loop setting.
+    this.edsmQueries = AsyncEDSMQueries() if config.getint('materializer_event_loop') else EDSM_QUERIES
+    this.edsmQueries.set_cache(open_cache(os.path.join(config.app_dir, EDSM_CACHE_FILE)))
+    this.edsmQueries.set_rate_limiter(TokenBucket.load(os.path.join(config.app_dir, RATE_LIMIT_FILE)))
+    # Big systems have huge bodies replies, keep only what we use. Other plugins receive the same records.
+    this.edsmQueries.set_projection(EDSM_QUERIES.API_SYSTEM_V1, 'bodies', BODIES_PROJECTION)
+
+    # Material distributions observed in earlier sessions
+    this.materialSketches = SketchSet.load(os.path.join(config.app_dir, SKETCHES_FILE))
+
+    # Matching EDSM bodies on the EDSM worker instead of the Tk thread is enabled with the
+    # materializer_worker_matching setting. Other plugins then receive `SystemMatches` for bodies requests.
+    this.bodiesMatcher = None
+    if config.getint('materializer_worker_matching'):
+        this.bodiesMatcher = BodiesMatcher(create_match_snapshot(), this.materialSketches)
+        this.edsmQueries.set_processor(EDSM_QUERIES.API_SYSTEM_V1, 'bodies', this.bodiesMatcher)
+
+    # The EDSM request metrics are written every materializer_metrics_interval seconds, when it is set.
+    this.metricsDump = None
+    metrics_interval = config.getint('materializer_metrics_interval')
+    if metrics_interval > 0:
+        this.metricsDump = MetricsDump(this.edsmQueries.metrics_snapshot,
+                                       os.path.join(config.app_dir, EDSM_METRICS_FILE), metrics_interval).start()
+
+    # Besides EDMC's own log, optionally keep a rotating log file of our own.
+    if config.getint('materializer_log_file'):
+        LOG_WRITER.set_file(os.path.join(config.app_dir, 'materializer.log'))
 
     LOGGER.log(this, LOG_INFO, 'Plugin Materializer (version: {version}) enabled...'.format(version=VERSION))
     for f in this.materialFilters:
-        LOGGER.debug(this, '  Filter used: {filter}'.format(filter=f.__str__()))
+        LOGGER.debug(this, '  Filter used: {filter}', filter=f)
 
     return 'Materializer'
 
@@ -125,6 +227,24 @@ def plugin_stop():
     """Stop and cleanup all running threads."""
 
     this.edsmQueries.stop()
+    counters = this.edsmQueries.counters
+    LOGGER.info(this, "EDSM: {requests} requests, {not_modified} not modified, {received} kB received for {decoded} kB",
+                requests=counters['requests'], not_modified=counters['notModified'],
+                received=counters['bytesReceived'] // 1024, decoded=counters['bytesDecoded'] // 1024)
+    if this.metricsDump is not None:
+        this.metricsDump.stop(1.0)
+    if this.edsmQueries.cache is not None:
+        this.edsmQueries.cache.close()
+        this.edsmQueries.set_cache(None)
+    try:
+        this.edsmQueries.rateLimiter.save(os.path.join(config.app_dir, RATE_LIMIT_FILE))
+    except (IOError, OSError) as err:
+        LOGGER.error(this, "Unable to save the EDSM rate limit: {err}", err=err)
+    try:
+        this.materialSketches.save(os.path.join(config.app_dir, SKETCHES_FILE))
+    except (IOError, OSError) as err:
+        LOGGER.error(this, "Unable to save material statistics: {err}", err=err)
+    LOG_WRITER.stop(1.0)
 
 
 def plugin_app(parent):
@@ -137,7 +257,13 @@ def plugin_app(parent):
 
     parent.bind('<<EDSMCallback>>', _edsm_callback_received)
     this.edsmQueries.start(parent)
-    this.materialMatchesFrame = MaterialFilterMatchesFrame(parent, this.materialFilters)
+    this.materialMatchesFrame = MaterialFilterMatchesFrame(
+        parent,
+        this.materialFilters,
+        this.materialWeights,
+        bool(this.sortByScore),
+        this.materialRules,
+    )
     return this.materialMatchesFrame
 
 
@@ -145,6 +271,8 @@ def journal_entry(_cmdr, _is_beta, system, _station, entry, _state):
     """Handle the events."""
 
     if entry[FIELD_EVENT] == VALUE_EVENT_FSDJUMP:
+        this.materialSketches.forget_bodies()
+        this.edsmQueries.set_current_system(system)
         this.materialMatchesFrame.jump_system(system)
 
     elif entry[FIELD_EVENT] == VALUE_EVENT_SCAN \
@@ -152,6 +280,9 @@ def journal_entry(_cmdr, _is_beta, system, _station, entry, _state):
             and FIELD_LANDABLE in entry \
             and entry[FIELD_LANDABLE] is True:
 
+        this.materialSketches.observe(entry[FIELD_MATERIALS], entry[FIELD_BODY_NAME])
+        if this.bodyPredicate is not None and not this.bodyPredicate.matches(body_attributes_from_scan(entry)):
+            return
         this.materialMatchesFrame.process_filter_planet_materials(
             system,
             str(entry[FIELD_BODY_NAME]),
@@ -174,7 +305,7 @@ def edsm_notify_system(reply):
     When an existing system is encountered, trigger an update from EDSM.
     :param reply:
     """
-    LOGGER.log(this, LOG_DEBUG, "Processing edsm notify event: {event}".format(event=pformat(reply)))
+    LOGGER.log(this, LOG_DEBUG, lambda: "Processing edsm notify event: {event}".format(event=pformat(reply)))
     if not reply:
         return
     elif reply['msgnum'] // 100 not in (1, 4):
@@ -197,7 +328,17 @@ def edsm_querier_response_api_system_v1_bodies(request, response):
     """Parse an edsm querier response for the api-system-v1  / bodies call."""
 
     (_api, _endpoint, _method, _params) = request
-    if response:
+    if isinstance(response, SystemMatches):
+        # Already matched on the worker.
+        this.currentState = {
+            "system": response.system,
+            "body_count": response.bodyCount,
+            "scanned": response.scanned,
+        }
+        this.lastEDSMScan = response.system
+        if response.matches:
+            this.materialMatchesFrame.process_system_matches(response.system, response.matches)
+    elif response:
         system = response['name']
         this.currentState = {
             "system": system,
@@ -209,10 +350,15 @@ def edsm_querier_response_api_system_v1_bodies(request, response):
         bodies = response.get('bodies', None)
         if bodies:
             for body in bodies:
-                # LOGGER.debug(this, "BODY: {name} -> {dump}".format(name=body["name"], dump=pformat(body)))
-                planet = body["name"]
-                materials = body.get("materials", None)
-                this.materialMatchesFrame.process_filter_planet_materials(system, planet, materials)
+                this.materialSketches.observe(body.get("materials", None), body["name"])
+            # The bodies carry the attributes with the names the predicate uses. Checking them is cheaper than
+            # matching the materials, so drop the bodies we are not interested in first.
+            if this.bodyPredicate is not None:
+                bodies = [body for body in bodies if this.bodyPredicate.matches(body)]
+            this.materialMatchesFrame.process_filter_system_bodies(
+                system,
+                [(body["name"], body.get("materials", None)) for body in bodies],
+            )
     return True
 
 
@@ -222,10 +368,26 @@ def edsm_querier_response_api_system_v1_bodies(request, response):
 # `   '`---'`---'|---'`---'`    `---'
 #                |
 
-def create_material_filter_prefs(parent, defaults, filters):
+def load_body_predicate(expression):
+    """Compile the body filter. An invalid filter is logged and ignored."""
+
+    try:
+        return compile_predicate(expression)
+    except BodyPredicateSyntaxError as err:
+        LOGGER.error(this, "Invalid body filter: {err}", err=err)
+        return None
+
+
+def create_match_snapshot():
+    """Take a snapshot of the filters, rules and body filter for the `BodiesMatcher`."""
+
+    return MatchSnapshot(this.materialFilters, this.materialRules, this.bodyPredicate)
+
+
+def create_material_filter_prefs(parent, defaults, filters, weights=None):
     """Create a new MaterialFilterConfigFrame."""
 
-    return MaterialFilterConfigFrame(parent, defaults, filters)
+    return MaterialFilterConfigFrame(parent, defaults, filters, weights)
 
 
 def create_options_prefs(parent):
@@ -245,11 +407,83 @@ def create_options_prefs(parent):
         frame, wrap=200, justify=tk.LEFT,
         text="You can reset to defaults by clearing an entry and (dis)/enable it (again).",
     )
-    lbl.grid()
+    lbl.grid(sticky=tk.W)
+
+    this.sortByScoreVar = tk.IntVar(value=getattr(this, 'sortByScore', 0))
+    sort_by_score = tk.Checkbutton(
+        frame, text="Show the best scoring bodies first", variable=this.sortByScoreVar, onvalue=1, offvalue=0,
+    )
+    sort_by_score.grid(sticky=tk.W)
+
+    lbl_weights = tk.Label(
+        frame, wrap=200, justify=tk.LEFT,
+        text="Scores add up how far each material exceeds its threshold, times its weight (x).",
+    )
+    lbl_weights.grid(sticky=tk.W)
+
+    lbl_body_filter = tk.Label(
+        frame, wrap=200, justify=tk.LEFT,
+        text="Only show bodies matching, for example: gravity < 0.5 and distanceToArrival < 5000",
+    )
+    lbl_body_filter.grid(sticky=tk.W)
+    this.bodyFilterVar = tk.StringVar(value=getattr(this, 'bodyFilter', ''))
+    body_filter = tk.Entry(frame, textvariable=this.bodyFilterVar, width=30)
+    body_filter.grid(sticky=tk.W + tk.E)
+
+    lbl_rules = tk.Label(
+        frame, wrap=200, justify=tk.LEFT,
+        text="Rules, one per line. For example ALL(Po>=1.1;Y>=2) or 2OF(Sb>=1.4;Tc>=1.4;Ru>=2.5).",
+    )
+    lbl_rules.grid(sticky=tk.W)
+    this.rulesText = tk.Text(frame, width=30, height=4)
+    rules_settings = MaterialFilterListConfigTranslator.translate_rules_to_settings(getattr(this, 'materialRules', []))
+    rules_settings.extend(getattr(this, 'invalidRules', []))
+    this.rulesText.insert(tk.END, "\n".join(rules_settings))
+    this.rulesText.grid(sticky=tk.W + tk.E)
+    if getattr(this, 'bodiesMatcher', None) is not None:
+        # EDSM bodies are matched against a copy of the rules on the worker.
+        this.bodiesMatcher.snapshot.merge_statistics(this.materialRules)
+    for rule in getattr(this, 'materialRules', []):
+        if rule.evaluations:
+            lbl_hits = tk.Label(
+                frame, wrap=200, justify=tk.LEFT,
+                text="{rule}: {hits}/{evaluations} bodies".format(
+                    rule=rule, hits=rule.hits, evaluations=rule.evaluations,
+                ),
+            )
+            lbl_hits.grid(sticky=tk.W)
+
+    sketches = getattr(this, 'materialSketches', None)
+    if sketches is not None:
+        observed = max([len(sketch) for sketch in sketches.sketches.values()] or [0])
+        suggest = tk.Button(
+            frame, text="Suggest top {top:.0f}% thresholds".format(top=(1 - SUGGEST_QUANTILE) * 100),
+            command=suggest_thresholds,
+        )
+        suggest.grid(sticky=tk.W)
+        lbl_observed = tk.Label(
+            frame, wrap=200, justify=tk.LEFT,
+            text="Based on up to {observed} observed bodies per material.".format(observed=observed),
+        )
+        lbl_observed.grid(sticky=tk.W)
+
     frame.grid()
     return wrap_frame
 
 
+def suggest_thresholds():
+    """Fill in the thresholds only the top bodies observed so far exceed."""
+
+    thresholds = dict()
+    for name, value in this.materialSketches.quantiles(SUGGEST_QUANTILE, SUGGEST_MINIMUM_BODIES).items():
+        material = Materials.by_name(name)
+        if material is not None:
+            thresholds[material] = round(value, 2)
+
+    LOGGER.info(this, "Suggesting thresholds for {count} materials", count=len(thresholds))
+    this.materialFiltersPreferences.set_thresholds(thresholds)
+
+
 def _edsm_callback_received(_event=None):
     """Proxy callbacks to plugins that support them.
 
@@ -265,39 +499,39 @@ def _edsm_callback_received(_event=None):
     If any of these returns `True`, the remaining more generic methods will be skipped for your plugin.
     """
 
-    LOGGER.debug(this, 'edsm callback received')
-    while True:
-        response = this.edsmQueries.get_response()
-        if response is None:
-            break
-
-        # LOGGER.debug(this, 'response: {resp}'.format(resp=pformat(response)))
-        (request, reply) = response
+    responses = this.edsmQueries.get_responses()
+    LOGGER.debug(this, 'edsm callback received for {count} responses', count=len(responses))
+    debug = LOGGER.is_enabled_for(this, LOG_DEBUG)
+    # (api, endpoint): [(plugin, [callbacks])], looked up once for the whole batch.
+    handlers = dict()
+    for (request, reply) in responses:
+        # LOGGER.debug(this, 'response: {resp}'.format(resp=pformat(reply)))
         (api, endpoint, _method, _request_params) = request
 
-        api_callbacks = [
-            'edsm_querier_response_{api}_{endpoint}'.format(
-                api=api.replace('-', '_'),
-                endpoint=endpoint,
-            ),
-            'edsm_querier_response_{api}'.format(api=api.replace('-', '_')),
-            'edsm_querier_response',
-        ]
-
-        for plugin in plug.PLUGINS:
-            for api_callback in api_callbacks:
-
-                LOGGER.debug(this, "checking for function: '{func}' on {plugin}".format(
-                    func=api_callback,
-                    plugin=plugin.name,
-                ))
-                LOGGER.debug(this, "plugin: {pl}".format(pl=pformat(plugin)))
-                if hasattr(plugin.module, api_callback):
-                    response = plug.invoke(plugin.name, None, api_callback, request, reply)
-                    LOGGER.debug(this, 'calling {func} on {plugin}: {response}'.format(
-                        func=api_callback,
-                        plugin=plugin,
-                        response=str(response),
-                    ))
-                    if response is True:
-                        break
+        if (api, endpoint) not in handlers:
+            api_callbacks = [
+                'edsm_querier_response_{api}_{endpoint}'.format(
+                    api=api.replace('-', '_'),
+                    endpoint=endpoint,
+                ),
+                'edsm_querier_response_{api}'.format(api=api.replace('-', '_')),
+                'edsm_querier_response',
+            ]
+            plugin_callbacks = []
+            for plugin in plug.PLUGINS:
+                if debug:
+                    LOGGER.debug(this, "checking for functions: '{funcs}' on {plugin}", funcs=api_callbacks,
+                                 plugin=plugin.name)
+                    LOGGER.debug(this, "plugin: {pl}", pl=pformat(plugin))
+                callbacks = [api_callback for api_callback in api_callbacks if hasattr(plugin.module, api_callback)]
+                if callbacks:
+                    plugin_callbacks.append((plugin, callbacks))
+            handlers[(api, endpoint)] = plugin_callbacks
+
+        for (plugin, callbacks) in handlers[(api, endpoint)]:
+            for api_callback in callbacks:
+                response = plug.invoke(plugin.name, None, api_callback, request, reply)
+                LOGGER.debug(this, 'calling {func} on {plugin}: {response}', func=api_callback, plugin=plugin,
+                             response=response)
+                if response is True:
+                    break
@@ -0,0 +1,212 @@
+"""
+Background writer for log records.
+
+The LogWriter runs in it's own thread so logging from the Tk main thread or
+the EDSM worker never blocks on console or file I/O. Records are queued in a
+bounded queue and written out in batches. When the queue is full, records
+are dropped and counted instead of blocking the caller.
+"""
+
+from __future__ import print_function
+import os
+import sys
+from Queue import Queue, Empty, Full
+from threading import Lock, Thread
+
+
+class LogWriter(object):
+    """Writes log records to stdout and/or a rotating file from a background thread."""
+
+    def __init__(self, max_queue=1000, batch_size=100, stdout=True, filename=None, max_bytes=1024 * 1024,
+                 backup_count=3):
+        """Initialize the `LogWriter`.
+
+        :param max_queue: Maximum number of records waiting to be written.
+        :param batch_size: Maximum number of records written in one go.
+        :param stdout: Write records to `sys.stdout`.
+        :param filename: Write records to this file as well. See `set_file()`.
+        :param max_bytes: Rotate the file when it would grow beyond this size.
+        :param backup_count: Number of rotated files to keep.
+        """
+
+        self.queue = Queue(max_queue)
+        self.batchSize = batch_size
+        self.stdout = stdout
+        self.filename = None
+        self.maxBytes = max_bytes
+        self.backupCount = backup_count
+        self.dropped = 0
+        self.droppedReported = 0
+        self.thread = None
+        # `stop()` queued the end of the thread, which may still be running: no new thread is started until it exits.
+        self.stopping = False
+        self.lock = Lock()
+        self.file = None
+        if filename is not None:
+            self.set_file(filename)
+
+    def set_file(self, filename):
+        """Write records to a (rotating) file. `None` disables writing to a file."""
+
+        self.queue.put((self._set_file, filename))
+        self._start()
+
+    def write(self, record):
+        """Queue a record. Never blocks: when the queue is full the record is dropped."""
+
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+        self._start()
+
+    def flush(self):
+        """Block until all queued records have been written."""
+
+        if self.thread is not None:
+            self.queue.join()
+
+    def stop(self, timeout=None):
+        """Write out the remaining records and stop the thread.
+
+        When the thread does not exit within `timeout`, it keeps the file until it does. Call `stop()` again to
+        wait for it; records written in the meantime are queued.
+        :param timeout: Maximum number of seconds to wait for the thread.
+        """
+
+        with self.lock:
+            thread = self.thread
+            stopping = self.stopping
+        if thread is None:
+            return
+
+        if not stopping:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except Full:
+                return
+            with self.lock:
+                self.stopping = True
+        thread.join(timeout)
+        if thread.isAlive():
+            return
+        with self.lock:
+            self.thread = None
+            self.stopping = False
+
+    def _start(self):
+        """Start the writer thread if it is not running. A stopped thread is only replaced once it has exited."""
+
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.worker, name='Materializer log writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def worker(self):
+        """Wait for records and write them out in batches."""
+
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batchSize:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            lines = []
+            for record in batch:
+                if record is None:
+                    running = False
+                elif isinstance(record, tuple):
+                    self._write(lines)
+                    lines = []
+                    record[0](record[1])
+                else:
+                    lines.append(record)
+
+            with self.lock:
+                dropped = self.dropped - self.droppedReported
+                self.droppedReported = self.dropped
+            if dropped:
+                lines.append("LogWriter > WARNING: dropped {dropped} log messages".format(dropped=dropped))
+
+            self._write(lines)
+            for _record in batch:
+                self.queue.task_done()
+
+        self._set_file(None)
+
+    def _write(self, lines):
+        """Write lines to all outputs."""
+
+        if not lines:
+            return
+
+        data = "\n".join(lines) + "\n"
+        if self.stdout:
+            try:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            except (IOError, ValueError):
+                pass
+
+        if self.file is not None:
+            try:
+                if self.file.tell() + len(data) > self.maxBytes:
+                    self._rotate()
+                self.file.write(data)
+                self.file.flush()
+            except (IOError, OSError, ValueError) as err:
+                print("LogWriter > ERROR: Unable to write to {file}: {err}".format(file=self.filename, err=err))
+                self._set_file(None)
+
+    def _set_file(self, filename):
+        """Close the current file and open a new one. Only call from the worker thread.
+
+        When the file can not be opened, the error is reported and we carry on without a file.
+        """
+
+        if self.file is not None:
+            try:
+                self.file.close()
+            except (IOError, OSError):
+                pass
+            self.file = None
+
+        self.filename = filename
+        if filename is not None:
+            try:
+                self.file = open(filename, 'a')
+            except (IOError, OSError) as err:
+                print("LogWriter > ERROR: Unable to open {file}: {err}".format(file=filename, err=err))
+
+    def _rotate(self):
+        """Rotate the log files: file.log => file.log.1 => file.log.2 ...
+
+        :raises IOError, OSError: when the files can not be renamed or opened. There is no file then.
+        """
+
+        self.file.close()
+        self.file = None
+        for index in range(self.backupCount - 1, 0, -1):
+            source = "{name}.{index}".format(name=self.filename, index=index)
+            if os.path.exists(source):
+                target = "{name}.{index}".format(name=self.filename, index=index + 1)
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+
+        if self.backupCount > 0:
+            target = "{name}.1".format(name=self.filename)
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(self.filename, target)
+            self.file = open(self.filename, 'a')
+        else:
+            self.file = open(self.filename, 'w')
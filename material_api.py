@@ -2,12 +2,21 @@
 
 from __future__ import print_function
 import inspect
+import weakref
 import Tkinter as tk
 from pprint import pformat
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
+
 # EDMC components
 from l10n import Locale
 
+# Own materializer stuff
+from log_writer import LogWriter
+
 
 LOG_ERROR = 2
 LOG_WARN = 3
@@ -43,37 +52,61 @@ VALUE_SCAN_TYPE_DETAILED = "Detailed"
 class Logger(object):
     """Represent a logger."""
 
-    def __init__(self, log_level=LOG_INFO, log_prefix=''):
-        """Initialize the logger."""
+    def __init__(self, log_level=LOG_INFO, log_prefix='', writer=None):
+        """Initialize the logger.
+
+        :param log_level: Default log level.
+        :param log_prefix: Default log prefix.
+        :param writer: `LogWriter` to hand the records to. Without one, records are printed synchronously.
+        """
 
         self.logLevel = log_level
         self.logPrefix = log_prefix
+        self.writer = writer
 
-    def debug(self, caller, message):
+    def debug(self, caller, message, *args, **kwargs):
         """Write a debug message for a caller."""
-        self.log(caller, LOG_DEBUG, message)
+        self.log(caller, LOG_DEBUG, message, *args, **kwargs)
 
-    def info(self, caller, message):
+    def info(self, caller, message, *args, **kwargs):
         """Write a info message for a caller."""
-        self.log(caller, LOG_INFO, message)
+        self.log(caller, LOG_INFO, message, *args, **kwargs)
 
-    def warn(self, caller, message):
+    def warn(self, caller, message, *args, **kwargs):
         """Write a warn message for a caller."""
-        self.log(caller, LOG_WARN, message)
+        self.log(caller, LOG_WARN, message, *args, **kwargs)
 
-    def error(self, caller, message):
+    def error(self, caller, message, *args, **kwargs):
         """Write a error message for a caller."""
-        self.log(caller, LOG_ERROR, message)
+        self.log(caller, LOG_ERROR, message, *args, **kwargs)
 
-    def log(self, caller, level, message):
-        """Log a message for a caller."""
+    def get_level(self, caller):
+        """Return the log level in effect for a caller."""
+
+        log_level = getattr(caller, 'logLevel', None)
+        if log_level is None:
+            return self.logLevel
+        return log_level
+
+    def is_enabled_for(self, caller, level):
+        """
+        Check if a message of a level would be logged for a caller.
 
-        log_level = self.logLevel
-        log_prefix = self.logPrefix
-        if hasattr(caller, 'logLevel') and caller.logLevel is not None:
-            log_level = caller.logLevel
-        if hasattr(caller, 'logPrefix') and caller.logPrefix is not None:
-            log_prefix = caller.logPrefix
+        Use this to guard expensive debug output (`pformat` and the like) in hot paths.
+        """
+
+        return level <= self.get_level(caller)
+
+    def log(self, caller, level, message, *args, **kwargs):
+        """Log a message for a caller.
+
+        Nothing is formatted unless the level is enabled for the caller.
+
+        :param caller: Object logging the message. Its logLevel and logPrefix attributes override ours.
+        :param level: Numeric LOG_* level or its name.
+        :param message: The message. Either a string, a format string for `args` and `kwargs` or a
+                        callable returning the message.
+        """
 
         if isinstance(level, str):
             from_output = 0
@@ -87,16 +120,34 @@ class Logger(object):
         else:
             print_level = LOG_OUTPUT.get(level, 'UNKNOWN')
 
-        if level <= log_level:
-            print("{prefix}{level}: {message}".format(prefix=log_prefix, level=print_level, message=message))
+        if level > self.get_level(caller):
+            return
 
+        log_prefix = getattr(caller, 'logPrefix', None)
+        if log_prefix is None:
+            log_prefix = self.logPrefix
 
-LOGGER = Logger()
+        if callable(message):
+            message = message()
+        elif args or kwargs:
+            message = message.format(*args, **kwargs)
+
+        record = "{prefix}{level}: {message}".format(prefix=log_prefix, level=print_level, message=message)
+        if self.writer is None:
+            print(record)
+        else:
+            self.writer.write(record)
+
+
+LOG_WRITER = LogWriter()
+LOGGER = Logger(writer=LOG_WRITER)
 
 
 class MaterialFilter(object):
     """Represents a filter on a certain material based on a threshold."""
 
+    __slots__ = ('material', 'threshold', 'enabled')
+
     def __init__(self, material, threshold, enabled=True):
         """Create a new `MaterialFilter`.
 
@@ -108,7 +159,12 @@ class MaterialFilter(object):
         self.material = material
         self.threshold = threshold
         self.enabled = enabled
-        self.logPrefix = "MaterialFilter {str} > ".format(str=self.__str__())
+
+    @property
+    def logPrefix(self):  # pylint: disable=invalid-name
+        """Return the log prefix. Only built when something is actually logged."""
+
+        return "MaterialFilter {str} > ".format(str=self.__str__())
 
     def __str__(self):
         """Return a string representation."""
@@ -133,6 +189,17 @@ class MaterialFilter(object):
 
         return other.material == self.material and other.threshold == self.threshold and other.enabled == self.enabled
 
+    def __ne__(self, other):
+        """Check if we are not equal to another object. See `__eq__()`."""
+
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        """Return a hash based on the same attributes as `__eq__()`."""
+
+        return hash((self.material, self.threshold, self.enabled))
+
     def check_match(self, material_list):
         """
         Check if any materials in the list are a match for our threshold.
@@ -141,9 +208,11 @@ class MaterialFilter(object):
         :return: returns a MaterialMatch or an empty list.
         """
         if self.enabled and material_list:
+            debug = LOGGER.is_enabled_for(self, LOG_DEBUG)
             for material_item in material_list:
                 percent = -1
-                LOGGER.debug(self, "Material item: {dump}".format(dump=pformat(material_item)))
+                if debug:
+                    LOGGER.debug(self, "Material item: {dump}", dump=pformat(material_item))
                 if isinstance(material_item, dict):
                     material_name = material_item[FIELD_NAME]
                     percent = material_item[FIELD_PERCENT]
@@ -153,21 +222,24 @@ class MaterialFilter(object):
 
                 material = Materials.by_name(material_name)
                 if material is None:
-                    LOGGER.warn(self, "Unknown material: {material}".format(material=material_name))
+                    LOGGER.warn(self, "Unknown material: {material}", material=material_name)
                     continue
 
                 if self.material == material:
-                    LOGGER.debug(self, "Compare {mat} percent {p} ({p_type}) >= {t} ({t_type}) => {result}".format(
-                        mat=material.name,
-                        p=percent,
-                        p_type=type(percent),
-                        t=self.threshold,
-                        t_type=type(self.threshold),
-                        result=str(percent >= self.threshold),
-                    ))
+                    if debug:
+                        LOGGER.debug(
+                            self, "Compare {mat} percent {p} ({p_type}) >= {t} ({t_type}) => {result}",
+                            mat=material.name,
+                            p=percent,
+                            p_type=type(percent),
+                            t=self.threshold,
+                            t_type=type(self.threshold),
+                            result=str(percent >= self.threshold),
+                        )
 
                     if percent >= self.threshold:
-                        LOGGER.debug(self, "Return match")
+                        if debug:
+                            LOGGER.debug(self, "Return match")
                         return MaterialMatch(material, percent)
 
                     return None
@@ -176,17 +248,75 @@ class MaterialFilter(object):
 
 
 class MaterialMatch(object):
-    """Represents a match for a material and a threshold."""
+    """Represents a match for a material and a threshold.
+
+    `MaterialMatch`es are immutable value objects. They are interned: creating a match for the same
+    material and percent returns the existing instance as long as it is still referenced. Setting an
+    attribute raises an `AttributeError`, it would change the match for everyone sharing it.
+    """
+
+    __slots__ = ('material', 'percent', '__weakref__')
 
-    def __init__(self, material, percent):
-        """Create a new `MaterialMatch`.
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, material, percent):
+        """Create a new `MaterialMatch` or return the interned one.
 
         :param material: `Material` that has matched.
         :param percent: percentage the matched material on a planet.
         """
 
-        self.material = material
-        self.percent = percent
+        key = (material.materialId, percent)
+        match = cls._interned.get(key)
+        if match is None:
+            match = object.__new__(cls)
+            object.__setattr__(match, 'material', material)
+            object.__setattr__(match, 'percent', percent)
+            cls._interned[key] = match
+        return match
+
+    def __setattr__(self, name, value):
+        """Refuse to change an attribute."""
+
+        raise AttributeError("MaterialMatch is immutable, can not set '{name}'".format(name=name))
+
+    def __delattr__(self, name):
+        """Refuse to delete an attribute."""
+
+        raise AttributeError("MaterialMatch is immutable, can not delete '{name}'".format(name=name))
+
+    def __reduce__(self):
+        """Copy and pickle through `__new__()`, so copies are interned as well."""
+
+        return (MaterialMatch, (self.material, self.percent))
+
+    def __eq__(self, other):
+        """Check if we are equal to another object.
+
+        `MaterialMatch`es are considered equal when material and percent are equal.
+        """
+
+        if not isinstance(other, MaterialMatch):
+            # don't attempt to compare against unrelated types
+            return NotImplemented
+
+        return self.material == other.material and self.percent == other.percent
+
+    def __ne__(self, other):
+        """Check if we are not equal to another object. See `__eq__()`."""
+
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        """Return a hash based on the same attributes as `__eq__()`."""
+
+        return hash((self.material.materialId, self.percent))
+
+    def __str__(self):
+        """Return a string representation."""
+
+        return "{symbol}: {percent}".format(symbol=self.material.symbol, percent=self.percent)
 
     def create_widget(self, parent):
         """Create a widget displaying this match."""
@@ -204,9 +334,174 @@ class MaterialMatch(object):
         return label_match
 
 
+class CompiledFilterSet(object):
+    """A list of `MaterialFilter`s compiled into a threshold table indexed by `Material.materialId`.
+
+    Disabled filters are left out. When multiple enabled filters exist for the same material,
+    the first one wins.
+    """
+
+    def __init__(self, filters=None):
+        """Compile a list of `MaterialFilter`s.
+
+        :param filters: list of `MaterialFilter`s. `None` compiles an empty set.
+        """
+
+        self.filters = list(filters) if filters else list()
+        self.logPrefix = 'CompiledFilterSet > '
+        # [materialId] => threshold or None, [materialId] => position of the filter in the output
+        size = max([material.materialId for material in Materials.items()]) + 1
+        self.thresholds = [None] * size
+        self.positions = [None] * size
+        # materialIds in filter order
+        self.order = []
+        for material_filter in self.filters:
+            material_id = material_filter.material.materialId
+            if not material_filter.enabled or self.thresholds[material_id] is not None:
+                continue
+            self.thresholds[material_id] = material_filter.threshold
+            self.positions[material_id] = len(self.order)
+            self.order.append(material_id)
+        self.count = len(self.order)
+
+    def __len__(self):
+        """Return the number of enabled filters."""
+
+        return self.count
+
+    def check_matches(self, materials):
+        """
+        Check all filters against a body's materials in a single pass.
+
+        :param materials: list of material dicts with a Name and Percent field or a dict with name: percent.
+        :return: list of `MaterialMatch`es in filter order.
+        """
+
+        if not materials or not self.count:
+            return []
+
+        thresholds = self.thresholds
+        by_name = Materials.by_name
+        found = [None] * self.count
+        if isinstance(materials, dict):
+            items = materials.items()
+        else:
+            items = ((item[FIELD_NAME], item[FIELD_PERCENT]) for item in materials)
+
+        for material_name, percent in items:
+            material = by_name(material_name)
+            if material is None:
+                LOGGER.warn(self, "Unknown material: {material}", material=material_name)
+                continue
+
+            threshold = thresholds[material.materialId]
+            if threshold is not None and percent >= threshold:
+                found[self.positions[material.materialId]] = MaterialMatch(material, percent)
+
+        return [match for match in found if match is not None]
+
+    def check_batch(self, bodies, use_numpy=True):
+        """
+        Check all filters against the materials of many bodies at once.
+
+        The percentages are loaded into an N x 28 matrix (one column per `Material.materialId`) which
+        is compared against the threshold vector in one go. NumPy is used when available, otherwise
+        this falls back to plain python lists.
+
+        :param bodies: list with the materials of each body. See `check_matches()`.
+        :param use_numpy: Set to `False` to force the pure python implementation.
+        :return: `BatchMatches`
+        """
+
+        columns = len(self.thresholds) - 1
+        rows = []
+        cols = []
+        values = []
+        for row, materials in enumerate(bodies):
+            if not materials:
+                continue
+            if isinstance(materials, dict):
+                items = materials.items()
+            else:
+                items = ((item[FIELD_NAME], item[FIELD_PERCENT]) for item in materials)
+
+            for material_name, percent in items:
+                material = Materials.by_name(material_name)
+                if material is None:
+                    LOGGER.warn(self, "Unknown material: {material}", material=material_name)
+                    continue
+                rows.append(row)
+                cols.append(material.materialId - 1)
+                values.append(percent)
+
+        # Absent materials get -1 so they never reach a threshold. Unfiltered materials get +inf.
+        if numpy is not None and use_numpy:
+            percents = numpy.full((len(bodies), columns), -1.0, dtype=numpy.float32)
+            percents[rows, cols] = values
+            thresholds = numpy.array(
+                [numpy.inf if t is None else t for t in self.thresholds[1:]],
+                dtype=numpy.float32,
+            )
+            mask = percents >= thresholds
+            return BatchMatches(self, mask, numpy.where(mask, percents, 0.0))
+
+        percents = [[-1.0] * columns for _body in bodies]
+        for row, col, percent in zip(rows, cols, values):
+            percents[row][col] = percent
+        thresholds = [float('inf') if t is None else t for t in self.thresholds[1:]]
+        mask = [[percent >= threshold for percent, threshold in zip(body, thresholds)] for body in percents]
+        matched = [[percent if hit else 0.0 for percent, hit in zip(body, hits)]
+                   for body, hits in zip(percents, mask)]
+        return BatchMatches(self, mask, matched)
+
+
+class BatchMatches(object):
+    """Result of `CompiledFilterSet.check_batch()`.
+
+    `mask` and `percents` are N x 28 matrices (NumPy arrays or nested lists). Column `materialId - 1`
+    holds the result for a `Material`. Percents of materials that did not match are 0.
+    """
+
+    def __init__(self, compiled_filters, mask, percents):
+        """Create a new `BatchMatches`."""
+
+        self.compiledFilters = compiled_filters
+        self.mask = mask
+        self.percents = percents
+
+    def __len__(self):
+        """Return the number of bodies."""
+
+        return len(self.mask)
+
+    def matched(self):
+        """Return the indexes of all bodies with at least one match."""
+
+        if numpy is not None and isinstance(self.mask, numpy.ndarray):
+            return [int(index) for index in numpy.flatnonzero(self.mask.any(axis=1))]
+        return [index for index, hits in enumerate(self.mask) if any(hits)]
+
+    def matches(self, index):
+        """
+        Return the `MaterialMatch`es for a single body in filter order.
+
+        :param index: Index of the body in the list passed to `check_batch()`.
+        """
+
+        hits = self.mask[index]
+        percents = self.percents[index]
+        return [
+            MaterialMatch(Materials.by_id(material_id), round(float(percents[material_id - 1]), 4))
+            for material_id in self.compiledFilters.order
+            if hits[material_id - 1]
+        ]
+
+
 class Rarity(object):
     """Represents a certain rarity for materials."""
 
+    __slots__ = ('rarityId', 'description', 'labelColor')
+
     def __init__(self, rarity_id, desc, label_color):
         """Create a new rarity.
 
@@ -234,6 +529,17 @@ class Rarity(object):
 
         return self.rarityId == other.rarityId
 
+    def __ne__(self, other):
+        """Check if we are not equal to another object. See `__eq__()`."""
+
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        """Return a hash of the rarityId."""
+
+        return hash(self.rarityId)
+
 
 class Rarities(object):
     """Different types of Rarity grades."""
@@ -247,6 +553,8 @@ class Rarities(object):
 class Material(object):
     """A Material."""
 
+    __slots__ = ('name', 'materialId', 'symbol', 'rarity')
+
     def __init__(self, name, material_id, symbol, rarity):
         """
         Create a new material.
@@ -279,6 +587,17 @@ class Material(object):
 
         return self.materialId == other.materialId
 
+    def __ne__(self, other):
+        """Check if we are not equal to another object. See `__eq__()`."""
+
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        """Return a hash of the materialId."""
+
+        return hash(self.materialId)
+
 
 class Materials(object):
     """List of known planetary materials."""
@@ -314,6 +633,32 @@ class Materials(object):
     BORON       = Material('Boron', 28, 'B', Rarities.COMMON)  # noqa: E221
     # pylint: enable=bad-whitespace
 
+    # Lookup indexes. Populated once at import time by `Materials.build_index()`.
+    _items = ()
+    _byName = dict()
+    _bySymbol = dict()
+    _byId = dict()
+    _byRarity = dict()
+
+    @classmethod
+    def build_index(cls):
+        """
+        (Re-)Build the lookup indexes for all known materials.
+
+        Names and symbols are case-folded. Rarities are indexed by their rarityId.
+        """
+
+        materials = tuple(x[1] for x in inspect.getmembers(cls) if isinstance(x[1], Material))
+        by_rarity = dict()
+        for material in materials:
+            by_rarity.setdefault(material.rarity.rarityId, []).append(material)
+
+        cls._items = materials
+        cls._byName = dict((str(material.name).lower(), material) for material in materials)
+        cls._bySymbol = dict((str(material.symbol).lower(), material) for material in materials)
+        cls._byId = dict((material.materialId, material) for material in materials)
+        cls._byRarity = dict((rarity_id, tuple(items)) for rarity_id, items in by_rarity.items())
+
     @classmethod
     def by_rarity(cls, rarity):
         """
@@ -323,7 +668,7 @@ class Materials(object):
         :return: list with `Material`s
         """
 
-        return [material for material in cls.items() if material.rarity == rarity]
+        return list(cls._byRarity.get(rarity.rarityId, ()))
 
     @classmethod
     def by_name(cls, name):
@@ -334,10 +679,7 @@ class Materials(object):
         :return: Found `Material` or `None`
         """
 
-        for i in cls.items():
-            if str(i.name).lower() == str(name).lower():
-                return i
-        return None
+        return cls._byName.get(str(name).lower())
 
     @classmethod
     def by_symbol(cls, symbol):
@@ -348,24 +690,18 @@ class Materials(object):
         :return: Found `Material` or `None`
         """
 
-        for i in cls.items():
-            if str(i.symbol).lower() == str(symbol).lower():
-                return i
-        return None
+        return cls._bySymbol.get(str(symbol).lower())
 
     @classmethod
     def by_id(cls, material_id):
         """
         Find a material by it's ID.
 
-        :param material_id: `Materials.elementId` to look for.
+        :param material_id: `Material.materialId` to look for.
         :return: Found `Material` or `None`
         """
 
-        for material in cls.items():
-            if material.material_id == material_id:
-                return material
-        return None
+        return cls._byId.get(material_id)
 
     @classmethod
     def items(cls):
@@ -375,7 +711,7 @@ class Materials(object):
         :return: List of all known `Material`s
         """
 
-        return [x[1] for x in inspect.getmembers(cls) if isinstance(x[1], Material)]
+        return list(cls._items)
 
     @classmethod
     def item_names(cls):
@@ -385,4 +721,7 @@ class Materials(object):
         :return: All material names.
         """
 
-        return [x.name for x in cls.items()]
+        return [x.name for x in cls._items]
+
+
+Materials.build_index()
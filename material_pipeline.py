@@ -0,0 +1,137 @@
+"""
+Match EDSM bodies replies on the EDSM worker instead of the Tk thread.
+
+A `BodiesMatcher` is registered as processor for api-system-v1/bodies with
+`EDSMQueries.set_processor()`. It turns each reply into a `SystemMatches`
+record holding only the bodies with matches, using a `MatchSnapshot` of the
+filters, rules and body filter. The Tk thread only has to show the matches.
+
+When the preferences change a new snapshot is swapped in; replies being
+processed at that moment finish with the old one.
+"""
+
+import copy
+from threading import Lock
+
+from material_api import CompiledFilterSet
+from material_rules import MaterialRuleSet, merge_matches
+
+
+class MatchSnapshot(object):
+    """The filters, rules and body filter at one moment, safe to use from the EDSM workers."""
+
+    def __init__(self, filters=None, rules=None, predicate=None):
+        """Create a new `MatchSnapshot`.
+
+        :param filters: list of `MaterialFilter`s.
+        :param rules: list of composite `MaterialRule`s. They are copied: rules keep statistics while evaluated.
+        :param predicate: `BodyPredicate` a body has to match, `None` to accept all bodies.
+        """
+
+        self.compiledFilters = CompiledFilterSet(filters)
+        self.ruleSet = MaterialRuleSet(copy.deepcopy(rules))
+        self.predicate = predicate
+        # Rules re-order their sub-rules while evaluated, the workers take turns.
+        self.rulesLock = Lock()
+        # id of a copied rule => it's (evaluations, hits) when they were last added to the original rule. Copies
+        # start with the statistics of the original.
+        self.merged = dict()
+        copies = list(self.ruleSet.rules)
+        while copies:
+            copied = copies.pop()
+            self.merged[id(copied)] = (copied.evaluations, copied.hits)
+            copies.extend(getattr(copied, 'rules', []))
+
+    def merge_statistics(self, rules):
+        """Add the evaluations and hits of the copied rules since the last merge to the rules they were copied from.
+
+        :param rules: The list of rules passed to the constructor.
+        """
+
+        with self.rulesLock:
+            pairs = list(zip(rules or [], self.ruleSet.rules))
+            while pairs:
+                (rule, copied) = pairs.pop()
+                (evaluations, hits) = self.merged.get(id(copied), (0, 0))
+                rule.evaluations += copied.evaluations - evaluations
+                rule.hits += copied.hits - hits
+                self.merged[id(copied)] = (copied.evaluations, copied.hits)
+                pairs.extend(zip(getattr(rule, 'rules', []), getattr(copied, 'rules', [])))
+
+    def check_bodies(self, bodies):
+        """Match the materials of the bodies of a system.
+
+        :param bodies: list of EDSM body dicts.
+        :return: list of (body name, list of `MaterialMatch`es) for the accepted bodies with matches.
+        """
+
+        if self.predicate is not None:
+            bodies = [body for body in bodies if self.predicate.matches(body)]
+        materials = [body.get('materials') or list() for body in bodies]
+
+        batch = self.compiledFilters.check_batch(materials)
+        matched = dict((index, batch.matches(index)) for index in batch.matched())
+        if self.ruleSet:
+            with self.rulesLock:
+                for index, body_materials in enumerate(materials):
+                    rule_matches = self.ruleSet.check_matches(body_materials)
+                    if rule_matches:
+                        matched[index] = merge_matches(matched.get(index, []), rule_matches)
+
+        return [(bodies[index]['name'], matched[index]) for index in sorted(matched)]
+
+
+class SystemMatches(object):  # pylint: disable=too-few-public-methods
+    """Compact result for a bodies reply: the system and only the bodies with matches."""
+
+    __slots__ = ('system', 'bodyCount', 'scanned', 'matches')
+
+    def __init__(self, system, body_count, scanned, matches):
+        """Create a new `SystemMatches`.
+
+        :param system: Name of the system.
+        :param body_count: Number of bodies in the system, according to EDSM.
+        :param scanned: Number of bodies EDSM knows about.
+        :param matches: list of (body name, list of `MaterialMatch`es).
+        """
+
+        self.system = system
+        self.bodyCount = body_count
+        self.scanned = scanned
+        self.matches = matches
+
+
+class BodiesMatcher(object):
+    """EDSM reply processor turning api-system-v1/bodies replies into `SystemMatches`."""
+
+    def __init__(self, snapshot, sketches=None):
+        """Create a new `BodiesMatcher`.
+
+        :param snapshot: The `MatchSnapshot` to use.
+        :param sketches: `SketchSet` observing the materials of every body, optional.
+        """
+
+        self.snapshot = snapshot
+        self.sketches = sketches
+        self.logPrefix = 'BodiesMatcher > '
+
+    def set_snapshot(self, snapshot):
+        """Use new filters for the replies processed from now on."""
+
+        self.snapshot = snapshot
+
+    def __call__(self, _request, reply):
+        """Process a reply.
+
+        :return: `SystemMatches`, or the reply itself when it has no system.
+        """
+
+        if not reply or 'name' not in reply:
+            return reply
+
+        snapshot = self.snapshot
+        bodies = reply.get('bodies') or []
+        if self.sketches is not None:
+            for body in bodies:
+                self.sketches.observe(body.get('materials'), body['name'])
+        return SystemMatches(reply['name'], reply.get('bodyCount'), len(bodies), snapshot.check_bodies(bodies))
@@ -0,0 +1,342 @@
+"""
+Composite rules on top of `MaterialFilter`s.
+
+Rules combine filters with ALL (and), ANY (or) and N-of-M conditions, for example:
+
+    ALL(Po>=1.10;Y>=2.00)
+    2OF(Sb>=1.40;Tc>=1.40;Ru>=2.50;Te>=1.50)
+    ANY(ALL(Po>=1.10;Y>=2.00);Sb>=1.40)
+
+Rules evaluate with short-circuiting. Each rule keeps hit-rate statistics which are
+used to order the sub-rules so the condition most likely to decide the outcome is
+tested first.
+"""
+
+from material_api import FIELD_NAME, FIELD_PERCENT
+from material_api import LOGGER, MaterialFilter, MaterialMatch, Materials
+
+
+class MaterialRuleSyntaxError(ValueError):
+    """Raised when a rule can not be parsed."""
+
+
+class MaterialRule(object):
+    """Base class for rules. Keeps track of how often a rule is evaluated and how often it hits."""
+
+    # Re-order sub-rules after this many evaluations.
+    REORDER_INTERVAL = 32
+
+    def __init__(self):
+        """Initialize the statistics."""
+
+        self.evaluations = 0
+        self.hits = 0
+
+    @property
+    def hit_rate(self):
+        """Return the (smoothed) fraction of evaluations that were a hit."""
+
+        return (self.hits + 1.0) / (self.evaluations + 2.0)
+
+    def evaluate(self, percents):
+        """
+        Evaluate the rule and update the statistics.
+
+        :param percents: dict with materialId: percent for a single body.
+        :return: `True` when the body matches.
+        """
+
+        self.evaluations += 1
+        result = self._evaluate(percents)
+        if result:
+            self.hits += 1
+        return result
+
+    def _evaluate(self, percents):
+        """Evaluate the rule. Implemented by subclasses."""
+
+        raise NotImplementedError()
+
+    def leaves(self):
+        """Return all `MaterialFilter`s used in this rule."""
+
+        raise NotImplementedError()
+
+    def __str__(self):
+        """Return the settings representation of the rule."""
+
+        raise NotImplementedError()
+
+
+class FilterRule(MaterialRule):
+    """A single `MaterialFilter` as a rule."""
+
+    def __init__(self, material_filter):
+        """Create a new `FilterRule`."""
+
+        MaterialRule.__init__(self)
+        self.materialFilter = material_filter
+
+    def _evaluate(self, percents):
+        """Check the percent of our material against the threshold."""
+
+        percent = percents.get(self.materialFilter.material.materialId)
+        return percent is not None and percent >= self.materialFilter.threshold
+
+    def leaves(self):
+        """Return our filter."""
+
+        return [self.materialFilter]
+
+    def __str__(self):
+        """Return Symbol>=Threshold."""
+
+        return '{symbol}>={threshold:.2f}'.format(
+            symbol=self.materialFilter.material.symbol,
+            threshold=self.materialFilter.threshold,
+        )
+
+
+class CompositeRule(MaterialRule):
+    """A rule combining sub-rules."""
+
+    KEYWORD = None
+
+    def __init__(self, rules):
+        """Create a new `CompositeRule`.
+
+        :param rules: list of `MaterialRule`s.
+        """
+
+        MaterialRule.__init__(self)
+        self.rules = list(rules)
+        # Evaluation order. `rules` keeps the order the user wrote them in.
+        self.order = list(self.rules)
+
+    def leaves(self):
+        """Return the `MaterialFilter`s of all sub-rules."""
+
+        return [leaf for rule in self.rules for leaf in rule.leaves()]
+
+    def _ordered(self):
+        """Return the sub-rules in evaluation order, re-ordering them every `REORDER_INTERVAL` evaluations."""
+
+        if self.evaluations % self.REORDER_INTERVAL == 1:
+            self.order.sort(key=self._order_key)
+        return self.order
+
+    @staticmethod
+    def _order_key(rule):
+        """Sort key for the sub-rules: most likely to decide the outcome first."""
+
+        return -rule.hit_rate
+
+    def __str__(self):
+        """Return KEYWORD(rule;rule;...)."""
+
+        return '{keyword}({rules})'.format(keyword=self.KEYWORD, rules=';'.join(str(rule) for rule in self.rules))
+
+
+class AllRule(CompositeRule):
+    """Matches when all sub-rules match. The rarest sub-rule is tested first."""
+
+    KEYWORD = 'ALL'
+
+    @staticmethod
+    def _order_key(rule):
+        """Rarest first: the first miss decides."""
+
+        return rule.hit_rate
+
+    def _evaluate(self, percents):
+        """Return `True` when all sub-rules match."""
+
+        for rule in self._ordered():
+            if not rule.evaluate(percents):
+                return False
+        return True
+
+
+class AnyRule(CompositeRule):
+    """Matches when any sub-rule matches. The most common sub-rule is tested first."""
+
+    KEYWORD = 'ANY'
+
+    def _evaluate(self, percents):
+        """Return `True` when any sub-rule matches."""
+
+        for rule in self._ordered():
+            if rule.evaluate(percents):
+                return True
+        return False
+
+
+class AtLeastRule(CompositeRule):
+    """Matches when at least `count` of the sub-rules match."""
+
+    def __init__(self, count, rules):
+        """Create a new `AtLeastRule`.
+
+        :param count: Minimum number of sub-rules that must match.
+        :param rules: list of `MaterialRule`s.
+        """
+
+        CompositeRule.__init__(self, rules)
+        self.count = count
+
+    def _evaluate(self, percents):
+        """Return `True` as soon as enough sub-rules match, `False` as soon as that can no longer happen."""
+
+        needed = self.count
+        remaining = len(self.rules)
+        for rule in self._ordered():
+            if needed <= 0 or remaining < needed:
+                break
+            remaining -= 1
+            if rule.evaluate(percents):
+                needed -= 1
+        return needed <= 0
+
+    def __str__(self):
+        """Return nOF(rule;rule;...)."""
+
+        return '{count}OF({rules})'.format(count=self.count, rules=';'.join(str(rule) for rule in self.rules))
+
+
+class MaterialRuleSet(object):
+    """A list of rules evaluated against a body's materials."""
+
+    def __init__(self, rules=None):
+        """Create a new `MaterialRuleSet`."""
+
+        self.rules = list(rules) if rules else list()
+        self.logPrefix = 'MaterialRuleSet > '
+
+    def __len__(self):
+        """Return the number of rules."""
+
+        return len(self.rules)
+
+    def check_matches(self, materials):
+        """
+        Check all rules against a body's materials.
+
+        :param materials: list of material dicts with a Name and Percent field or a dict with name: percent.
+        :return: list of `MaterialMatch`es for the filters of all matching rules.
+        """
+
+        if not self.rules or not materials:
+            return []
+
+        percents = self.percent_table(materials)
+        matches = []
+        found = set()
+        for rule in self.rules:
+            if not rule.evaluate(percents):
+                continue
+            for leaf in rule.leaves():
+                material_id = leaf.material.materialId
+                if material_id not in found and percents.get(material_id, -1) >= leaf.threshold:
+                    found.add(material_id)
+                    matches.append(MaterialMatch(leaf.material, percents[material_id]))
+        return matches
+
+    def percent_table(self, materials):
+        """Convert a body's materials into a dict with materialId: percent."""
+
+        if isinstance(materials, dict):
+            items = materials.items()
+        else:
+            items = ((item[FIELD_NAME], item[FIELD_PERCENT]) for item in materials)
+
+        percents = dict()
+        for material_name, percent in items:
+            material = Materials.by_name(material_name)
+            if material is None:
+                LOGGER.warn(self, "Unknown material: {material}", material=material_name)
+                continue
+            percents[material.materialId] = percent
+        return percents
+
+
+def merge_matches(matches, rule_matches):
+    """Add the matches of composite rules to the filter matches, skipping materials already matched."""
+
+    materials = set(match.material for match in matches)
+    return matches + [match for match in rule_matches if match.material not in materials]
+
+
+def is_rule(setting):
+    """Check if a settings string is a composite rule instead of a plain Symbol>=Threshold filter."""
+
+    return '(' in setting
+
+
+def parse_rule(text):
+    """
+    Parse a rule from its settings representation.
+
+    :param text: The rule, see the module documentation.
+    :return: `MaterialRule`
+    :raises MaterialRuleSyntaxError: when the rule is invalid.
+    """
+
+    text = text.replace(' ', '')
+    rule, position = _parse(text, 0)
+    if position != len(text):
+        raise MaterialRuleSyntaxError("Unexpected '{rest}' in rule '{rule}'".format(rest=text[position:], rule=text))
+    return rule
+
+
+def _parse(text, position):
+    """Parse a rule starting at position. Returns the rule and the position after it."""
+
+    opening = text.find('(', position)
+    ending = min([index for index in (text.find(';', position), text.find(')', position), len(text))
+                  if index >= 0])
+    if opening < 0 or ending < opening:
+        return _parse_filter(text[position:ending]), ending
+
+    keyword = text[position:opening].upper()
+    rules = []
+    position = opening + 1
+    while True:
+        rule, position = _parse(text, position)
+        rules.append(rule)
+        if position >= len(text):
+            raise MaterialRuleSyntaxError("Missing ')' in rule '{rule}'".format(rule=text))
+        if text[position] == ')':
+            position += 1
+            break
+        position += 1  # ;
+
+    if keyword == AllRule.KEYWORD:
+        return AllRule(rules), position
+    if keyword == AnyRule.KEYWORD:
+        return AnyRule(rules), position
+    if keyword.endswith('OF') and keyword[:-2].isdigit():
+        count = int(keyword[:-2])
+        if not 0 < count <= len(rules):
+            raise MaterialRuleSyntaxError("Invalid count {count} for {total} rules".format(
+                count=count,
+                total=len(rules),
+            ))
+        return AtLeastRule(count, rules), position
+
+    raise MaterialRuleSyntaxError("Unknown rule type '{keyword}'".format(keyword=keyword))
+
+
+def _parse_filter(text):
+    """Parse a Symbol>=Threshold filter."""
+
+    if '>=' not in text:
+        raise MaterialRuleSyntaxError("Expected Symbol>=Threshold, got '{text}'".format(text=text))
+
+    symbol, threshold = text.split('>=', 1)
+    material = Materials.by_symbol(symbol)
+    if material is None:
+        raise MaterialRuleSyntaxError("Unknown material with symbol '{symbol}'".format(symbol=symbol))
+    try:
+        return FilterRule(MaterialFilter(material, round(float(threshold), 2)))
+    except ValueError:
+        raise MaterialRuleSyntaxError("Invalid threshold '{threshold}'".format(threshold=threshold))
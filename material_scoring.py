@@ -0,0 +1,128 @@
+"""Score bodies on their material matches and keep track of the best ones."""
+
+import heapq
+import itertools
+
+
+DEFAULT_WEIGHT = 1.0
+
+
+class MaterialScorer(object):
+    """Gives bodies a weighted score based on how far their matches exceed the thresholds."""
+
+    def __init__(self, compiled_filters, weights=None, rules=None):
+        """Create a new `MaterialScorer`.
+
+        :param compiled_filters: `CompiledFilterSet` holding the thresholds.
+        :param weights: dict with `Material`: weight. Materials without a weight get `DEFAULT_WEIGHT`.
+        :param rules: list of composite `MaterialRule`s. Matches found by a rule are scored against the
+            thresholds of it's filters.
+        """
+
+        self.compiledFilters = compiled_filters
+        self.weights = dict(weights) if weights else dict()
+        # materialId => sorted thresholds of the rule filters for the material
+        self.ruleThresholds = dict()
+        for rule in rules or []:
+            for leaf in rule.leaves():
+                self.ruleThresholds.setdefault(leaf.material.materialId, set()).add(leaf.threshold)
+        for material_id, thresholds in self.ruleThresholds.items():
+            self.ruleThresholds[material_id] = sorted(thresholds)
+
+    def score(self, matches):
+        """
+        Calculate the score for the matches of a single body.
+
+        Each match adds its weight times the relative amount the percent exceeds the threshold
+        with. A match exactly on its threshold still counts as 1% over it. Matches found by a rule
+        are scored against the highest threshold of the rule filters they reach.
+        :param matches: list of `MaterialMatch`es.
+        :return: score as a float.
+        """
+
+        score = 0.0
+        thresholds = self.compiledFilters.thresholds
+        for match in matches:
+            threshold = thresholds[match.material.materialId]
+            if threshold is None or match.percent < threshold:
+                threshold = self._rule_threshold(match)
+                if threshold is None:
+                    continue
+            excess = max(match.percent - threshold, threshold * 0.01) / max(threshold, 1.0)
+            score += self.weights.get(match.material, DEFAULT_WEIGHT) * excess
+        return score
+
+    def _rule_threshold(self, match):
+        """Return the highest rule filter threshold a match reaches, `None` when it reaches none."""
+
+        reached = [threshold for threshold in self.ruleThresholds.get(match.material.materialId, [])
+                   if threshold <= match.percent]
+        return reached[-1] if reached else None
+
+
+class TopBodies(object):
+    """Keeps the k best scored bodies using a bounded min-heap.
+
+    Updating a body costs O(log k), or O(k) when the body is already ranked. Bodies that have been
+    pushed out are forgotten, so a ranked body losing score is not replaced by one pushed out before.
+    """
+
+    def __init__(self, size=5):
+        """Create a new `TopBodies`.
+
+        :param size: Number of bodies to keep.
+        """
+
+        self.size = size
+        self.heap = []
+        self.ranked = dict()
+        self.counter = itertools.count()
+
+    def __len__(self):
+        """Return the number of ranked bodies."""
+
+        return len(self.heap)
+
+    def clear(self):
+        """Forget all bodies."""
+
+        self.heap = []
+        self.ranked = dict()
+
+    def update(self, body, score):
+        """
+        Add or update the score of a body.
+
+        :param body: Hashable key for the body, like its name.
+        :param score: The body's score.
+        :return: `True` if the body is ranked after the update.
+        """
+
+        if body in self.ranked:
+            if self.ranked[body] == score:
+                return True
+            for entry in self.heap:
+                if entry[2] == body:
+                    entry[0] = score
+                    break
+            heapq.heapify(self.heap)
+            self.ranked[body] = score
+            return True
+
+        # The counter makes sure we never compare bodies, ties are decided by first come.
+        entry = [score, -next(self.counter), body]
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            removed = heapq.heapreplace(self.heap, entry)
+            del self.ranked[removed[2]]
+        else:
+            return False
+
+        self.ranked[body] = score
+        return True
+
+    def best(self):
+        """Return a list with (body, score) tuples, best score first."""
+
+        return [(entry[2], entry[0]) for entry in sorted(self.heap, reverse=True)]
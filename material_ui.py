@@ -9,14 +9,16 @@ from l10n import Locale
 from theme import theme
 
 # Own materializer stuff
-from material_api import MaterialFilter, Materials, Rarities
-from material_api import LOGGER
+from material_api import CompiledFilterSet, MaterialFilter, Materials, Rarities
+from material_api import LOGGER, LOG_DEBUG
+from material_rules import MaterialRuleSet, MaterialRuleSyntaxError, is_rule, merge_matches, parse_rule
+from material_scoring import DEFAULT_WEIGHT, MaterialScorer, TopBodies
 
 
 class MaterialFilterConfigFrame(tk.Frame):
     """Creates a frame to manage the Material Alert List."""
 
-    def __init__(self, master, default_thresholds, material_filter_list=None, **kw):
+    def __init__(self, master, default_thresholds, material_filter_list=None, material_weights=None, **kw):
         """Create a new Frame."""
 
         tk.Frame.__init__(self, master, **kw)
@@ -25,6 +27,7 @@ class MaterialFilterConfigFrame(tk.Frame):
             material_filter_list = []
 
         self.materialFilterList = material_filter_list
+        self.materialWeights = material_weights if material_weights is not None else dict()
         self.materialWidgets = dict()
         self.defaultThresholds = default_thresholds
         self.create_widgets()
@@ -45,9 +48,11 @@ class MaterialFilterConfigFrame(tk.Frame):
         """Update the UI with the current configured `MaterialFilter`s."""
 
         # Clear all
-        for _material, widgets in self.materialWidgets.items():
+        for material, widgets in self.materialWidgets.items():
             widgets[0].set(0)
             widgets[1].delete(0, tk.END)
+            widgets[2].delete(0, tk.END)
+            widgets[2].insert(0, Locale.stringFromNumber(self.materialWeights.get(material, DEFAULT_WEIGHT), 1))
 
         # Load all
         for alert in self.materialFilterList:
@@ -77,6 +82,38 @@ class MaterialFilterConfigFrame(tk.Frame):
             material_filters.append(MaterialFilter(material, threshold, enabled))
         return material_filters
 
+    def set_thresholds(self, thresholds):
+        """
+        Fill in thresholds for materials, for example suggested ones. Enabled states are left alone.
+
+        :param thresholds: dict with `Material`: threshold.
+        """
+
+        for material, threshold in thresholds.items():
+            widgets = self.materialWidgets.get(material)
+            if widgets is not None:
+                widgets[1].delete(0, tk.END)
+                widgets[1].insert(0, Locale.stringFromNumber(threshold, 2))
+
+    def get_material_weights(self):
+        """
+        Convert the weights set in the UI in a dict with `Material`: weight.
+
+        Empty and invalid entries get the default weight.
+        :return: dict with a weight for each material.
+        """
+
+        material_weights = dict()
+        for material, widgets in self.materialWidgets.items():
+            entry_value = widgets[2].get().strip()
+            weight = Locale.numberFromString(entry_value) if entry_value else DEFAULT_WEIGHT
+            if weight is None:
+                LOGGER.error(None, "Invalid weight '{weight}' for {symbol}, using {default}.", weight=entry_value,
+                             symbol=material.symbol, default=DEFAULT_WEIGHT)
+                weight = DEFAULT_WEIGHT
+            material_weights[material] = round(weight * 10) / 10.0
+        return material_weights
+
     # bound methods documentation is kinda lacking. I hacked around.
     def _material_selectbox_event(self, _event=None):
         """
@@ -132,8 +169,15 @@ class MaterialFilterConfigFrame(tk.Frame):
             entry = tk.Entry(materials_frame)
             entry.configure(width=10, justify=tk.RIGHT)
             entry.grid(column=2, row=index, sticky=tk.E)
+
+            times = tk.Label(materials_frame, text="x")
+            times.grid(column=3, row=index, sticky=tk.E)
+
+            weight_entry = tk.Entry(materials_frame)
+            weight_entry.configure(width=4, justify=tk.RIGHT)
+            weight_entry.grid(column=4, row=index, sticky=tk.E)
             index = index + 1
-            self.materialWidgets[material] = (check_var, entry)
+            self.materialWidgets[material] = (check_var, entry, weight_entry)
 
         materials_frame.grid_columnconfigure(2, weight=1)
         materials_frame.pack(fill=tk.BOTH)
@@ -142,8 +186,16 @@ class MaterialFilterConfigFrame(tk.Frame):
 class MaterialFilterMatchesFrame(tk.Frame):
     """A tk frame which displays matching material alerts."""
 
-    def __init__(self, master, filters=None, **kw):
-        """Create a new `Frame` and initialize components."""
+    TOP_BODIES = 5
+
+    def __init__(self, master, filters=None, weights=None, sort_by_score=False, rules=None, **kw):
+        """Create a new `Frame` and initialize components.
+
+        :param filters: list of `MaterialFilter`s.
+        :param weights: dict with `Material`: weight used to score bodies.
+        :param sort_by_score: Show the best scoring bodies first instead of sorting on name.
+        :param rules: list of composite `MaterialRule`s.
+        """
 
         tk.Frame.__init__(self, master, **kw)
 
@@ -151,6 +203,12 @@ class MaterialFilterMatchesFrame(tk.Frame):
         self.filters = filters
         if self.filters is None:
             self.filters = list()
+        self.compiledFilters = CompiledFilterSet(self.filters)
+        self.ruleSet = MaterialRuleSet(rules)
+        self.scorer = MaterialScorer(self.compiledFilters, weights, self.ruleSet.rules)
+        self.sortByScore = sort_by_score
+        self.systemRanking = TopBodies(self.TOP_BODIES)
+        self.sessionRanking = TopBodies(self.TOP_BODIES)
         self.containerFrame = None
         self.planetMatches = dict()
         self.systemData = dict()
@@ -165,20 +223,30 @@ class MaterialFilterMatchesFrame(tk.Frame):
             self.containerFrame = tk.Frame(self)
             self.containerFrame.grid()
 
-    def update_filters(self, filters):
-        """Change the current filter. Re-applies them to the current system data."""
+    def update_filters(self, filters, weights=None, sort_by_score=None, rules=None):
+        """Change the current filter. Re-applies them to the current system data.
+
+        Scores are not comparable between filter sets: the session ranking restarts.
+        """
 
         self.filters = filters
+        self.compiledFilters = CompiledFilterSet(filters)
+        if rules is not None:
+            self.ruleSet = MaterialRuleSet(rules)
+        self.scorer = MaterialScorer(self.compiledFilters, weights if weights is not None else self.scorer.weights,
+                                     self.ruleSet.rules)
+        if sort_by_score is not None:
+            self.sortByScore = sort_by_score
+        self.sessionRanking.clear()
         self._clear_matches(False)
-        for planet, materials in self.systemData.items():
-            self.process_filter_planet_materials(self.currentSystem, planet, materials)
+        self.process_filter_system_bodies(self.currentSystem, self.systemData.items())
 
     def jump_system(self, system, update_ui=True):
         """Change current system: clear all data."""
 
-        LOGGER.debug(self, "Jump system called: '{system}'".format(system=system))
+        LOGGER.debug(self, "Jump system called: '{system}'", system=system)
         if self.currentSystem == system:
-            LOGGER.debug(self, "Already working on '{system}'. Not resetting.".format(system=system))
+            LOGGER.debug(self, "Already working on '{system}'. Not resetting.", system=system)
         else:
             self.systemData = dict()
             self.currentSystem = system
@@ -212,10 +280,7 @@ class MaterialFilterMatchesFrame(tk.Frame):
                     current_system=self.currentSystem,
                     system=system,
                 ))
-                LOGGER.debug(self, "Skipped planet_materials: {planet} system: {system}".format(
-                    planet=planet,
-                    system=system,
-                ))
+                LOGGER.debug(self, "Skipped planet_materials: {planet} system: {system}", planet=planet, system=system)
                 return
 
         if materials is None:
@@ -227,6 +292,62 @@ class MaterialFilterMatchesFrame(tk.Frame):
         if matches:
             self._add_matches(planet, matches, priority)
 
+    def process_filter_system_bodies(self, system, bodies):
+        """Scan the raw materials of many planets of a system at once and update the UI once.
+
+        Bodies for another system than the current one are skipped. See `process_filter_planet_materials()`.
+        :param system: System the bodies belong to.
+        :param bodies: list of (planet, materials) tuples.
+        """
+
+        if self.currentSystem is None:
+            self.currentSystem = system
+
+        if not system == self.currentSystem:
+            LOGGER.warn(self, "Adding bodies for wrong system. wants: {current_system}, got {system}".format(
+                current_system=self.currentSystem,
+                system=system,
+            ))
+            return
+
+        bodies = [(planet, materials if materials is not None else list()) for planet, materials in bodies]
+        for planet, materials in bodies:
+            self.systemData[planet] = materials
+
+        batch = self.compiledFilters.check_batch([materials for _planet, materials in bodies])
+        matched = dict((index, batch.matches(index)) for index in batch.matched())
+        if self.ruleSet:
+            for index, (_planet, materials) in enumerate(bodies):
+                rule_matches = self.ruleSet.check_matches(materials)
+                if rule_matches:
+                    matched[index] = self._merge_matches(matched.get(index, []), rule_matches)
+
+        self.process_system_matches(system, [(bodies[index][0], matches) for index, matches in matched.items()])
+
+    def process_system_matches(self, system, matches):
+        """Show the matches of many planets of a system at once, found by a `material_pipeline.BodiesMatcher`.
+
+        The planets are not kept in the system data: they are not re-checked when the filters change.
+        :param system: System the planets belong to.
+        :param matches: list of (planet, list of `MaterialMatch`es) tuples.
+        """
+
+        if self.currentSystem is None:
+            self.currentSystem = system
+
+        if not system == self.currentSystem:
+            LOGGER.warn(self, "Adding matches for wrong system. wants: {current_system}, got {system}".format(
+                current_system=self.currentSystem,
+                system=system,
+            ))
+            return
+
+        for planet, planet_matches in matches:
+            if self.planetMatches.get(planet) is None:
+                self._set_planet_matches(planet, planet_matches)
+
+        self._draw_matches()
+
     def _check_material_matches(self, materials):
         """
         Check each filter against the provided raw materials and returns matches.
@@ -234,26 +355,28 @@ class MaterialFilterMatchesFrame(tk.Frame):
         :param materials: List of materials: array of [{"Name": <value>, "Percent": <value>}, ...]
         """
 
-        LOGGER.debug(self, "Called _check_material_matches for materials: {materials}".format(
-            materials=pformat(materials),
-        ))
-        matches = []
-        if materials is None or not materials:
-            return matches
-
-        for f in self.filters:
-            LOGGER.debug(self, "Checking filter {filter}".format(filter=f.__str__()))
-            filter_match = f.check_match(materials)
-            if filter_match is not None:
-                LOGGER.debug(self, "Matched {match}".format(match=filter_match.__str__()))
-                matches.append(filter_match)
+        debug = LOGGER.is_enabled_for(self, LOG_DEBUG)
+        if debug:
+            LOGGER.debug(self, "Called _check_material_matches for materials: {m}", m=pformat(materials))
+        matches = self.compiledFilters.check_matches(materials)
+        if self.ruleSet:
+            matches = self._merge_matches(matches, self.ruleSet.check_matches(materials))
+        if debug:
+            LOGGER.debug(self, "Matched {matches}", matches=", ".join([str(match) for match in matches]))
         return matches
 
+    @staticmethod
+    def _merge_matches(matches, rule_matches):
+        """Add the matches of composite rules to the filter matches, skipping materials already matched."""
+
+        return merge_matches(matches, rule_matches)
+
     def _clear_matches(self, update_ui=True):
         """Clear the frame with matches."""
 
-        LOGGER.debug(self, "Clear all matches called (update_ui={update_ui}).".format(update_ui=str(update_ui)))
+        LOGGER.debug(self, "Clear all matches called (update_ui={update_ui}).", update_ui=update_ui)
         self.planetMatches = dict()
+        self.systemRanking.clear()
         if update_ui:
             self._draw_matches()
             self.containerFrame.configure(background=theme.current['background'])
@@ -262,10 +385,30 @@ class MaterialFilterMatchesFrame(tk.Frame):
     def _add_matches(self, planet, matches, priority=False):
         """Add a planet with matches to the frame."""
         if priority or self.planetMatches.get(planet) is None:
-            self.planetMatches[planet] = matches
+            self._set_planet_matches(planet, matches)
 
         self._draw_matches()
 
+    def _set_planet_matches(self, planet, matches):
+        """Store the matches for a planet and update the rankings with its score."""
+
+        self.planetMatches[planet] = matches
+        score = self.scorer.score(matches)
+        self.systemRanking.update(planet, score)
+        self.sessionRanking.update(planet, score)
+
+    def _sorted_planets(self):
+        """Return the planets with matches in display order.
+
+        Sorted by name, or the best scoring planets first when sorting by score.
+        """
+
+        if not self.sortByScore:
+            return sorted(self.planetMatches)
+
+        ranked = [planet for planet, _score in self.systemRanking.best() if planet in self.planetMatches]
+        return ranked + sorted(set(self.planetMatches) - set(ranked))
+
     def _draw_matches(self):
         """(re-)Generate the frame for all the matches."""
 
@@ -277,7 +420,7 @@ class MaterialFilterMatchesFrame(tk.Frame):
         # Copy the color configuration from the EDMC theme.
         self.initialize_frame()
         current_row = 0
-        for planet in sorted(self.planetMatches):
+        for planet in self._sorted_planets():
             matches = self.planetMatches[planet]
             planet_name = planet.replace(self.currentSystem, '')
             planet_text = "{planet}:".format(planet=planet_name)
@@ -302,6 +445,15 @@ class MaterialFilterMatchesFrame(tk.Frame):
 
             current_row = current_row + 1
 
+        session_best = self.sessionRanking.best()
+        if self.sortByScore and session_best:
+            label_best = tk.Label(self.containerFrame, text="Session best: {planet}".format(planet=session_best[0][0]))
+            label_best.configure(
+                foreground=theme.current['foreground'],
+                background=theme.current['background'],
+            )
+            label_best.grid(column=0, row=current_row, columnspan=2, sticky=tk.W)
+
         self.containerFrame.configure(background=theme.current['background'])
         self.containerFrame.grid()
 
@@ -322,6 +474,8 @@ class MaterialFilterListConfigTranslator(object):
 
         alerts = list()
         for mat in materials:
+            if is_rule(mat):
+                continue  # See translate_rules_from_settings()
 
             key, threshold = mat.split('>=')
 
@@ -366,3 +520,96 @@ class MaterialFilterListConfigTranslator(object):
                                                          threshold=Locale.stringFromNumber(threshold, 2)))
 
         return result
+
+    @classmethod
+    def translate_rules_from_settings(cls, settings, invalid=None):
+        """
+        Read the composite rules, like ALL(Po>=1.10;Y>=2.00), from a settings list.
+
+        Plain Symbol>=Threshold entries are skipped: see `translate_from_settings()`.
+        :param settings: list with filters and rules.
+        :param invalid: list the rules with a syntax error are added to, so they can be saved as they are.
+        :return: list of `MaterialRule`s.
+        """
+
+        rules = list()
+        if settings is None:
+            return rules
+
+        for setting in settings:
+            if not is_rule(setting):
+                continue
+            try:
+                rules.append(parse_rule(setting))
+            except MaterialRuleSyntaxError as err:
+                LOGGER.error(None, "Invalid rule '{rule}': {err}. Skipping.", rule=setting, err=err)
+                if invalid is not None:
+                    invalid.append(setting)
+
+        return rules
+
+    @classmethod
+    def translate_rules_to_settings(cls, rules):
+        """
+        Convert a list of `MaterialRule`s into strings to store in settings next to the filters.
+
+        :param rules: list of `MaterialRule`s.
+        :return: list of string representations.
+        """
+
+        if rules is None:
+            return []
+
+        return [str(rule) for rule in rules]
+
+
+class MaterialWeightConfigTranslator(object):
+    """Helper class to translate material weights from and to settings."""
+
+    @classmethod
+    def translate_from_settings(cls, weights):
+        """
+        Read a list with Symbol=Weight and parse it into a dict with `Material`: weight.
+
+        :param weights: list with material and weight.
+        :return: dict with weights.
+        """
+
+        material_weights = dict()
+        if weights is None:
+            return material_weights
+
+        for weight_setting in weights:
+            key, weight = weight_setting.split('=')
+            material = Materials.by_symbol(key)
+            if material is None:
+                LOGGER.error(None, "Unknown material with symbol '{symbol}'. Skipping.", symbol=key)
+                continue
+
+            number = Locale.numberFromString(weight)
+            if number is None:
+                LOGGER.error(None, "Invalid weight '{weight}' for {symbol}, using {default}.", weight=weight,
+                             symbol=key, default=DEFAULT_WEIGHT)
+            else:
+                material_weights[material] = round(number * 10) / 10.0
+
+        return material_weights
+
+    @classmethod
+    def translate_to_settings(cls, weights):
+        """
+        Convert a dict with `Material`: weight into a string only list to store in settings.
+
+        Default weights are left out.
+        :param weights: dict with weights.
+        :return: list with Symbol=Weight strings.
+        """
+
+        if weights is None:
+            return []
+
+        return [
+            '{symbol}={weight}'.format(symbol=material.symbol, weight=Locale.stringFromNumber(weight, 1))
+            for material, weight in sorted(weights.items(), key=lambda item: item[0].materialId)
+            if weight != DEFAULT_WEIGHT
+        ]
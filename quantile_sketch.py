@@ -0,0 +1,274 @@
+"""
+Constant memory quantile sketches for material percentages.
+
+`TDigest` is a merging t-digest: it summarizes any number of observations in
+a bounded number of centroids, can estimate quantiles and merges cheaply with
+other digests. `SketchSet` keeps one digest per material.
+
+This module does not depend on EDMC so it can be used from offline tools.
+"""
+
+import json
+import math
+import os
+from threading import RLock
+
+
+class TDigest(object):
+    """A merging t-digest."""
+
+    def __init__(self, compression=100):
+        """Create an empty digest.
+
+        :param compression: Controls the number of centroids kept (about 2x compression at most).
+        """
+
+        self.compression = compression
+        self.centroids = []  # sorted [mean, weight] pairs
+        self.buffer = []
+        self.count = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        """Return the number of observations."""
+
+        return int(self.count)
+
+    def add(self, value, weight=1.0):
+        """Add an observation."""
+
+        self.buffer.append([value, weight])
+        self.count += weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.buffer) > self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        """Merge another digest into this one."""
+
+        if not other.count:
+            return
+        self.buffer.extend([list(centroid) for centroid in other.centroids])
+        self.buffer.extend([list(item) for item in other.buffer])
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.compress()
+
+    def compress(self):
+        """Merge the buffered observations into the centroids."""
+
+        if not self.buffer:
+            return
+
+        items = sorted(self.centroids + self.buffer)
+        self.buffer = []
+        total = self.count
+        centroids = []
+        current = items[0]
+        weight_before = 0.0
+        k_lower = self._scale(0.0)
+        for item in items[1:]:
+            if self._scale((weight_before + current[1] + item[1]) / total) - k_lower <= 1.0:
+                weight = current[1] + item[1]
+                current = [current[0] + (item[0] - current[0]) * item[1] / weight, weight]
+            else:
+                centroids.append(current)
+                weight_before += current[1]
+                k_lower = self._scale(weight_before / total)
+                current = item
+        centroids.append(current)
+        self.centroids = centroids
+
+    def _scale(self, quantile):
+        """Scale function k1: keeps centroids small near the tails."""
+
+        quantile = min(max(quantile, 0.0), 1.0)
+        return self.compression / (2 * math.pi) * math.asin(2 * quantile - 1)
+
+    def quantile(self, quantile):
+        """
+        Estimate the value at a quantile.
+
+        :param quantile: Quantile between 0 and 1. 0.95 returns the value 95% of the observations are below.
+        :return: The estimate or `None` when the digest is empty.
+        """
+
+        self.compress()
+        if not self.centroids:
+            return None
+
+        target = quantile * self.count
+        previous_center = 0.0
+        previous_mean = self.min
+        cumulative = 0.0
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2.0
+            if target < center:
+                return self._interpolate(previous_mean, mean, previous_center, center, target)
+            previous_center = center
+            previous_mean = mean
+            cumulative += weight
+
+        return self._interpolate(previous_mean, self.max, previous_center, self.count, target)
+
+    @staticmethod
+    def _interpolate(low, high, low_rank, high_rank, rank):
+        """Linear interpolation between two (rank, value) points."""
+
+        if high_rank <= low_rank:
+            return high
+        fraction = min(max((rank - low_rank) / (high_rank - low_rank), 0.0), 1.0)
+        return low + (high - low) * fraction
+
+    def to_dict(self):
+        """Return a compact, json serializable representation."""
+
+        self.compress()
+        return {
+            'n': self.count,
+            'min': self.min,
+            'max': self.max,
+            'c': [[round(mean, 4), weight] for mean, weight in self.centroids],
+        }
+
+    @classmethod
+    def from_dict(cls, data, compression=100):
+        """Create a digest from `to_dict()` output."""
+
+        digest = cls(compression)
+        digest.count = float(data.get('n', 0.0))
+        digest.min = data.get('min')
+        digest.max = data.get('max')
+        digest.centroids = [[float(mean), float(weight)] for mean, weight in data.get('c', [])]
+        return digest
+
+
+class SketchSet(object):
+    """A `TDigest` for each material, keyed by the lower-cased material name."""
+
+    VERSION = 1
+
+    def __init__(self, compression=100):
+        """Create an empty set."""
+
+        self.compression = compression
+        self.sketches = dict()
+        self.seen = set()
+        # Bodies can be observed from the EDSM workers while the Tk thread uses the set.
+        self.lock = RLock()
+
+    def __len__(self):
+        """Return the number of sketches."""
+
+        return len(self.sketches)
+
+    def get(self, name):
+        """Return the sketch for a material name or `None`."""
+
+        return self.sketches.get(str(name).lower())
+
+    def observe(self, materials, body=None):
+        """
+        Add the material percentages of a body.
+
+        :param materials: list of material dicts with a Name and Percent field or a dict with name: percent.
+        :param body: Name of the body. Bodies observed since the last `forget_bodies()` are skipped.
+        :return: `True` when the body was added.
+        """
+
+        if not materials:
+            return False
+        if isinstance(materials, dict):
+            items = materials.items()
+        else:
+            items = ((item['Name'], item['Percent']) for item in materials)
+
+        with self.lock:
+            if body is not None:
+                if body in self.seen:
+                    return False
+                self.seen.add(body)
+
+            for name, percent in items:
+                key = str(name).lower()
+                sketch = self.sketches.get(key)
+                if sketch is None:
+                    sketch = self.sketches[key] = TDigest(self.compression)
+                sketch.add(float(percent))
+        return True
+
+    def forget_bodies(self):
+        """Forget which bodies have been observed. Call when leaving a system."""
+
+        with self.lock:
+            self.seen = set()
+
+    def merge(self, other):
+        """Merge the sketches of another `SketchSet` into this one."""
+
+        with self.lock:
+            for key, sketch in other.sketches.items():
+                if key in self.sketches:
+                    self.sketches[key].merge(sketch)
+                else:
+                    self.sketches[key] = TDigest.from_dict(sketch.to_dict(), self.compression)
+
+    def quantiles(self, quantile, minimum=1):
+        """
+        Estimate a quantile for each material.
+
+        :param quantile: Quantile between 0 and 1.
+        :param minimum: Minimum number of observations before a material is included.
+        :return: dict with name: value.
+        """
+
+        with self.lock:
+            return dict(
+                (key, sketch.quantile(quantile))
+                for key, sketch in self.sketches.items()
+                if len(sketch) >= minimum
+            )
+
+    def to_dict(self):
+        """Return a json serializable representation."""
+
+        with self.lock:
+            return {
+                'version': self.VERSION,
+                'sketches': dict((key, sketch.to_dict()) for key, sketch in self.sketches.items()),
+            }
+
+    @classmethod
+    def from_dict(cls, data, compression=100):
+        """Create a `SketchSet` from `to_dict()` output."""
+
+        sketch_set = cls(compression)
+        if data.get('version') == cls.VERSION:
+            for key, sketch in data.get('sketches', {}).items():
+                sketch_set.sketches[key] = TDigest.from_dict(sketch, compression)
+        return sketch_set
+
+    def save(self, filename):
+        """Write the sketches to a json file. The file is replaced at once, a crash never leaves a partial one."""
+
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as sketch_file:
+            json.dump(self.to_dict(), sketch_file, separators=(',', ':'))
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)  # No atomic replace on Windows with python 2.
+        os.rename(temporary, filename)
+
+    @classmethod
+    def load(cls, filename, compression=100):
+        """Read sketches from a json file. Returns an empty set when the file is missing or unusable."""
+
+        try:
+            with open(filename, 'r') as sketch_file:
+                return cls.from_dict(json.load(sketch_file), compression)
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return cls(compression)
@@ -0,0 +1,154 @@
+"""
+Token bucket rate limiter for the EDSM api.
+
+EDSM reports it's budget with every reply:
+
+* X-Rate-Limit-Limit: number of requests allowed in the window.
+* X-Rate-Limit-Remaining: number of requests left.
+* X-Rate-Limit-Reset: seconds until the budget is completely restored.
+
+The bucket follows these headers: requests are sent right away while there is
+budget, and are spaced out more and more as the budget runs low. The state is
+saved so a restart does not start with a full budget that EDSM does not grant.
+"""
+
+import json
+import time
+from threading import Lock
+
+
+class TokenBucket(object):
+    """A token bucket updated from EDSM rate limit headers."""
+
+    HEADER_LIMIT = 'X-Rate-Limit-Limit'
+    HEADER_REMAINING = 'X-Rate-Limit-Remaining'
+    HEADER_RESET = 'X-Rate-Limit-Reset'
+
+    # Used until EDSM tells us otherwise: a burst of 10 requests, then one every 5 seconds.
+    DEFAULT_CAPACITY = 10.0
+    DEFAULT_RATE = 1 / 5.0
+    # Below this fraction of the capacity requests are spaced out.
+    RESERVE = 0.2
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, rate=DEFAULT_RATE, clock=time.time):
+        """Create a full bucket.
+
+        :param capacity: Maximum number of tokens.
+        :param rate: Tokens added per second.
+        :param clock: Function returning the current time in seconds.
+        """
+
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = Lock()
+        self.logPrefix = 'TokenBucket > '
+
+    def _refill(self, now):
+        """Add the tokens earned since the last update."""
+
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Return the number of seconds to wait before the next request. 0 when it can go right away."""
+
+        with self.lock:
+            self._refill(self.clock())
+            return self._delay()
+
+    def _delay(self):
+        """Return the delay for the current number of tokens."""
+
+        if self.tokens < 1.0:
+            return (1.0 - self.tokens) / self.rate
+
+        reserve = self.capacity * self.RESERVE
+        if self.tokens >= reserve or reserve <= 1.0:
+            return 0.0
+        # Running low: wait up to the time it takes to earn a token.
+        return (reserve - self.tokens) / (reserve - 1.0) / self.rate
+
+    def consume(self):
+        """Take a token for a request. The bucket may go into debt when called without waiting."""
+
+        with self.lock:
+            self._refill(self.clock())
+            self.tokens -= 1.0
+
+    def reserve(self):
+        """Take a token for a request, even if it is not there yet.
+
+        Concurrent callers each reserve their own token, the debt makes later callers wait longer.
+        :return: The number of seconds to wait before sending the request.
+        """
+
+        with self.lock:
+            self._refill(self.clock())
+            delay = self._delay()
+            self.tokens -= 1.0
+            return delay
+
+    def update(self, headers):
+        """Follow the rate limit headers of a reply. Replies without them are ignored.
+
+        A debt, from tokens reserved by requests EDSM did not see yet, is subtracted from the remaining budget.
+        :param headers: dict like object with the response headers.
+        """
+
+        try:
+            limit = float(headers[self.HEADER_LIMIT])
+            remaining = float(headers[self.HEADER_REMAINING])
+            reset = float(headers[self.HEADER_RESET])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        if limit <= 0:
+            return
+
+        with self.lock:
+            self.updated = self.clock()
+            self.capacity = limit
+            self.tokens = min(max(remaining, 0.0), limit) + min(self.tokens, 0.0)
+            if reset > 0 and remaining < limit:
+                self.rate = (limit - remaining) / reset
+
+    def to_dict(self):
+        """Return a json serializable representation."""
+
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'rate': self.rate,
+                'tokens': self.tokens,
+                'updated': self.updated,
+            }
+
+    @classmethod
+    def from_dict(cls, data, clock=time.time):
+        """Create a bucket from `to_dict()` output. Tokens earned since it was saved are added."""
+
+        bucket = cls(data.get('capacity', cls.DEFAULT_CAPACITY), data.get('rate', cls.DEFAULT_RATE), clock)
+        bucket.tokens = min(float(data.get('tokens', bucket.capacity)), bucket.capacity)
+        bucket.updated = float(data.get('updated', bucket.updated))
+        bucket._refill(clock())
+        return bucket
+
+    def save(self, filename):
+        """Write the state to a json file."""
+
+        with open(filename, 'w') as bucket_file:
+            json.dump(self.to_dict(), bucket_file)
+
+    @classmethod
+    def load(cls, filename, clock=time.time):
+        """Read the state from a json file. Returns a full default bucket when the file is missing or unusable."""
+
+        try:
+            with open(filename, 'r') as bucket_file:
+                return cls.from_dict(json.load(bucket_file), clock)
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return cls(clock=clock)
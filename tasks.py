@@ -50,6 +50,40 @@ def lint(ctx, filename=None, envdir=['env', 'venv'], noglob=False):
     os.system(command)
 
 
+@task(
+    help={
+        'name': 'Benchmark(s) to run, comma separated. Defaults to all.',
+    },
+)
+def benchmark(ctx, name=None):
+    """Run the micro-benchmarks in benchmarks.py.
+
+    Requires the EDMC sources on the python path.
+    """
+
+    command = 'python benchmarks.py'
+    if name is not None:
+        command += ' ' + ' '.join(name.split(','))
+
+    ctx.run(command, err_stream=sys.stdout)
+
+
+@task(
+    help={
+        'dump': 'EDSM bodies dump to read (bodies.json, optionally gzipped).',
+        'out': 'Where to store the thresholds. Defaults to thresholds.json, which load.py picks up.',
+        'processes': 'Number of worker processes. Defaults to the number of cpus.',
+        'chunk-size': 'Number of bodies handed to a worker at once.',
+        'quantile': 'Quantile used for the default thresholds.',
+    },
+)
+def thresholds(ctx, dump, out='thresholds.json', processes=None, chunk_size=5000, quantile=0.95):
+    """Generate the default thresholds and percentile tables from an EDSM bodies dump."""
+
+    import threshold_tables
+    threshold_tables.main(dump, out, int(processes) if processes else None, int(chunk_size), float(quantile))
+
+
 @task(
     help={
         'out': 'Where to store the file',
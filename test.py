@@ -1,10 +1,62 @@
 """Tests."""
 
+import BaseHTTPServer
+import copy
+import gzip
+import json
+import os
+import pickle
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from StringIO import StringIO
 from testfixtures import compare
 
-from material_ui import MaterialFilterListConfigTranslator
-from material_api import MaterialFilter, Materials
+from body_predicates import BodyPredicateSyntaxError, body_attributes_from_scan, compile_predicate
+from edsm_async import AsyncEDSMQueries, Job, ResponseParser
+from edsm_cache import EDSMCache
+from edsm_metrics import EDSMMetrics, Histogram, MetricsDump
+from edsm_projection import BODIES_PROJECTION, ProjectionError
+from circuit_breaker import CircuitBreaker
+from edsm_queries import EDSMQueries, OrderedDelivery
+from edsm_standin import StandInEDSM, load_fixtures
+from requests import ConnectionError as RequestsConnectionError, HTTPError, Response
+from log_writer import LogWriter
+from material_pipeline import BodiesMatcher, MatchSnapshot, SystemMatches
+from material_rules import MaterialRuleSet, MaterialRuleSyntaxError, parse_rule
+from material_scoring import MaterialScorer, TopBodies
+from material_ui import MaterialFilterListConfigTranslator, MaterialWeightConfigTranslator
+from quantile_sketch import SketchSet, TDigest
+from rate_limiter import TokenBucket
+import threshold_tables
+from threshold_tables import THRESHOLDS_VERSION, generate, iter_chunks, load_thresholds, write_thresholds
+from material_api import CompiledFilterSet, Logger, MaterialFilter, MaterialMatch, Materials, Rarities
+from material_api import LOG_DEBUG, LOG_INFO
+
+
+class FakeTkRoot(object):  # pylint: disable=too-few-public-methods
+    """Stands in for the Tk root the EDSM queries generate their events on."""
+
+    def __init__(self, on_event=None):
+        """Create a new `FakeTkRoot`.
+
+        :param on_event: Optional callable, called with each event.
+        """
+
+        self.events = []
+        self.onEvent = on_event
+
+    def event_generate(self, event, **_kwargs):
+        """Record the event."""
+
+        self.events.append(event)
+        if self.onEvent is not None:
+            self.onEvent(event)
 
 
 class TestMaterialAlertListSettings(unittest.TestCase):
@@ -36,5 +88,1284 @@ class TestMaterialAlertListSettings(unittest.TestCase):
         compare(MaterialFilterListConfigTranslator.translate_to_settings(alert_list), expected)
 
 
+class TestMaterialWeightSettings(unittest.TestCase):
+    """Test cases for MaterialWeightConfigTranslator helpers."""
+
+    def test_round_trip(self):  # pylint: disable=no-self-use
+        """Weights survive a round trip, default weights are not stored."""
+
+        weights = {Materials.POLONIUM: 2.5, Materials.IRON: 1.0, Materials.ARSENIC: 0.5}
+        settings = MaterialWeightConfigTranslator.translate_to_settings(weights)
+        compare(settings, ['As=0.5', 'Po=2.5'])
+        compare(MaterialWeightConfigTranslator.translate_from_settings(settings),
+                {Materials.POLONIUM: 2.5, Materials.ARSENIC: 0.5})
+
+    def test_invalid_weights(self):  # pylint: disable=no-self-use
+        """A weight that is not a number is left out, the material gets the default weight."""
+
+        compare(MaterialWeightConfigTranslator.translate_from_settings(['Po=abc', 'Fe=2']), {Materials.IRON: 2.0})
+
+
+class TestMaterials(unittest.TestCase):
+    """Test cases for the indexed `Materials` lookups."""
+
+    def test_lookups(self):
+        """Lookup by name, symbol and id."""
+
+        self.assertIs(Materials.by_name('polonium'), Materials.POLONIUM)
+        self.assertIs(Materials.by_name(u'POLONIUM'), Materials.POLONIUM)
+        self.assertIs(Materials.by_symbol('zr'), Materials.ZIRCONIUM)
+        self.assertIs(Materials.by_id(28), Materials.BORON)
+        self.assertIsNone(Materials.by_name('unobtainium'))
+        self.assertIsNone(Materials.by_id(0))
+
+    def test_by_rarity(self):
+        """All materials are indexed by exactly one rarity."""
+
+        rarities = [Rarities.VERY_COMMON, Rarities.COMMON, Rarities.RARE, Rarities.VERY_RARE]
+        by_rarity = [material for rarity in rarities for material in Materials.by_rarity(rarity)]
+        self.assertEqual(len(by_rarity), len(Materials.items()))
+        self.assertIn(Materials.YTTRIUM, Materials.by_rarity(Rarities.VERY_RARE))
+
+    def test_value_semantics(self):
+        """Model objects hash consistently with equality and can be used as dict keys."""
+
+        self.assertEqual(len({MaterialFilter(Materials.IRON, 1.0), MaterialFilter(Materials.IRON, 1.0)}), 1)
+        self.assertTrue(MaterialFilter(Materials.IRON, 1.0) != MaterialFilter(Materials.IRON, 1.0, False))
+        self.assertFalse(Materials.IRON != Materials.by_symbol('fe'))
+        self.assertIs(MaterialMatch(Materials.IRON, 20.5), MaterialMatch(Materials.IRON, 20.5))
+        self.assertEqual({MaterialMatch(Materials.IRON, 20.5): 1}.get(MaterialMatch(Materials.IRON, 20.5)), 1)
+
+    def test_matches_are_immutable(self):
+        """Interned matches are shared, they can not be changed. Copies are the interned match."""
+
+        match = MaterialMatch(Materials.IRON, 20.5)
+        with self.assertRaises(AttributeError):
+            match.percent = 1.0
+        with self.assertRaises(AttributeError):
+            del match.material
+        compare((MaterialMatch(Materials.IRON, 20.5).material, match.percent), (Materials.IRON, 20.5))
+        self.assertIs(copy.deepcopy(match), match)
+        self.assertIs(pickle.loads(pickle.dumps(match, pickle.HIGHEST_PROTOCOL)), match)
+
+
+class TestCompiledFilterSet(unittest.TestCase):
+    """Test cases for `CompiledFilterSet`."""
+
+    FILTERS = [
+        MaterialFilter(Materials.POLONIUM, 1.0, True),
+        MaterialFilter(Materials.ARSENIC, 2.0, True),
+        MaterialFilter(Materials.IRON, 0.0, False),
+    ]
+
+    def test_matches_in_filter_order(self):
+        """Matches are returned in filter order, disabled filters are skipped."""
+
+        materials = [
+            {'Name': 'iron', 'Percent': 20.0},
+            {'Name': 'arsenic', 'Percent': 2.5},
+            {'Name': 'polonium', 'Percent': 1.2},
+        ]
+        matches = CompiledFilterSet(self.FILTERS).check_matches(materials)
+        self.assertEqual([(m.material, m.percent) for m in matches],
+                         [(Materials.POLONIUM, 1.2), (Materials.ARSENIC, 2.5)])
+
+    def test_matches_dict(self):
+        """Materials can be passed as an EDSM style dict."""
+
+        matches = CompiledFilterSet(self.FILTERS).check_matches({'Arsenic': 1.9, 'Polonium': 1.0})
+        self.assertEqual([(m.material, m.percent) for m in matches], [(Materials.POLONIUM, 1.0)])
+        self.assertEqual(CompiledFilterSet([]).check_matches({'Arsenic': 1.9}), [])
+
+    def test_check_batch(self):
+        """Batch evaluation matches single body evaluation, with and without numpy."""
+
+        bodies = [
+            {'Arsenic': 2.0, 'Polonium': 0.5},
+            None,
+            [{'Name': 'polonium', 'Percent': 1.25}, {'Name': 'iron', 'Percent': 30.0}],
+            {'Iron': 0.0},
+        ]
+        compiled = CompiledFilterSet(self.FILTERS)
+        expected = [[(m.material, m.percent) for m in compiled.check_matches(body)] for body in bodies]
+        for use_numpy in (True, False):
+            batch = compiled.check_batch(bodies, use_numpy)
+            self.assertEqual(batch.matched(), [0, 2])
+            self.assertEqual([[(m.material, m.percent) for m in batch.matches(i)] for i in range(len(batch))],
+                             expected)
+
+
+class TestMaterialRules(unittest.TestCase):
+    """Test cases for composite rules."""
+
+    def test_round_trip(self):
+        """Rules are parsed and written back in their settings representation."""
+
+        for text in ('ALL(Po>=1.10;Y>=2.00)', '2OF(Sb>=1.40;Tc>=1.40;Ru>=2.50)', 'ANY(ALL(Po>=1.10;Y>=2.00);Sb>=1.40)'):
+            compare(str(parse_rule(text)), text)
+        compare(str(parse_rule('all( Po>=1.1 ; Y>=2 )')), 'ALL(Po>=1.10;Y>=2.00)')
+        for text in ('ALL(Po>=1.1', 'XOR(Po>=1.1)', '3OF(Po>=1;Y>=2)', 'ALL(Xx>=1)', 'ALL(Po>1)'):
+            self.assertRaises(MaterialRuleSyntaxError, parse_rule, text)
+
+    def test_translate_from_settings(self):  # pylint: disable=no-self-use
+        """Filters and rules share the settings list."""
+
+        settings = ['Po>=1.10', 'ALL(Po>=1.10;Y>=2.00)', 'ANY(Broken']
+        compare(MaterialFilterListConfigTranslator.translate_from_settings(settings),
+                [MaterialFilter(Materials.POLONIUM, 1.1, True)])
+        invalid = []
+        rules = MaterialFilterListConfigTranslator.translate_rules_from_settings(settings, invalid)
+        compare([str(rule) for rule in rules], ['ALL(Po>=1.10;Y>=2.00)'])
+        compare(invalid, ['ANY(Broken'])
+
+    def test_matches(self):
+        """Matching rules return the matches of their filters."""
+
+        rules = MaterialRuleSet([parse_rule('2OF(Po>=1.00;Y>=2.00;Sb>=1.00)')])
+        compare(rules.check_matches({'polonium': 1.5, 'yttrium': 2.5, 'antimony': 0.5}),
+                [MaterialMatch(Materials.POLONIUM, 1.5), MaterialMatch(Materials.YTTRIUM, 2.5)])
+        compare(rules.check_matches({'polonium': 1.5, 'antimony': 0.5}), [])
+
+    def test_short_circuit(self):
+        """Sub-rules are not evaluated once the outcome is known."""
+
+        rule = parse_rule('ALL(Y>=2.00;Po>=1.00)')
+        for _index in range(40):
+            rule.evaluate({Materials.YTTRIUM.materialId: 2.5})
+        # Polonium never matches, after re-ordering it is tested first and Yttrium is skipped.
+        compare([(str(sub), sub.evaluations) for sub in rule.order], [('Po>=1.00', 40), ('Y>=2.00', 32)])
+        # The rule is still written the way the user did.
+        compare(str(rule), 'ALL(Y>=2.00;Po>=1.00)')
+
+
+class TestBodyPredicates(unittest.TestCase):
+    """Test cases for body attribute predicates."""
+
+    def test_predicates(self):
+        """Expressions are evaluated against EDSM body attributes."""
+
+        body = {'gravity': 0.3, 'distanceToArrival': 1200, 'subType': 'Icy body', 'isLandable': True}
+        for expression, expected in (
+                ('gravity < 0.5 and distanceToArrival < 5000', True),
+                ('gravity < 0.5 and distanceToArrival > 5000', False),
+                ('gravity > 1 or subType == "Icy body"', True),
+                ('not (isLandable == true) or surfaceTemperature < 200', False),
+                ('surfaceTemperature != 200', False),
+        ):
+            compare(compile_predicate(expression).matches(body), expected)
+        self.assertIsNone(compile_predicate('  '))
+        invalid = ('gravity <', 'weight < 1', 'gravity < 1 and', '(gravity < 1', 'gravity < 1 2', 'gravity ~ 1')
+        for expression in invalid:
+            self.assertRaises(BodyPredicateSyntaxError, compile_predicate, expression)
+
+    def test_scan_attributes(self):  # pylint: disable=no-self-use
+        """Journal scan fields are translated into EDSM attributes."""
+
+        entry = {'SurfaceGravity': 9.80665, 'DistanceFromArrivalLS': 12.5, 'Landable': True, 'Radius': 1500000.0}
+        compare(body_attributes_from_scan(entry),
+                {'gravity': 1.0, 'distanceToArrival': 12.5, 'isLandable': True, 'radius': 1500.0})
+
+    def test_scan_values(self):
+        """Journal values are converted to EDSM's wording, so one filter works for both."""
+
+        entry = {'PlanetClass': 'High metal content body', 'TerraformState': 'Terraformable',
+                 'Atmosphere': 'thick methane rich atmosphere'}
+        compare(body_attributes_from_scan(entry), {
+            'subType': 'High metal content world',
+            'terraformingState': 'Candidate for terraforming',
+            'atmosphereType': 'Thick Methane-rich',
+        })
+        predicate = compile_predicate(
+            "subType == 'High metal content world' and terraformingState == 'Candidate for terraforming'",
+        )
+        self.assertTrue(predicate.matches(body_attributes_from_scan(entry)))
+        self.assertFalse(predicate.matches(body_attributes_from_scan(dict(entry, TerraformState=''))))
+        atmospheres = (
+            ('', 'No atmosphere'),
+            ('hot thick carbon dioxide atmosphere', 'Hot thick Carbon dioxide'),
+            ('suitable for water based life', 'Suitable for water-based life'),
+        )
+        for atmosphere, expected in atmospheres:
+            compare(body_attributes_from_scan({'Atmosphere': atmosphere})['atmosphereType'], expected)
+
+
+class TestMaterialPipeline(unittest.TestCase):
+    """Test cases for matching bodies on the EDSM worker."""
+
+    def test_bodies_matcher(self):
+        """Replies become `SystemMatches` with only the accepted bodies with matches, the sketches see all bodies."""
+
+        with open(os.path.join('fixtures', 'edsm-system-body-sol.json'), 'r') as fixture:
+            reply = json.load(fixture)
+        filters = [MaterialFilter(Materials.IRON, 20.0, True)]
+        rules = [parse_rule('ALL(Po>=0.50;Y>=0.50)')]
+        compiled = CompiledFilterSet(filters)
+        rule_set = MaterialRuleSet(rules)
+        expected = []
+        for body in reply['bodies']:
+            if body.get('materials') and body.get('isLandable'):
+                matches = compiled.check_matches(body['materials'])
+                matches += [match for match in rule_set.check_matches(body['materials']) if match not in matches]
+                if matches:
+                    expected.append((body['name'], matches))
+        self.assertTrue(expected)
+
+        sketches = SketchSet()
+        matcher = BodiesMatcher(MatchSnapshot(filters, rules, compile_predicate('isLandable == true')), sketches)
+        queries = EDSMQueries()
+        queries.set_processor('api-system-v1', 'bodies', matcher)
+        queries._http_request = lambda *_args: reply  # pylint: disable=protected-access
+        queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+        queries.queue.put((EDSMQueries.PRIORITY_BACKGROUND, None))
+        queries.worker()
+
+        (_request, matched) = queries.get_response()
+        self.assertIsInstance(matched, SystemMatches)
+        compare((matched.system, matched.bodyCount, matched.scanned), ('Sol', reply['bodyCount'], len(reply['bodies'])))
+        compare(matched.matches, expected)
+        compare(len(sketches.get('iron')), len([body for body in reply['bodies'] if body.get('materials')]))
+        compare(matcher(None, {}), {})
+
+        # The rules of the snapshot are copies: their statistics are merged into the rules shown in the preferences.
+        (evaluations, hits) = (rules[0].evaluations, rules[0].hits)
+        matcher.snapshot.merge_statistics(rules)
+        matcher.snapshot.merge_statistics(rules)
+        probe = MaterialRuleSet([parse_rule('ALL(Po>=0.50;Y>=0.50)')])
+        for body in reply['bodies']:
+            if body.get('isLandable'):
+                probe.check_matches(body.get('materials'))
+        self.assertTrue(probe.rules[0].evaluations)
+        compare((rules[0].evaluations - evaluations, rules[0].hits - hits),
+                (probe.rules[0].evaluations, probe.rules[0].hits))
+
+
+class TestScoring(unittest.TestCase):
+    """Test cases for `MaterialScorer` and `TopBodies`."""
+
+    def test_score(self):
+        """Weighted relative excess over the thresholds."""
+
+        compiled = CompiledFilterSet([MaterialFilter(Materials.POLONIUM, 2.0), MaterialFilter(Materials.IRON, 10.0)])
+        scorer = MaterialScorer(compiled, {Materials.POLONIUM: 2.0})
+        self.assertAlmostEqual(scorer.score([MaterialMatch(Materials.POLONIUM, 3.0)]), 1.0)
+        self.assertAlmostEqual(scorer.score([MaterialMatch(Materials.POLONIUM, 3.0),
+                                             MaterialMatch(Materials.IRON, 15.0)]), 1.5)
+
+    def test_rule_matches(self):
+        """Matches only a rule found are scored against the thresholds of the rule's filters."""
+
+        compiled = CompiledFilterSet([MaterialFilter(Materials.POLONIUM, 1.0), MaterialFilter(Materials.IRON, 25.0)])
+        rule = parse_rule('ALL(Fe>=15;Ni>=10)')
+        scorer = MaterialScorer(compiled, rules=[rule])
+        self.assertAlmostEqual(scorer.score([MaterialMatch(Materials.POLONIUM, 1.5)]), 0.5)
+        rule_matches = MaterialRuleSet([rule]).check_matches({'Iron': 20.0, 'Nickel': 12.0})
+        self.assertAlmostEqual(scorer.score(rule_matches), 5.0 / 15 + 2.0 / 10)
+        compare(MaterialScorer(compiled).score(rule_matches), 0.0)
+
+    def test_top_bodies(self):
+        """Only the best bodies are kept and updates are applied."""
+
+        ranking = TopBodies(2)
+        for body, score in (('a', 1.0), ('b', 3.0), ('c', 2.0), ('d', 0.5)):
+            ranking.update(body, score)
+        self.assertEqual(ranking.best(), [('b', 3.0), ('c', 2.0)])
+        self.assertTrue(ranking.update('c', 4.0))
+        self.assertFalse(ranking.update('d', 0.5))
+        self.assertEqual(ranking.best(), [('c', 4.0), ('b', 3.0)])
+
+
+class TestQuantileSketch(unittest.TestCase):
+    """Test cases for `TDigest` and `SketchSet`."""
+
+    def test_quantiles(self):
+        """Quantile estimates are close, also after merging."""
+
+        generator = random.Random(1)
+        values = [generator.uniform(0.0, 10.0) for _i in range(20000)]
+        digest = TDigest()
+        halves = (TDigest(), TDigest())
+        for index, value in enumerate(values):
+            digest.add(value)
+            halves[index % 2].add(value)
+        halves[0].merge(halves[1])
+
+        for quantile in (0.5, 0.95, 0.99):
+            self.assertAlmostEqual(digest.quantile(quantile), quantile * 10.0, delta=0.05)
+            self.assertAlmostEqual(halves[0].quantile(quantile), quantile * 10.0, delta=0.05)
+        self.assertLess(len(digest.centroids), 2 * digest.compression)
+
+    def test_sketch_set(self):
+        """Bodies are observed once and sketches survive serialization."""
+
+        sketches = SketchSet()
+        self.assertTrue(sketches.observe({'Iron': 20.0, 'Polonium': 1.0}, 'Sol 1'))
+        self.assertFalse(sketches.observe({'Iron': 20.0}, 'Sol 1'))
+        self.assertTrue(sketches.observe([{'Name': 'iron', 'Percent': 30.0}], 'Sol 2'))
+
+        restored = SketchSet.from_dict(sketches.to_dict())
+        self.assertEqual(len(restored.get('IRON')), 2)
+        self.assertEqual(restored.quantiles(0.0, minimum=2), {'iron': 20.0})
+
+    def test_sketch_set_files(self):
+        """Sketches are saved and loaded, unusable files give an empty set."""
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'sketches.json')
+            sketches = SketchSet()
+            sketches.observe({'Iron': 20.0}, 'Sol 1')
+            sketches.save(filename)
+            sketches.save(filename)
+            compare(os.listdir(directory), ['sketches.json'])
+            self.assertEqual(len(SketchSet.load(filename).get('iron')), 1)
+
+            for contents in ('{"version": 1, "sket', '[]', '{"version": 1, "sketches": {"iron": {"c": [[1]]}}}',
+                             '{"version": 1, "sketches": {"iron": {"n": null}}}'):
+                with open(filename, 'w') as sketch_file:
+                    sketch_file.write(contents)
+                self.assertEqual(SketchSet.load(filename).quantiles(0.5, minimum=0), {})
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestThresholdTables(unittest.TestCase):
+    """Test cases for generating threshold tables from a dump."""
+
+    def test_generate(self):
+        """Tables do not depend on the number of processes nor on compression, and can be written and loaded."""
+
+        with open(os.path.join('fixtures', 'edsm-system-body-sol.json'), 'r') as fixture:
+            bodies = json.load(fixture)['bodies']
+        lines = ['['] + [json.dumps(body) + ',' for body in bodies[:-1]] + [json.dumps(bodies[-1]), ']']
+        with_materials = [body for body in bodies if body.get('materials')]
+
+        directory = tempfile.mkdtemp()
+        try:
+            dump = os.path.join(directory, 'bodies.json')
+            with open(dump, 'w') as dump_file:
+                dump_file.write('\n'.join(lines) + '\n')
+            with open(dump, 'rb') as dump_file, gzip.open(dump + '.gz', 'wb') as gzip_file:
+                gzip_file.write(dump_file.read())
+            compare([len(chunk) for chunk in iter_chunks(dump + '.gz', 10)],
+                    [10] * (len(lines) // 10) + ([len(lines) % 10] if len(lines) % 10 else []))
+
+            progress = []
+            tables = generate(dump, processes=1, chunk_size=10, progress=progress.append)
+            compare(generate(dump, processes=2, chunk_size=10), tables)
+            compare(generate(dump + '.gz', processes=2, chunk_size=10), tables)
+            compare((tables['version'], tables['bodies'], progress[-1]),
+                    (THRESHOLDS_VERSION, len(with_materials), len(with_materials)))
+            compare(sorted(tables['subTypes']), sorted(set(body['subType'] for body in with_materials)))
+            iron = [body['materials']['Iron'] for body in with_materials if 'Iron' in body['materials']]
+            self.assertLessEqual(tables['percentiles']['iron']['50'], max(iron))
+            self.assertLessEqual(tables['percentiles']['iron']['50'], tables['thresholds']['iron'])
+
+            filename = os.path.join(directory, 'thresholds.json')
+            self.assertIsNone(load_thresholds(filename))
+            write_thresholds(tables, filename)
+            compare(load_thresholds(filename), tables['thresholds'])
+            write_thresholds(dict(tables, version=THRESHOLDS_VERSION + 1), filename)
+            self.assertIsNone(load_thresholds(filename))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_failing_worker(self):
+        """A worker failing to summarize a chunk makes `generate()` raise instead of waiting for it forever."""
+
+        def broken(_lines, _everything, _sub_types):
+            """Summarize nothing."""
+            raise ValueError("broken")
+
+        directory = tempfile.mkdtemp()
+        summarize = threshold_tables._summarize  # pylint: disable=protected-access
+        try:
+            dump = os.path.join(directory, 'bodies.json')
+            with open(dump, 'w') as dump_file:
+                dump_file.write('[\n' + '{"name": "Body", "materials": {"Iron": 20.0}},\n' * 100 + '{}\n]\n')
+            # The workers are forked and inherit the broken summary.
+            threshold_tables._summarize = broken  # pylint: disable=protected-access
+            with self.assertRaisesRegexp(RuntimeError, 'ValueError: broken'):
+                generate(dump, processes=2, chunk_size=10)
+        finally:
+            threshold_tables._summarize = summarize  # pylint: disable=protected-access
+            shutil.rmtree(directory)
+
+
+class TestLogger(unittest.TestCase):
+    """Test cases for `Logger`."""
+
+    def test_disabled_levels_are_not_formatted(self):
+        """Lazy messages are only built when the level is enabled for the caller."""
+
+        class Caller(object):  # pylint: disable=too-few-public-methods
+            """Caller with a log level override."""
+
+            logLevel = LOG_DEBUG
+            logPrefix = ''
+
+        def fail():
+            """Message callable which may not be called."""
+            raise AssertionError("Message formatted while disabled")
+
+        logger = Logger(LOG_INFO)
+        self.assertFalse(logger.is_enabled_for(None, LOG_DEBUG))
+        self.assertTrue(logger.is_enabled_for(Caller(), LOG_DEBUG))
+        logger.debug(None, fail)
+        logger.debug(None, "{0}", fail)
+
+
+class TestLogWriter(unittest.TestCase):
+    """Test cases for `LogWriter`."""
+
+    def setUp(self):
+        """Create a scratch directory."""
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the scratch directory."""
+
+        shutil.rmtree(self.directory)
+
+    def test_rotation(self):
+        """Records end up in the rotated files in order."""
+
+        filename = os.path.join(self.directory, 'test.log')
+        writer = LogWriter(batch_size=1, stdout=False, filename=filename, max_bytes=20, backup_count=2)
+        for index in range(6):
+            writer.write("record {index}".format(index=index))
+        writer.stop()
+
+        contents = []
+        for name in (filename + '.2', filename + '.1', filename):
+            with open(name) as log_file:
+                contents.append(log_file.read())
+        self.assertEqual(contents, ["record 0\nrecord 1\n", "record 2\nrecord 3\n", "record 4\nrecord 5\n"])
+        self.assertEqual(writer.dropped, 0)
+
+    def test_unwritable_file(self):
+        """A file that can not be opened is reported and the writer carries on."""
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            writer = LogWriter(stdout=False, filename=os.path.join(self.directory, 'missing', 'test.log'))
+            writer.write("lost")
+            writer.flush()
+            filename = os.path.join(self.directory, 'test.log')
+            writer.set_file(filename)
+            writer.write("kept")
+            writer.flush()
+            writer.stop()
+            self.assertIn("Unable to open", sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+        with open(filename) as log_file:
+            self.assertEqual(log_file.read(), "kept\n")
+
+    def test_restart_after_stop(self):
+        """A writer that did not stop in time is not joined by a second one, it is replaced once it exited."""
+
+        def writers():
+            """Return the running writer threads."""
+            return set(thread for thread in threading.enumerate() if thread.name == 'Materializer log writer')
+
+        others = writers()
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            writer = LogWriter()
+            busy = threading.Event()
+            writer.queue.put((busy.wait, 5.0))  # Keeps the writer busy, like a slow disk.
+            writer.write("first")
+            first = writer.thread
+            writer.stop(timeout=0.1)
+            writer.write("second")
+            self.assertIs(writer.thread, first)
+            compare(writers() - others, set([first]))
+
+            busy.set()
+            writer.stop()
+            self.assertIsNone(writer.thread)
+            writer.write("third")
+            self.assertIsNot(writer.thread, first)
+            writer.stop()
+            compare(sys.stdout.getvalue(), "first\nsecond\nthird\n")
+        finally:
+            sys.stdout = stdout
+
+
+class TestEDSMProjection(unittest.TestCase):
+    """Test cases for the streaming projection of EDSM replies."""
+
+    def test_chunks(self):  # pylint: disable=no-self-use
+        """Any split of the reply gives the same compact records, even inside numbers and utf-8 sequences."""
+
+        with open(os.path.join('fixtures', 'edsm-system-body-sol.json'), 'r') as fixture:
+            reply = json.load(fixture)
+        reply['bodies'][0]['name'] = u'Sol \xe9'
+        text = json.dumps(reply, ensure_ascii=False).encode('utf-8')
+        expected = BODIES_PROJECTION.project(reply)
+        compare(all(set(body) <= BODIES_PROJECTION.itemFields for body in expected['bodies']), True)
+        compare(['parents' in body for body in (reply['bodies'][1], expected['bodies'][1])], [True, False])
+
+        for size in (1, 7, 1000, len(text)):
+            chunks = [text[start:start + size] for start in range(0, len(text), size)]
+            compare(BODIES_PROJECTION.parse(chunks), expected)
+        compare(BODIES_PROJECTION.parse(['{"name": "Empty", "bodyCount": 1', '2, "bodies": []}']),
+                {'name': 'Empty', 'bodyCount': 12, 'bodies': []})
+
+    def test_invalid_replies(self):
+        """Truncated or unexpected replies raise a `ProjectionError`."""
+
+        for chunks in (['{"name": "Sol", "bodies": [{"name": "Earth"}'], ['[]'], ['{"name" "Sol"}'], []):
+            self.assertRaises(ProjectionError, BODIES_PROJECTION.parse, chunks)
+
+
+class TestEDSMCache(unittest.TestCase):
+    """Test cases for `EDSMCache`."""
+
+    def setUp(self):
+        """Create a scratch directory."""
+
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache.sqlite')
+
+    def tearDown(self):
+        """Remove the scratch directory."""
+
+        shutil.rmtree(self.directory)
+
+    def test_persistence(self):
+        """Replies survive reopening, the params are normalized and stale replies are flagged."""
+
+        cache = EDSMCache(self.filename)
+        self.assertIsNone(cache.get('api-system-v1', 'bodies', {'systemName': 'Sol'}))
+        self.assertTrue(cache.put('api-system-v1', 'bodies', {'systemName': 'Sol'}, {'name': 'Sol'}))
+        self.assertFalse(cache.put('api-system-v1', 'bodies', {'systemName': 'Sol'}, {'name': 'Sol'}))
+        cache.put('api-system-v1', 'status', {'systemName': 'Sol'}, {'status': 1})
+        cache.close()
+
+        cache = EDSMCache(self.filename)
+        compare(cache.get('api-system-v1', 'bodies', {'systemName': ' sol'}), ({'name': 'Sol'}, True))
+        cache.ttls[('api-system-v1', 'status')] = -1
+        compare(cache.get('api-system-v1', 'status', {'systemName': 'Sol'}), ({'status': 1}, False))
+        cache.close()
+
+    def test_eviction(self):
+        """The least recently used replies are evicted first."""
+
+        cache = EDSMCache(max_entries=2)
+        cache.put('api-system-v1', 'bodies', {'systemName': 'A'}, 'a')
+        cache.put('api-system-v1', 'bodies', {'systemName': 'B'}, 'b')
+        cache.get('api-system-v1', 'bodies', {'systemName': 'A'})
+        cache.put('api-system-v1', 'bodies', {'systemName': 'C'}, 'c')
+        compare(len(cache), 2)
+        self.assertIsNone(cache.get('api-system-v1', 'bodies', {'systemName': 'B'}))
+        self.assertIsNotNone(cache.get('api-system-v1', 'bodies', {'systemName': 'A'}))
+
+    def test_hits_do_not_write(self):
+        """A hit only notes the access time, it is written by the next put or when the cache is closed."""
+
+        cache = EDSMCache(self.filename)
+        cache.put('api-system-v1', 'bodies', {'systemName': 'Sol'}, {'name': 'Sol'})
+        changes = cache.connection.total_changes
+        cache.get('api-system-v1', 'bodies', {'systemName': 'Sol'})
+        compare(cache.connection.total_changes, changes)
+        accessed = cache.accessed[cache.key('api-system-v1', 'bodies', {'systemName': 'Sol'})]
+        cache.close()
+
+        cache = EDSMCache(self.filename)
+        compare(cache.connection.execute("SELECT accessed FROM replies").fetchall(), [(accessed,)])
+        cache.close()
+
+    def test_queries_serve_hits(self):
+        """A fresh hit is delivered right away without queueing a request, a stale one is revalidated."""
+
+        queries = EDSMQueries()
+        queries.callbackRoot = FakeTkRoot()
+        queries.set_cache(EDSMCache(ttls={('api-system-v1', 'stale'): -1}))
+        queries.cache.put('api-system-v1', 'bodies', {'systemName': 'Sol'}, {'name': 'Sol'})
+        queries.cache.put('api-system-v1', 'stale', {'systemName': 'Sol'}, {'name': 'Sol'})
+
+        queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+        compare(queries.get_response(), (('api-system-v1', 'bodies', 'GET', {'systemName': 'Sol'}), {'name': 'Sol'}))
+        compare(queries.callbackRoot.events, ['<<EDSMCallback>>'])
+        self.assertTrue(queries.queue.empty())
+
+        queries.request_get('api-system-v1', 'stale', systemName='Sol')
+        self.assertIsNotNone(queries.get_response())
+        compare(queries.queue.qsize(), 1)
+
+        # EDSM went down before the refresh is sent: the stale reply is not delivered a second time.
+        queries.circuitBreaker = CircuitBreaker(failure_threshold=1, reset_timeout=3600)
+        queries.circuitBreaker.record_failure()
+        queries.logLevel = 0
+        queries.queue.put((EDSMQueries.PRIORITY_BACKGROUND, None))
+        queries.worker()
+        compare((queries.get_responses(), queries.counters['failedFast']), ([], 1))
+        self.assertFalse(queries.revalidating)
+
+    def test_cache_hits_are_processed_on_a_thread(self):
+        """The processor does not run on the thread requesting a cached reply, replies still arrive in order."""
+
+        processed = []
+
+        def processor(request, reply):
+            """Record the thread and slow down the first reply."""
+            if reply['name'] == 'Sol':
+                time.sleep(0.1)
+            processed.append(threading.current_thread().name)
+            return reply['name'].upper()
+
+        queries = EDSMQueries()
+        queries.set_cache(EDSMCache())
+        queries.set_processor('api-system-v1', 'bodies', processor)
+        queries.cache.put('api-system-v1', 'bodies', {'systemName': 'Sol'}, {'name': 'Sol'})
+        queries.cache.put('api-system-v1', 'status', {'systemName': 'Sol'}, {'name': 'Sol'})
+
+        queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+        queries.request_get('api-system-v1', 'status', systemName='Sol')
+        compare(queries.get_responses(), [])
+        deadline = time.time() + 5
+        responses = []
+        while len(responses) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+            responses.extend(queries.get_responses())
+        compare([reply for _request, reply in responses], ['SOL', {'name': 'Sol'}])
+        compare(processed, ['EDSM Queries processor'])
+        queries.stop(0)
+        self.assertIsNone(queries.processThread)
+
+    def test_conditional_requests(self):
+        """Both engines revalidate stale replies with their validators, a 304 is not parsed nor delivered again."""
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """Serves a gzipped reply with an ETag."""
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Answer a GET request, conditional on the ETag."""
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.send_header('ETag', '"v1"')
+                    self.end_headers()
+                    return
+                compressed = StringIO()
+                with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+                    gzip_file.write(json.dumps({'name': 'Sol', 'padding': ' ' * 1000}))
+                body = compressed.getvalue()
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Be quiet."""
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base_url = 'http://127.0.0.1:{port}'.format(port=server.server_address[1])
+        try:
+            for queries in (EDSMQueries(workers=1, base_url=base_url), AsyncEDSMQueries(base_url=base_url)):
+                queries.set_cache(EDSMCache(ttls={('api-system-v1', 'bodies'): -1}))
+                queries.start(FakeTkRoot())
+                for _index in range(2):
+                    queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+                    queries.queue.join()
+                queries.stop()
+                queries.session.close()
+
+                compare([reply['name'] for (_request, reply) in queries.resultQueue], ['Sol', 'Sol'])
+                compare(queries.counters['notModified'], 1)
+                self.assertTrue(0 < queries.counters['bytesReceived'] < queries.counters['bytesDecoded'])
+                compare(queries.cache.validators('api-system-v1', 'bodies', {'systemName': 'sol'}), {'etag': '"v1"'})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestEDSMQueries(unittest.TestCase):
+    """Test cases for `EDSMQueries`."""
+
+    def test_coalescing(self):
+        """Identical pending requests are sent once and their reply is delivered once."""
+
+        queries = EDSMQueries()
+        sent = []
+
+        def http_request(api, endpoint, method, request_params, *_args):
+            """Record the request."""
+            sent.append((api, endpoint, method, request_params))
+            return {'name': request_params['systemName']}
+        queries._http_request = http_request  # pylint: disable=protected-access
+
+        queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+        queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+        queries.request_get('api-system-v1', 'bodies', systemName='Achenar')
+        compare(queries.counters, {'requests': 3, 'coalesced': 1, 'dropped': 0, 'cancelled': 0, 'retries': 0,
+                                   'failedFast': 0, 'expired': 0, 'notModified': 0, 'bytesReceived': 0,
+                                   'bytesDecoded': 0})
+
+        queries.queue.put((EDSMQueries.PRIORITY_BACKGROUND, None))
+        queries.worker()
+        compare([params['systemName'] for (_api, _endpoint, _method, params) in sent], ['Sol', 'Achenar'])
+        compare([reply for (_request, reply) in queries.resultQueue], [{'name': 'Sol'}, {'name': 'Achenar'}])
+        compare(queries.pending, {})
+
+    def test_priorities(self):
+        """Requests are served by priority, stale system requests are cancelled and the queue is bounded."""
+
+        queries = EDSMQueries()
+        queries.queue.maxRequests = 3
+        queries.request_get('api-system-v1', 'bodies', EDSMQueries.PRIORITY_BACKGROUND, systemName='Background')
+        queries.request_get('api-system-v1', 'bodies', systemName='Left')
+        queries.request_get('api-system-v1', 'bodies', EDSMQueries.PRIORITY_PREFETCH, systemName='Next')
+        queries.set_current_system('Current')
+        queries.request_get('api-system-v1', 'bodies', systemName='Current')
+        # Full: the background request makes way, another background request is refused.
+        queries.request_get('api-system-v1', 'bodies', EDSMQueries.PRIORITY_CURRENT, systemName='Other')
+        queries.request_get('api-system-v1', 'bodies', EDSMQueries.PRIORITY_BACKGROUND, systemName='More')
+
+        served = []
+        while not queries.queue.empty():
+            served.append(queries.queue.get()[3]['systemName'])
+        compare(served, ['Current', 'Other', 'Next'])
+        compare(queries.counters, {'requests': 6, 'coalesced': 0, 'dropped': 2, 'cancelled': 1, 'retries': 0,
+                                   'failedFast': 0, 'expired': 0, 'notModified': 0, 'bytesReceived': 0,
+                                   'bytesDecoded': 0})
+        compare(sorted(key[3][0][1] for key in queries.pending), ['Current', 'Next', 'Other'])
+
+    def test_retries_and_circuit_breaker(self):
+        """Failures are retried, too many failed requests open the breaker and cached replies are used."""
+
+        queries = EDSMQueries()
+        queries.BACKOFF_BASE = 0
+        queries.circuitBreaker = CircuitBreaker(failure_threshold=2, reset_timeout=3600)
+        queries.set_cache(EDSMCache())
+        queries.cache.put('api-system-v1', 'bodies', {'systemName': 'Cached'}, {'name': 'Cached'})
+        calls = []
+
+        def http_request(api, endpoint, method, request_params, *_args):
+            """Fail like an unreachable EDSM."""
+            calls.append(request_params['systemName'])
+            raise RequestsConnectionError('down')
+        queries._http_request = http_request  # pylint: disable=protected-access
+
+        for system in ('A', 'B', 'C', 'Cached'):
+            queries.queue.put_bounded(('api-system-v1', 'bodies', 'GET', {'systemName': system}), 0)
+        queries.queue.put((EDSMQueries.PRIORITY_BACKGROUND, None))
+        queries.worker()
+
+        compare(calls, ['A', 'A', 'A', 'B', 'B', 'B'])
+        compare(queries.circuitBreaker.state, CircuitBreaker.OPEN)
+        compare((queries.counters['retries'], queries.counters['failedFast']), (4, 2))
+        compare([reply for (_request, reply) in queries.resultQueue], [{'name': 'Cached'}])
+
+    def test_expired_probe(self):
+        """In both engines, a half-open probe expiring on a long Retry-After opens the breaker again."""
+
+        with StandInEDSM(template='Sol', throttled=1.0, retry_after=120) as stand_in:
+            for queries in (EDSMQueries(workers=1, base_url=stand_in.base_url),
+                            AsyncEDSMQueries(base_url=stand_in.base_url)):
+                queries.logLevel = 0  # The errors are expected.
+                queries.circuitBreaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+                queries.circuitBreaker.record_failure()
+                queries.start(FakeTkRoot())
+                stand_in.throttled = 1.0
+                queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+                queries.queue.join()
+                compare((queries.circuitBreaker.state, queries.counters['expired']), (CircuitBreaker.OPEN, 1))
+
+                stand_in.throttled = 0.0
+                queries.request_get('api-system-v1', 'bodies', systemName='Achenar')
+                queries.queue.join()
+                queries.stop()
+                queries.session.close()
+                compare((queries.circuitBreaker.state, queries.counters['failedFast']), (CircuitBreaker.CLOSED, 0))
+                compare([reply['name'] for (_request, reply) in queries.get_responses()], ['Achenar'])
+
+    def test_non_json_replies(self):
+        """A reply that is not json fails like a broken one, errors don't stop the worker nor strand requests."""
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """Serves a maintenance page."""
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Answer a GET request with html."""
+                body = b'<html><body>Down for maintenance</body></html>'
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Be quiet."""
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        queries = EDSMQueries(workers=1, base_url='http://127.0.0.1:{port}'.format(port=server.server_address[1]))
+        queries.BACKOFF_BASE = 0
+        queries.logLevel = 0  # The errors are expected.
+        try:
+            for _index in range(2):
+                queries.request_get('api-status-v1', 'elite-server')
+            queries.queue.put((EDSMQueries.PRIORITY_BACKGROUND, None))
+            queries.worker()
+        finally:
+            queries.session.close()
+            server.shutdown()
+            server.server_close()
+        compare((queries.pending, queries.counters['coalesced'], queries.counters['retries']), ({}, 1, 2))
+
+        def broken(_request):
+            """Fail unexpectedly."""
+            raise RuntimeError('broken')
+        queries._validators = broken  # pylint: disable=protected-access
+        queries.request_get('api-status-v1', 'elite-server')
+        queries.request_get('api-status-v1', 'elite-server')
+        queries.queue.put((EDSMQueries.PRIORITY_BACKGROUND, None))
+        queries.worker()
+        compare((queries.pending, queries.queue.empty()), ({}, True))
+
+    def test_client_errors_are_not_retried(self):
+        """A 404 is not retried, a 429 honours Retry-After."""
+
+        queries = EDSMQueries()
+        queries.BACKOFF_BASE = 0
+        response = Response()
+        response.status_code = 429
+        response.headers['Retry-After'] = '0'
+        compare(queries._retry_after(response), 0.0)  # pylint: disable=protected-access
+        response.status_code = 404
+        calls = []
+
+        def http_request(api, endpoint, method, request_params, *_args):
+            """Answer not found."""
+            calls.append(request_params)
+            raise HTTPError('not found', response=response)
+        queries._http_request = http_request  # pylint: disable=protected-access
+
+        self.assertIsNone(queries._perform(('api-system-v1', 'bodies', 'GET', {})))  # pylint: disable=protected-access
+        compare((len(calls), queries.circuitBreaker.state), (1, CircuitBreaker.CLOSED))
+
+    def test_deadlines_and_bounded_stop(self):
+        """Requests give up when they would miss their deadline, stop() returns in time for both engines."""
+
+        queries = EDSMQueries()
+        queries.DEADLINE = 1.0
+        queries.set_rate_limiter(TokenBucket(capacity=1, rate=0.01))
+        queries.rateLimiter.consume()
+        self.assertIsNone(queries._perform(('api-system-v1', 'bodies', 'GET', {})))  # pylint: disable=protected-access
+        compare(queries.counters['expired'], 1)
+
+        # Connections are accepted by the backlog, but never answered.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        base_url = 'http://127.0.0.1:{port}'.format(port=listener.getsockname()[1])
+        try:
+            # A worker blocked in a read can only be abandoned, the event loop closes it's connections.
+            for queries, abandoned in ((EDSMQueries(workers=1, base_url=base_url), 1),
+                                       (AsyncEDSMQueries(base_url=base_url), 0)):
+                queries.API_TIMEOUT = 1
+                queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+                queries.start(FakeTkRoot())
+                time.sleep(0.2)
+                queries.stop(timeout=0.3)
+                queries.session.close()
+                self.assertLess(queries.shutdownSeconds, 0.5)
+                compare(queries.abandonedWorkers, abandoned)
+                compare(list(queries.resultQueue), [])
+        finally:
+            listener.close()
+
+    def test_pool_delivers_in_order(self):
+        """Replies from concurrent workers are delivered in request order per system."""
+
+        queries = EDSMQueries(workers=4)
+        delays = {'1': 0.05, '2': 0.0, '3': 0.02, '4': 0.0}
+
+        def http_request(api, endpoint, method, request_params, *_args):
+            """Answer after a delay, so the replies complete out of order."""
+            time.sleep(delays[request_params['id']])
+            return request_params['id']
+        queries._http_request = http_request  # pylint: disable=protected-access
+
+        for index in ('1', '2', '3', '4'):
+            queries.request_get('api-system-v1', 'bodies', systemName='Sol', id=index)
+        queries.start(FakeTkRoot())
+        queries.queue.join()
+        queries.stop()
+        compare([reply for (_request, reply) in queries.resultQueue], ['1', '2', '3', '4'])
+
+    def test_ordered_delivery(self):  # pylint: disable=no-self-use
+        """Completed items are held back until the earlier ones in their stream are done."""
+
+        delivered = []
+        delivery = OrderedDelivery(lambda request, reply: delivered.append(reply))
+        first, second, third = [delivery.issue('sol') for _index in range(3)]
+        other = delivery.issue('achenar')
+        delivery.complete('sol', third, ('request', 'third'))
+        delivery.complete('achenar', other, ('request', 'other'))
+        delivery.complete('sol', second, None)
+        compare(delivered, ['other'])
+        delivery.complete('sol', first, ('request', 'first'))
+        compare(delivered, ['other', 'first', 'third'])
+        compare(delivery.issued, {})
+
+    def test_delivery_does_not_hold_the_lock(self):  # pylint: disable=no-self-use
+        """The Tk thread can issue sequence numbers while a worker waits for it in `event_generate`."""
+
+        issued = []
+
+        def wait_for_tk(_event):
+            """Wait, like with threaded Tcl, for the Tk thread which is making a request."""
+            done = threading.Event()
+
+            def issue():
+                """Stand in for the Tk thread making a request."""
+                queries.delivery.issue('achenar')
+                done.set()
+
+            threading.Thread(target=issue).start()
+            issued.append(done.wait(2.0))
+
+        queries = EDSMQueries()
+        queries.callbackRoot = FakeTkRoot(wait_for_tk)
+        request = ('api-system-v1', 'bodies', 'GET', {'systemName': 'Sol'})
+        worker = threading.Thread(target=queries.delivery.complete, args=('sol', queries.delivery.issue('sol'),
+                                                                          (request, {'name': 'Sol'})))
+        worker.start()
+        worker.join()
+        compare(issued, [True])
+        compare(len(queries.get_responses()), 1)
+
+    def test_coalesced_notifications(self):  # pylint: disable=no-self-use
+        """One event covers all replies delivered until they are taken."""
+
+        queries = EDSMQueries()
+        queries.callbackRoot = FakeTkRoot()
+        for index in range(3):
+            queries._deliver(('api-system-v1', 'bodies', 'GET', {}), index)  # pylint: disable=protected-access
+        compare(queries.callbackRoot.events, ['<<EDSMCallback>>'])
+        compare([reply for (_request, reply) in queries.get_responses()], [0, 1, 2])
+        compare(queries.get_responses(), [])
+
+        queries._deliver(('api-system-v1', 'bodies', 'GET', {}), 3)  # pylint: disable=protected-access
+        compare(queries.callbackRoot.events, ['<<EDSMCallback>>', '<<EDSMCallback>>'])
+
+
+class TestAsyncEDSMQueries(unittest.TestCase):
+    """Test cases for the event loop engine."""
+
+    def test_response_parser(self):  # pylint: disable=no-self-use
+        """Responses can arrive in pieces, chunked and gzipped."""
+
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+            gzip_file.write(b'{"name": "Sol"}')
+        body = compressed.getvalue()
+        data = b''.join([
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nContent-Encoding: gzip\r\n\r\n',
+            b'5\r\n', body[:5], b'\r\n',
+            '{size:x}\r\n'.format(size=len(body) - 5).encode('ascii'), body[5:], b'\r\n',
+            b'0\r\n\r\n',
+            b'HTTP/1.1 404 Not Found\r\nContent-Length: 2\r\nConnection: close\r\n\r\nno',
+        ])
+
+        parser = ResponseParser()
+        responses = []
+        for index in range(0, len(data), 7):
+            responses.append(parser.feed(data[index:index + 7]))
+        compare([(item.status_code, item.content, item.keepAlive) for item in responses if item is not None],
+                [(200, b'{"name": "Sol"}', True), (404, b'no', False)])
+
+    def test_requests(self):
+        """Requests are sent over keep-alive connections and delivered in order."""
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """Answers with the query string as the system name."""
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Answer a GET request."""
+                body = json.dumps({'path': self.path})
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Be quiet."""
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        queries = AsyncEDSMQueries(max_connections=1, base_url='http://127.0.0.1:{port}'.format(
+            port=server.server_address[1],
+        ))
+        try:
+            for system in ('Sol', 'Achenar', 'Sol'):
+                queries.request_get('api-system-v1', 'bodies', systemName=system, showId=1)
+            queries.start(FakeTkRoot())
+            queries.queue.join()
+        finally:
+            queries.stop()
+            server.shutdown()
+            server.server_close()
+
+        compare([reply['path'] for (_request, reply) in queries.resultQueue], [
+            '/api-system-v1/bodies?showId=1&systemName=Sol',
+            '/api-system-v1/bodies?showId=1&systemName=Achenar',
+        ])
+        compare(queries.counters['coalesced'], 1)
+
+    def test_abandoned_loop(self):  # pylint: disable=no-self-use
+        """A reply an abandoned loop finishes after `stop()` is dropped, the cache is closed by then."""
+
+        queries = AsyncEDSMQueries()
+        queries.set_cache(EDSMCache())
+        queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+        job = Job(queries.queue.get_nowait(), generation=queries.generation)
+        queries.active = 1
+        queries.stop(0)
+        queries.cache.close()
+        queries._done(job, {'name': 'Sol'})  # pylint: disable=protected-access
+        compare((list(queries.resultQueue), queries.active), ([], 0))
+
+
+class TestEDSMMetrics(unittest.TestCase):
+    """Test cases for `EDSMMetrics`."""
+
+    def test_histograms_and_snapshot(self):
+        """Values are counted in fixed buckets, the snapshot is json serializable and can be dumped."""
+
+        histogram = Histogram((0.01, 0.1, 1.0))
+        for value in (0.005, 0.05, 0.05, 0.5, 5.0):
+            histogram.observe(value)
+        compare(histogram.counts, [1, 2, 1, 1])
+        compare((histogram.quantile(0.5), histogram.quantile(0.99)), (0.1, 5.0))
+
+        metrics = EDSMMetrics(clock=lambda: 100.0)
+        metrics.count('retries', api='api-system-v1', endpoint='bodies')
+        metrics.observe('http', 0.2, 'api-system-v1', 'bodies')
+        metrics.observe('dispatch', 0.002)
+        for depth in (3, 7, 0):
+            metrics.gauge('queueDepth', depth)
+        snapshot = json.loads(json.dumps(metrics.snapshot()))
+        compare(snapshot['gauges'], {'queueDepth': {'value': 0, 'max': 7}})
+        compare(snapshot['histograms']['dispatch']['count'], 1)
+        compare(snapshot['endpoints']['api-system-v1/bodies']['counters'], {'retries': 1})
+        compare(snapshot['endpoints']['api-system-v1/bodies']['histograms']['http']['p50'], 0.2)
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'metrics.json')
+            dump = MetricsDump(metrics.snapshot, filename, interval=60).start()
+            dump.stop()
+            with open(filename) as dumped:
+                compare(json.load(dumped), snapshot)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_queries(self):
+        """Both engines record the queue wait, http and parse times, retries, failures, bytes and the dispatch delay."""
+
+        with StandInEDSM(fixtures={}) as stand_in:
+            for queries in (EDSMQueries(workers=1, base_url=stand_in.base_url),
+                            AsyncEDSMQueries(base_url=stand_in.base_url)):
+                queries.BACKOFF_BASE = 0.01
+                queries.logLevel = 0  # The errors are expected.
+                stand_in.errors = 0.0
+                queries.start(FakeTkRoot())
+                queries.request_get('api-status-v1', 'elite-server')
+                queries.queue.join()
+                stand_in.errors = 1.0
+                queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+                queries.queue.join()
+                compare(len(queries.get_responses()), 1)
+                queries.stop()
+                queries.session.close()
+
+                snapshot = queries.metrics_snapshot()
+                status = snapshot['endpoints']['api-status-v1/elite-server']
+                bodies = snapshot['endpoints']['api-system-v1/bodies']
+                compare([status['histograms'][name]['count'] for name in ('queueWait', 'http', 'parse')], [1, 1, 1])
+                self.assertTrue(status['counters']['bytesReceived'] > 0)
+                compare((bodies['counters']['retries'], bodies['counters']['failures']), (2, 1))
+                compare(bodies['histograms']['http']['count'], 3)
+                compare(snapshot['histograms']['dispatch']['count'], 1)
+                compare(snapshot['counters']['requests'], 2)
+
+
+class TestEDSMStandIn(unittest.TestCase):
+    """Test cases for `StandInEDSM`."""
+
+    def test_fixtures(self):
+        """Fixtures are found next to the module, whatever the working directory."""
+
+        cwd = os.getcwd()
+        os.chdir(tempfile.gettempdir())
+        try:
+            self.assertIn('sol', load_fixtures())
+        finally:
+            os.chdir(cwd)
+
+    def test_replies(self):  # pylint: disable=no-self-use
+        """Fixtures, the template, the rate limit budget and injected faults."""
+
+        stand_in = StandInEDSM(template='Sol', rate_limit=(2, 60))
+        try:
+            replies = [stand_in.reply('/api-system-v1/bodies', {'systemName': name}) for name in ('sol', 'Achenar')]
+            compare([json.loads(body)['name'] for (_delay, _status, _headers, body) in replies], ['Sol', 'Achenar'])
+            compare([headers['X-Rate-Limit-Remaining'] for (_delay, _status, headers, _body) in replies], ['1', '0'])
+            (_delay, status, headers, _body) = stand_in.reply('/api-status-v1/elite-server', {})
+            compare((status, headers['Retry-After']), (429, '30'))
+        finally:
+            stand_in.stop()
+
+        stand_in = StandInEDSM(fixtures={}, errors=0.5, throttled=0.5, retry_after=2, seed=1)
+        try:
+            statuses = set(stand_in.reply('/api-system-v1/bodies', {})[1] for _index in range(50))
+            compare(statuses, set([429, 500, 502, 503]))
+            stand_in.errors = stand_in.throttled = 0.0
+            compare(stand_in.reply('/api-system-v1/bodies', {'systemName': 'Sol'})[1:], (200, {}, '{}'))
+            compare(stand_in.reply('/api-system-v1/unknown', {})[1], 404)
+        finally:
+            stand_in.stop()
+
+    def test_queries(self):  # pylint: disable=no-self-use
+        """Both engines read slowly dripping replies and follow the rate limit headers."""
+
+        with StandInEDSM(rate_limit=(100, 50), drip=(8192, 0.001)) as stand_in:
+            for queries in (EDSMQueries(workers=1, base_url=stand_in.base_url),
+                            AsyncEDSMQueries(base_url=stand_in.base_url)):
+                queries.set_projection('api-system-v1', 'bodies', BODIES_PROJECTION)
+                queries.start(FakeTkRoot())
+                queries.request_get('api-system-v1', 'bodies', systemName='Sol')
+                queries.request_get('api-status-v1', 'elite-server')
+                queries.queue.join()
+                queries.stop()
+                queries.session.close()
+
+                replies = dict((request[1], reply) for (request, reply) in queries.resultQueue)
+                compare((replies['bodies']['name'], len(replies['bodies']['bodies'])), ('Sol', 40))
+                compare(replies['elite-server']['status'], 2)
+                compare(queries.rateLimiter.capacity, 100.0)
+        compare(stand_in.stats, {200: 4})
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test cases for `CircuitBreaker`."""
+
+    def test_states(self):
+        """Closed, open after the failures, half-open after the timeout and closed after a good probe."""
+
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 10.0
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(breaker.allow())
+        compare(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        compare((breaker.state, breaker.trips), (CircuitBreaker.OPEN, 2))
+        now[0] = 20.0
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        compare(breaker.state, CircuitBreaker.CLOSED)
+
+        # A probe without an outcome.
+        breaker.record_failure()
+        breaker.record_failure()
+        now[0] = 30.0
+        self.assertTrue(breaker.allow())
+        breaker.release_probe()
+        compare((breaker.state, breaker.openedAt, breaker.trips), (CircuitBreaker.OPEN, 30.0, 3))
+        breaker.record_success()
+        breaker.release_probe()
+        compare(breaker.state, CircuitBreaker.CLOSED)
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Test cases for `TokenBucket`."""
+
+    def setUp(self):
+        """Use a fake clock."""
+
+        self.now = 1000.0
+
+    def clock(self):
+        """Return the fake time."""
+
+        return self.now
+
+    def test_burst_and_pace(self):
+        """Requests burst while there is budget, then get spaced out."""
+
+        bucket = TokenBucket(capacity=20, rate=0.5, clock=self.clock)
+        delays = []
+        for _index in range(20):
+            delays.append(round(bucket.delay(), 2))
+            bucket.consume()
+        compare(delays[:17], [0.0] * 17)
+        compare(delays[17:], [0.67, 1.33, 2.0])
+        compare(bucket.delay(), 2.0)
+        self.now += 1.0
+        compare(bucket.delay(), 1.0)
+        compare([bucket.reserve(), bucket.reserve()], [1.0, 3.0])
+
+    def test_headers(self):
+        """The bucket follows the EDSM rate limit headers and survives a restart."""
+
+        bucket = TokenBucket(clock=self.clock)
+        bucket.update({'X-Rate-Limit-Limit': '360', 'X-Rate-Limit-Remaining': '0', 'X-Rate-Limit-Reset': '3600'})
+        compare((bucket.capacity, bucket.tokens, bucket.rate), (360.0, 0.0, 0.1))
+        compare(bucket.delay(), 10.0)
+        bucket.update({})
+        compare(bucket.tokens, 0.0)
+
+        self.now += 100
+        restored = TokenBucket.from_dict(bucket.to_dict(), self.clock)
+        compare((restored.capacity, restored.tokens), (360.0, 10.0))
+
+    def test_headers_keep_reservations(self):
+        """Tokens reserved by requests in flight are not forgotten when a reply reports the remaining budget."""
+
+        bucket = TokenBucket(capacity=2, rate=1.0, clock=self.clock)
+        compare([bucket.reserve() for _index in range(4)], [0.0, 0.0, 1.0, 2.0])
+        bucket.update({'X-Rate-Limit-Limit': '2', 'X-Rate-Limit-Remaining': '1', 'X-Rate-Limit-Reset': '1'})
+        compare(bucket.tokens, -1.0)
+        compare(bucket.reserve(), 2.0)
+
+    def test_unusable_files(self):
+        """A default bucket is used instead of an unusable file."""
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'bucket.json')
+            for contents in ('{"capacity": null}', '{"capacity": 5, "tokens": "x"}', '[]', '{"rate'):
+                with open(filename, 'w') as bucket_file:
+                    bucket_file.write(contents)
+                compare(TokenBucket.load(filename, self.clock).capacity, TokenBucket.DEFAULT_CAPACITY)
+        finally:
+            shutil.rmtree(directory)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,9 @@
-"""Test EDSMQueries."""
+"""Test EDSMQueries.
+
+Usage: python test_edsm_queries.py [base url]
+
+Pass the url of an `edsm_standin.py` server to query it instead of www.edsm.net.
+"""
 
 import sys
 import json
@@ -84,8 +89,8 @@ def callback(request, response):
 def eventfull_callback(_event=None):
     """Catch EDSMCallback callback."""
 
-    (request, reply) = APP.queries.get_response()
-    callback(request, reply)
+    for (request, reply) in APP.queries.get_responses():
+        callback(request, reply)
 
 
 def make_requests():
@@ -98,6 +103,8 @@ def make_requests():
 
 
 LOGGER.logLevel = LOG_DEBUG
+if len(sys.argv) > 1:
+    EDSM_QUERIES.API_BASE_URL = sys.argv[1]
 
 ROOT = tk.Tk()
 APP = Application(master=ROOT)
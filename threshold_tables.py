@@ -0,0 +1,280 @@
+"""
+Generate percentile tables for material thresholds from an EDSM bodies dump.
+
+The dump (https://www.edsm.net/en/nightly-dumps, bodies.json or bodies7days.json,
+optionally gzipped) is a json list with one body per line. It is streamed in
+chunks of lines which are parsed and summarized by worker processes. Each worker
+adds all of its chunks to its own `SketchSet`s and hands them over once, when
+the dump is read, so the parent only reads the dump and merges one `SketchSet`
+per process. Memory stays flat no matter how large the dump is.
+
+This module does not depend on EDMC. Use it through `invoke thresholds`.
+"""
+
+from __future__ import print_function
+import gzip
+import json
+import time
+from multiprocessing import Process, Queue, cpu_count
+
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full  # pylint: disable=import-error
+
+from quantile_sketch import SketchSet
+
+
+THRESHOLDS_VERSION = 1
+DEFAULT_QUANTILE = 0.95
+PERCENTILES = (50, 75, 90, 95, 99)
+
+
+def iter_chunks(filename, chunk_size=5000):
+    """
+    Read a dump and yield lists with the raw lines of up to chunk_size bodies.
+
+    :param filename: Dump to read. Files ending in .gz are decompressed on the fly.
+    :param chunk_size: Number of lines per chunk.
+    """
+
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as dump:
+        chunk = []
+        for line in dump:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def process_chunk(lines):
+    """
+    Parse the bodies in a chunk and summarize their materials.
+
+    :param lines: Raw lines from the dump.
+    :return: tuple with the number of bodies, the `SketchSet.to_dict()` for all bodies and a dict with
+             subType: `SketchSet.to_dict()`.
+    """
+
+    everything = SketchSet()
+    sub_types = dict()
+    bodies = _summarize(lines, everything, sub_types)
+    return bodies, everything.to_dict(), dict((key, value.to_dict()) for key, value in sub_types.items())
+
+
+def _summarize(lines, everything, sub_types):
+    """
+    Add the materials of the bodies in a chunk to the sketches.
+
+    :param lines: Raw lines from the dump.
+    :param everything: `SketchSet` for all bodies.
+    :param sub_types: dict with subType: `SketchSet`, missing subTypes are added.
+    :return: The number of bodies with materials.
+    """
+
+    bodies = 0
+    for line in lines:
+        line = line.strip().rstrip(b',')
+        if not line.startswith(b'{'):
+            continue  # The opening and closing brackets of the list.
+        try:
+            body = json.loads(line.decode('utf-8'))
+        except ValueError:
+            continue
+
+        materials = body.get('materials')
+        if not materials:
+            continue
+        bodies += 1
+        everything.observe(materials)
+        sub_type = body.get('subType') or 'Unknown'
+        if sub_type not in sub_types:
+            sub_types[sub_type] = SketchSet()
+        sub_types[sub_type].observe(materials)
+    return bodies
+
+
+def _worker(tasks, results):
+    """
+    Summarize chunks until a `None` arrives, then send the sketches of all of them.
+
+    Runs in a worker process. Chunks are the joined lines, which pickle a lot faster than lists of lines.
+    :param tasks: `Queue` with chunks.
+    :param results: `Queue` receiving ('progress', bodies) after each chunk, ('done', (`SketchSet.to_dict()`, dict
+                    with subType: `SketchSet.to_dict()`)) at the end or ('error', message) when summarizing failed.
+    """
+
+    everything = SketchSet()
+    sub_types = dict()
+    try:
+        for chunk in iter(tasks.get, None):
+            results.put(('progress', _summarize(chunk.splitlines(), everything, sub_types)))
+        results.put(('done', (everything.to_dict(), dict((key, value.to_dict()) for key, value in sub_types.items()))))
+    except Exception as err:  # pylint: disable=broad-except
+        results.put(('error', '{type}: {err}'.format(type=type(err).__name__, err=err)))
+
+
+def _check_workers(workers, results):
+    """Raise a `RuntimeError` when all workers are gone without leaving messages."""
+
+    if not any(worker.is_alive() for worker in workers) and results.empty():
+        raise RuntimeError("All threshold workers exited")
+
+
+def generate(filename, processes=None, chunk_size=5000, quantile=DEFAULT_QUANTILE, progress=None):
+    """
+    Compute the percentile tables for a dump.
+
+    At most two chunks per process are queued, so reading never runs ahead of the workers.
+    :param filename: Dump to read.
+    :param processes: Number of worker processes. Defaults to the number of cpus.
+    :param chunk_size: Number of lines per chunk.
+    :param quantile: Quantile used for the default thresholds.
+    :param progress: Optional callable receiving the number of bodies processed so far.
+    :return: json serializable dict with the tables. See `load_thresholds()`.
+    :raise RuntimeError: When a worker failed.
+    """
+
+    processes = processes or cpu_count()
+    everything = SketchSet()
+    sub_types = dict()
+    bodies = [0]
+    done = [0]
+
+    def collect(message):
+        """Handle a message from a worker."""
+        (kind, value) = message
+        if kind == 'progress':
+            bodies[0] += value
+            if progress is not None:
+                progress(bodies[0])
+        elif kind == 'done':
+            (worker_sketches, worker_sub_types) = value
+            everything.merge(SketchSet.from_dict(worker_sketches))
+            for sub_type, sketches in worker_sub_types.items():
+                if sub_type not in sub_types:
+                    sub_types[sub_type] = SketchSet()
+                sub_types[sub_type].merge(SketchSet.from_dict(sketches))
+            done[0] += 1
+        else:
+            raise RuntimeError("Threshold worker failed: {message}".format(message=value))
+
+    def drain():
+        """Handle the messages the workers sent so far."""
+        while True:
+            try:
+                collect(results.get_nowait())
+            except Empty:
+                break
+
+    def put(chunk):
+        """Queue a chunk for the workers, handling their messages while waiting."""
+        while True:
+            try:
+                tasks.put(chunk, timeout=1.0)
+                break
+            except Full:
+                drain()
+                _check_workers(workers, results)
+        drain()
+
+    tasks = Queue(processes * 2)
+    results = Queue()
+    workers = [Process(target=_worker, args=(tasks, results)) for _ in range(processes)]
+    try:
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for chunk in iter_chunks(filename, chunk_size):
+            put(b''.join(chunk))
+        for _ in workers:
+            put(None)
+        while done[0] < len(workers):
+            try:
+                collect(results.get(timeout=1.0))
+            except Empty:
+                _check_workers(workers, results)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    return {
+        'version': THRESHOLDS_VERSION,
+        'bodies': bodies[0],
+        'quantile': quantile,
+        'thresholds': _rounded(everything.quantiles(quantile)),
+        'percentiles': _percentiles(everything),
+        'subTypes': dict(
+            (sub_type, {'percentiles': _percentiles(sketches)}) for sub_type, sketches in sub_types.items()
+        ),
+    }
+
+
+def _percentiles(sketches):
+    """Return a dict with material: {percentile: value}."""
+
+    tables = dict()
+    for percentile in PERCENTILES:
+        for material, value in sketches.quantiles(percentile / 100.0).items():
+            tables.setdefault(material, dict())[str(percentile)] = round(value, 2)
+    return tables
+
+
+def _rounded(values):
+    """Round all values of a dict to 2 decimals."""
+
+    return dict((key, round(value, 2)) for key, value in values.items())
+
+
+def write_thresholds(tables, filename):
+    """Write the output of `generate()` to a file."""
+
+    with open(filename, 'w') as out:
+        json.dump(tables, out, indent=1, sort_keys=True, separators=(',', ': '))
+
+
+def load_thresholds(filename):
+    """
+    Read the default thresholds from a file written by `write_thresholds()`.
+
+    :param filename: File to read.
+    :return: dict with lower-cased material name: threshold or `None` when the file is missing or unusable.
+    """
+
+    try:
+        with open(filename, 'r') as tables_file:
+            tables = json.load(tables_file)
+    except (IOError, ValueError):
+        return None
+
+    if tables.get('version') != THRESHOLDS_VERSION or not tables.get('thresholds'):
+        return None
+    return tables['thresholds']
+
+
+def main(filename, out, processes=None, chunk_size=5000, quantile=DEFAULT_QUANTILE):
+    """Generate the tables for a dump, write them out and report the throughput."""
+
+    start = time.time()
+
+    def progress(bodies):
+        """Print progress."""
+        print("\r{bodies} bodies with materials ({rate:.0f}/s)".format(
+            bodies=bodies,
+            rate=bodies / max(time.time() - start, 0.001),
+        ), end='')
+
+    tables = generate(filename, processes, chunk_size, quantile, progress)
+    print()
+    write_thresholds(tables, out)
+    print("Wrote thresholds for {count} materials and {sub_types} planet types to {out} in {seconds:.1f}s".format(
+        count=len(tables['thresholds']),
+        sub_types=len(tables['subTypes']),
+        out=out,
+        seconds=time.time() - start,
+    ))